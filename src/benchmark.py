@@ -0,0 +1,230 @@
+"""
+Performance benchmarks of every stage on synthetic data (src/utils/synthetic.py):
+    normalize -> run_quality_check -> summarize_qa_flags -> clean -> aggregate_kpis
+    -> compute_kpi_zone_time -> cluster_zone_time -> forecast_and_evaluate -> visualize_*
+
+For every data set size (100k, 1m, 10m rows of one month) each stage is timed (wall and CPU seconds, the
+best of --repeat runs) and run once more under tracemalloc for its peak of Python / NumPy allocations.
+The synthetic raw files are generated once into processed/synthetic and reused (same size, rates and seed
+give the same file). Results go to reports/benchmarks/benchmark_<time>_<commit>.json together with the commit,
+the machine and the package versions, so that two runs can be compared:
+
+Usage (from the project root):
+    python -m src.benchmark --sizes 100k 1m
+    python -m src.benchmark --sizes 1m --stages normalize run_quality_check clean --repeat 3
+    python -m src.benchmark --compare reports/benchmarks/<before>.json reports/benchmarks/<after>.json
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')  # headless: figures are only drawn and closed
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import pyarrow
+import seaborn
+import sklearn
+import statsmodels
+
+from src.utils.synthetic import default_rates, dataset_sizes, write_trips
+from src.utils.normalizing import normalize
+from src.utils.qa_rules import run_quality_check, summarize_qa_flags
+from src.utils.cleaning import clean
+from src.utils.kpi import aggregate_kpis
+from src.utils.cluster_zone import compute_kpi_zone_time, cluster_zone_time
+from src.utils.forecasting import forecast_and_evaluate
+from src.utils.visualization import visualize_summary, visualize_customer_segments, visualize_temporal_trends, visualize_trip_characteristics, visualize_geographical_analysis
+
+project_root = Path(__file__).resolve().parents[1]
+synthetic_dir = project_root / 'processed' / 'synthetic'
+benchmark_dir = project_root / 'reports' / 'benchmarks'
+
+# Stages in pipeline order, each run on the outputs of the stages before it
+benchmark_stages = ['normalize', 'run_quality_check', 'summarize_qa_flags', 'clean', 'aggregate_kpis',
+                    'compute_kpi_zone_time', 'cluster_zone_time', 'forecast_and_evaluate',
+                    'visualize_summary', 'visualize_customer_segments', 'visualize_temporal_trends',
+                    'visualize_trip_characteristics', 'visualize_geographical_analysis']
+mb = 1024 ** 2
+
+'''
+    Max resident set size of this process so far (ru_maxrss is in KB on Linux, in bytes on macOS).
+'''
+def max_rss_mb() -> float:
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / mb if sys.platform == 'darwin' else rss / 1024
+
+'''
+    Runs func(*args) repeat times and returns its result with wall / CPU seconds (best run) and,
+    with memory=True, the tracemalloc peak of one more run (tracing slows the code down, so it is never timed).
+'''
+def measure(func, *args, repeat: int = 1, memory: bool = True, **kwargs) -> tuple:
+    wall, cpu = [], []
+    for _ in range(repeat):
+        gc.collect()
+        start, start_cpu = time.perf_counter(), time.process_time()
+        result = func(*args, **kwargs)
+        wall.append(time.perf_counter() - start)
+        cpu.append(time.process_time() - start_cpu)
+    stats = {'seconds': min(wall), 'cpu_seconds': min(cpu), 'runs': wall}
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        func(*args, **kwargs)
+        stats['peak_mb'] = tracemalloc.get_traced_memory()[1] / mb
+        tracemalloc.stop()
+    stats['max_rss_mb'] = max_rss_mb()
+    return result, stats
+
+'''
+    Draws the figures of a visualize_* function and closes them.
+'''
+def draw(func, *args) -> int:
+    figures = func(*args)
+    for fig in figures.values():
+        plt.close(fig)
+    return len(figures)
+
+'''
+    Path of the synthetic raw month of n_rows, written first if it does not exist yet.
+'''
+def synthetic_file(name: str, n_rows: int, month: int, seed: int) -> Path:
+    path = synthetic_dir / f"synthetic_{name}_seed{seed}_2021-{month:02d}.parquet"
+    if not path.exists():
+        synthetic_dir.mkdir(parents=True, exist_ok=True)
+        start = time.perf_counter()
+        write_trips(path, n_rows, month, seed=seed)
+        print(f"Generated {n_rows:,} synthetic trips in {time.perf_counter() - start:.1f}s: {path}")
+    return path
+
+'''
+    Runs the selected stages on one raw month and returns one result row per stage.
+    Stages that are not selected still run (untimed) when a later stage needs their output.
+'''
+def run_benchmark(df_raw: pd.DataFrame, month: int, stages: list = None, repeat: int = 1, memory: bool = True) -> list:
+    stages = benchmark_stages if stages is None else stages
+    last = max(benchmark_stages.index(stage) for stage in stages)
+    rows = []
+
+    def stage(name: str, func, *args, rows_in: int = None, rows_out=len, **kwargs):
+        if name in stages:
+            result, stats = measure(func, *args, repeat=repeat, memory=memory, **kwargs)
+            out = rows_out(result) if rows_out is not None else None
+            rows.append({'stage': name, 'rows_in': rows_in, 'rows_out': out, **stats})
+            print(f"  {name:32s} {stats['seconds']:8.2f}s" + (f" {stats['peak_mb']:9.1f} MB peak" if memory else ''))
+            return result
+        return func(*args, **kwargs)
+
+    n = len(df_raw)
+    df = stage('normalize', normalize, df_raw, rows_in=n)
+    qa_flags = stage('run_quality_check', run_quality_check, df, month, rows_in=n)
+    stage('summarize_qa_flags', summarize_qa_flags, qa_flags, rows_in=n, rows_out=None)
+    if last <= benchmark_stages.index('summarize_qa_flags'):
+        return rows
+    cleaned, cleaned_flags = stage('clean', clean, df, qa_flags, rows_in=n, rows_out=lambda result: len(result[0]))
+    del df, qa_flags
+    m = len(cleaned)
+    kpi = stage('aggregate_kpis', aggregate_kpis, cleaned, cleaned_flags, rows_in=m, rows_out=lambda result: len(result['Daily']))
+    kpi_zone_time = stage('compute_kpi_zone_time', compute_kpi_zone_time, cleaned, cleaned_flags, rows_in=m)
+    stage('cluster_zone_time', cluster_zone_time, kpi_zone_time, rows_in=len(kpi_zone_time), rows_out=lambda result: len(result[0]))
+    stage('forecast_and_evaluate', forecast_and_evaluate, cleaned, 'H', 168, rows_in=m, rows_out=lambda result: len(result['predictions']))
+    for name, func, args in [
+        ('visualize_summary', visualize_summary, (cleaned, kpi['Daily'])),
+        ('visualize_customer_segments', visualize_customer_segments, (cleaned, cleaned_flags)),
+        ('visualize_temporal_trends', visualize_temporal_trends, (cleaned, cleaned_flags)),
+        ('visualize_trip_characteristics', visualize_trip_characteristics, (cleaned, cleaned_flags)),
+        ('visualize_geographical_analysis', visualize_geographical_analysis, (cleaned, cleaned_flags)),
+    ]:
+        if name in stages:
+            stage(name, draw, func, *args, rows_in=m, rows_out=None)
+    return rows
+
+'''
+    Commit the benchmark ran on and whether the tracked files had local changes (None outside a git checkout).
+'''
+def git_state() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=project_root, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=project_root, capture_output=True, text=True, check=True).stdout
+        return {'commit': commit, 'dirty': bool(status.strip())}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+def environment() -> dict:
+    return {
+        'python': platform.python_version(), 'platform': platform.platform(), 'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'packages': {module.__name__: module.__version__ for module in [pd, np, pyarrow, sklearn, statsmodels, matplotlib, seaborn]},
+    }
+
+'''
+    Result rows of a benchmark file as a frame indexed by (dataset, stage).
+'''
+def load_results(path) -> pd.DataFrame:
+    with open(path) as f:
+        report = json.load(f)
+    return pd.DataFrame(report['results']).set_index(['dataset', 'stage'])
+
+'''
+    Seconds and peak memory of two benchmark files side by side, with new / base ratios;
+    stages slower (or heavier) than threshold x the base are marked as regressions.
+'''
+def compare_benchmarks(base_path, new_path, threshold: float = 1.2) -> pd.DataFrame:
+    base, new = load_results(base_path), load_results(new_path)
+    columns = [c for c in ['seconds', 'peak_mb'] if c in base.columns and c in new.columns]
+    comparison = base[columns].join(new[columns], lsuffix='_base', rsuffix='_new', how='inner')
+    for c in columns:
+        comparison[f'{c}_ratio'] = comparison[f'{c}_new'] / comparison[f'{c}_base']
+    comparison['regression'] = (comparison[[f'{c}_ratio' for c in columns]] > threshold).any(axis=1)
+    return comparison
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Benchmark every pipeline stage on synthetic NYC TLC data.')
+    parser.add_argument('--sizes', nargs='+', default=['100k', '1m'], choices=list(dataset_sizes))
+    parser.add_argument('--stages', nargs='+', default=benchmark_stages, choices=benchmark_stages)
+    parser.add_argument('--month', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='timed runs per stage, the best one is kept')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run of every stage')
+    parser.add_argument('--output', type=Path, default=benchmark_dir)
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two benchmark files instead of running')
+    parser.add_argument('--threshold', type=float, default=1.2, help='ratio above which --compare reports a regression')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        comparison = compare_benchmarks(*args.compare, threshold=args.threshold)
+        with pd.option_context('display.width', 200, 'display.max_rows', None):
+            print(comparison.round(3))
+        if comparison['regression'].any():
+            sys.exit(1)
+        return
+
+    report = {'created': datetime.now().isoformat(timespec='seconds'), **git_state(), **environment(),
+              'month': args.month, 'seed': args.seed, 'repeat': args.repeat, 'rates': default_rates, 'results': []}
+    for name in args.sizes:
+        path = synthetic_file(name, dataset_sizes[name], args.month, args.seed)
+        print(f"Benchmark {name}: {path.name}")
+        df_raw = pd.read_parquet(path)
+        for row in run_benchmark(df_raw, args.month, args.stages, args.repeat, not args.no_memory):
+            report['results'].append({'dataset': name, 'rows': len(df_raw), **row})
+        del df_raw
+
+    args.output.mkdir(parents=True, exist_ok=True)
+    commit = (report['commit'] or 'nogit')[:7] + ('-dirty' if report['dirty'] else '')
+    out_path = args.output / f"benchmark_{datetime.now():%Y%m%d-%H%M%S}_{commit}.json"
+    with open(out_path, 'w') as f:
+        json.dump(report, f, indent=1, default=float)
+    print(f"Benchmark results saved to {out_path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,429 @@
+"""
+Command-line runner for the monthly pipeline:
+    normalize/QA/clean -> aggregate_kpis -> cluster_zones_with_kpi -> figures
+
+Each month runs in its own worker process, afterwards the per-month outputs are merged
+(in calendar order, so the result does not depend on which worker finished first) into
+reports/qa_summary.csv, reports/kpi_{daily,weekly,monthly,yearly}_<year>.csv and figures/<year>.
+
+Weekly and yearly KPIs are rolled up from the daily partials of the months (src/utils/kpi.py, rollup_kpis),
+so a week across two months is one row. The kpi stage also appends every month to the KPI cube in
+processed/kpi_cube, queried with src.utils.cube.query_cube, and writes its origin-destination flows
+to processed/od (merged into od_<year>.npy, see src/utils/od.py). The hourly trips of every pickup zone are kept
+for the whole year in the memory-mapped store of processed/demand (src/utils/demand.py), updated for the changed months only.
+
+The cleaned months are also written as a partitioned dataset to processed/cleaned_dataset
+(by pickup month and day, with the QA flags inside), read with src.utils.dataset.load_cleaned.
+
+Trips re-sent in a later month are flagged as duplicates there: before the months run, the trip fingerprints
+of every earlier raw month are written to processed/fingerprints (see src/utils/fingerprint.py).
+
+Every run writes reports/run_report_<time>.json: wall / CPU seconds, rows in and out and the RSS change of every stage
+of every month and of the instrumented functions inside it (src/utils/instrumentation.py); --trace-memory adds
+tracemalloc peaks, --profile STEP dumps a cProfile of one step to reports/profiles.
+
+Stages are skipped when processed/build_manifest.json shows that their outputs were built from the
+same inputs and the same code (see src/utils/build_cache.py), --force rebuilds them anyway.
+
+Usage (from the project root):
+    python -m src.pipeline --months 1-12 --workers 6
+    python -m src.pipeline --months 1,2,3 --stages kpi figures
+    python -m src.pipeline --months 3 --stages clean --force --trace-memory --profile run_quality_check
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import matplotlib
+matplotlib.use('Agg')  # headless: worker processes only save figures
+import pandas as pd
+
+from src.utils import normalizing, qa_rules, cleaning, streaming, fingerprint, dataset, kpi as kpi_module, sketch, cube, od, demand, cluster_zone, figure_data, visualization
+from src.utils.build_cache import BuildManifest, code_version, stage_key
+from src.utils.instrumentation import Instrumentation, instrument_run, step
+from src.utils.streaming import stream_normalize_clean
+from src.utils.fingerprint import FingerprintIndex, raw_file_fingerprints
+from src.utils.dataset import write_month_dataset
+from src.utils.qa_rules import qa_report_frame, QASummaryAccumulator
+from src.utils.kpi import aggregate_kpis, daily_partials, rollup_kpis
+from src.utils.cube import build_cube, append_month_cube
+from src.utils.od import ODMatrix, merge_od_files
+from src.utils.demand import DemandStore, demand_columns
+from src.utils.figure_data import FigureData
+from src.utils.rendering import render_all, save_figures
+from src.utils.cluster_zone import cluster_zones_with_kpi
+from src.utils.visualization import visualize_years
+
+project_root = Path(__file__).resolve().parents[1]
+raw_dir = project_root / 'raw'
+cleaned_dir = project_root / 'processed' / 'cleaned_data'
+dataset_dir = project_root / 'processed' / 'cleaned_dataset'
+flag_dir = project_root / 'processed' / 'flags_for_analysis'
+cluster_dir = project_root / 'processed' / 'cluster_zone'
+qa_dir = project_root / 'processed' / 'qa_summary'
+kpi_dir = project_root / 'processed' / 'kpi'
+cube_dir = project_root / 'processed' / 'kpi_cube'
+od_dir = project_root / 'processed' / 'od'
+demand_dir = project_root / 'processed' / 'demand'
+figure_data_dir = project_root / 'processed' / 'figure_data'
+fingerprint_dir = project_root / 'processed' / 'fingerprints'
+reports_dir = project_root / 'reports'
+profile_dir = reports_dir / 'profiles'
+figures_dir = project_root / 'figures'
+manifest_path = project_root / 'processed' / 'build_manifest.json'
+
+all_stages = ['clean', 'kpi', 'cluster', 'figures']
+kpi_frequencies = ['Daily', 'Weekly', 'Monthly']
+
+def month_key(year: int, month: int) -> str:
+    return f"{year}-{month:02d}"
+
+def raw_file(year: int, month: int) -> Path:
+    return raw_dir / f"yellow_tripdata_{month_key(year, month)}.parquet"
+
+def month_name(month: int) -> str:
+    return pd.Timestamp(2000, month, 1).strftime('%B')
+
+def parse_months(text: str) -> list:
+    months = set()
+    for part in text.split(','):
+        if '-' in part:
+            start, end = part.split('-')
+            months.update(range(int(start), int(end) + 1))
+        else:
+            months.add(int(part))
+    return sorted(months)
+
+'''
+    Output files of every stage of one month.
+'''
+def month_outputs(year: int, month: int) -> dict:
+    key = month_key(year, month)
+    return {
+        'clean': [cleaned_dir / f"cleaned_yellow_tripdata_{key}.parquet",
+                  flag_dir / f"flag_yellow_tripdata_{key}.parquet",
+                  qa_dir / f"qa_summary_{key}.json",
+                  dataset_dir / f"pickup_month={key}"],
+        'kpi': [kpi_dir / f"kpi_{freq.lower()}_{key}.parquet" for freq in kpi_frequencies]
+               + [kpi_dir / f"kpi_partials_{key}.parquet", cube_dir / f"pickup_month={key}", od_dir / f"od_{key}.npy"],
+        'cluster': [cluster_dir / f"clustered_yellow_tripdata_{key}.parquet"],
+        'figures': [figure_data_dir / f"figure_data_{key}"],
+    }
+
+'''
+    Keys of the fingerprint files of every raw month of the year, from the content of the raw file.
+'''
+def fingerprint_keys(manifest: BuildManifest, year: int) -> dict:
+    code = code_version(fingerprint)
+    return {month: stage_key([manifest.file_hash(raw_file(year, month))], code)
+            for month in range(1, 13) if raw_file(year, month).exists()}
+
+'''
+    Key of the cleaned file on disk: the key it was recorded with, or its content hash (e.g. a cleaned file
+    copied in without a manifest).
+'''
+def cleaned_file_key(manifest: BuildManifest, cleaned_path: Path) -> str:
+    return manifest.artifacts.get(manifest.relative(cleaned_path)) or manifest.file_hash(cleaned_path)
+
+'''
+    Build keys of every stage of one month. The clean stage is keyed by the content of the raw file,
+    the fingerprints of the earlier months (cross-month duplicates) and the normalize/QA/clean code,
+    later stages by the key of the cleaned file they read and their own code.
+    cleaned_key is that key when the clean stage does not run first (see run_pipeline); by default the later
+    stages read the output of the clean key. Without the raw file, the existing cleaned file is taken as the source of the month.
+'''
+def month_keys(manifest: BuildManifest, year: int, month: int, fingerprints: dict, cleaned_key: str = None) -> dict:
+    raw_path = raw_file(year, month)
+    cleaned_path = month_outputs(year, month)['clean'][0]
+    if raw_path.exists():
+        earlier = [key for m, key in sorted(fingerprints.items()) if m < month]
+        clean_key = stage_key([manifest.file_hash(raw_path)] + earlier, code_version(normalizing, qa_rules, cleaning, streaming, fingerprint, dataset), packed_flags=True,
+                              legacy_double_count=True)
+    elif cleaned_path.exists():
+        clean_key = cleaned_file_key(manifest, cleaned_path)
+    else:
+        return {}
+    source = clean_key if cleaned_key is None else cleaned_key
+    return {
+        'clean': clean_key,
+        'kpi': stage_key([source], code_version(kpi_module, sketch, cube, od)),
+        'cluster': stage_key([source], code_version(cluster_zone, kpi_module)),
+        'figures': stage_key([source], code_version(kpi_module, figure_data)),
+    }
+
+'''
+    Writes the fingerprint file of one raw month. Executed in a worker process.
+'''
+def build_fingerprints(year: int, month: int) -> int:
+    FingerprintIndex(fingerprint_dir).save(year, month, raw_file_fingerprints(raw_file(year, month)))
+    return month
+
+'''
+    Runs the selected stages for one month. Executed in a worker process.
+    Outputs are written to processed/, figures/ and small per-month intermediates
+    (QA summary accumulator, KPI frames) that merge_outputs() combines afterwards.
+'''
+def run_month(year: int, month: int, stages: list, batch_size: int, trace_memory: bool = False, profile: str = None,
+              save_fingerprints: bool = True) -> dict:
+    with instrument_run(trace_memory=trace_memory, profile=profile, profile_dir=profile_dir, labels={'month': month}) as run:
+        run_month_stages(year, month, stages, batch_size, save_fingerprints)
+    timings = {record['name']: record['wall_seconds'] for record in run.records if record['depth'] == 0}
+    return {'month': month, 'timings': timings, 'calls': run.records, 'profiles': run.profiles}
+
+'''
+    The stages of one month, each one step of the run report (the instrumented functions inside are nested in it).
+    save_fingerprints=False keeps the month's fingerprint file, already built from the same raw file
+    (later months may be reading it).
+'''
+def run_month_stages(year: int, month: int, stages: list, batch_size: int, save_fingerprints: bool = True) -> None:
+    key = month_key(year, month)
+    cleaned_path, flag_path, qa_path, _ = month_outputs(year, month)['clean']
+
+    if 'clean' in stages:
+        with step('clean'):
+            accumulator = QASummaryAccumulator()
+            stream_normalize_clean(raw_file(year, month), cleaned_path, flag_path, month, batch_size=batch_size, packed_flags=True,
+                                   fingerprint_index=FingerprintIndex(fingerprint_dir), year=year, accumulator=accumulator,
+                                   save_fingerprints=save_fingerprints, legacy_double_count=True)
+            with open(qa_path, 'w') as f:
+                json.dump(accumulator.to_dict(), f)
+            write_month_dataset(pd.read_parquet(cleaned_path), pd.read_parquet(flag_path), dataset_dir, year, month)
+
+    if not set(stages) & {'kpi', 'cluster', 'figures'}:
+        return
+
+    with step('load_cleaned') as record:
+        df = pd.read_parquet(cleaned_path)
+        df_flag = pd.read_parquet(flag_path)
+        record['rows_out'] = len(df)
+
+    kpi = None
+    if 'kpi' in stages or 'figures' in stages:
+        with step('kpi', rows_in=len(df)):
+            kpi = aggregate_kpis(df, df_flag)
+            if 'kpi' in stages:
+                for freq in kpi_frequencies:
+                    kpi[freq].to_parquet(kpi_dir / f"kpi_{freq.lower()}_{key}.parquet", index=False)
+                daily_partials(df, df_flag).to_parquet(kpi_dir / f"kpi_partials_{key}.parquet", index=False)
+                append_month_cube(build_cube(df, df_flag), cube_dir, year, month)
+                ODMatrix.from_trips(df, df_flag, by='time_bin').save(od_dir / f"od_{key}.npy")
+
+    if 'cluster' in stages:
+        with step('cluster', rows_in=len(df)):
+            clustered_df, centroids = cluster_zones_with_kpi(df, df_flag)
+            clustered_df.to_parquet(cluster_dir / f"clustered_yellow_tripdata_{key}.parquet")
+
+    if 'figures' in stages:
+        # Only the figure data here, the charts of all months are rendered together by render_figures()
+        with step('figures', rows_in=len(df)):
+            FigureData.from_trips(df, df_flag, kpi['Daily']).save(figure_data_dir / f"figure_data_{key}")
+
+'''
+    Combines the per-month intermediates of all available months into the yearly reports.
+    Months are always taken in calendar order, so the files are identical whatever the worker order was.
+    A yearly report is only rewritten when the keys of its monthly inputs changed.
+'''
+def merge_outputs(manifest: BuildManifest, year: int, stages: list, dpi: int, force: bool = False) -> None:
+    months = range(1, 13)
+    merge_code = code_version(merge_outputs)
+
+    def merged_key(paths: list, **params) -> str:
+        return stage_key([manifest.artifacts.get(manifest.relative(p)) for p in paths], merge_code, **params)
+
+    if 'clean' in stages:
+        paths = {m: qa_dir / f"qa_summary_{month_key(year, m)}.json" for m in months}
+        paths = {m: p for m, p in paths.items() if p.exists()}
+        qa_path = reports_dir / "qa_summary.csv"
+        key = merged_key(list(paths.values()))
+        if paths and (force or not manifest.is_fresh([qa_path], key)):
+            # One column per month, then the whole year from the merged accumulators
+            final_qa_report_df = qa_report_frame()
+            year_total = QASummaryAccumulator()
+            for m, path in paths.items():
+                with open(path) as f:
+                    accumulator = QASummaryAccumulator.from_dict(json.load(f))
+                final_qa_report_df[month_name(m)] = accumulator.summary()
+                year_total.merge(accumulator)
+            final_qa_report_df[str(year)] = year_total.summary()
+            final_qa_report_df.to_csv(qa_path, index=False)
+            manifest.record([qa_path], key)
+            print(f"QA report saved to {qa_path}")
+
+    if 'kpi' in stages or 'figures' in stages:
+        # Daily and monthly KPIs never cross a month: the exact monthly frames are concatenated
+        for freq in ['Daily', 'Monthly']:
+            paths = [p for p in (kpi_dir / f"kpi_{freq.lower()}_{month_key(year, m)}.parquet" for m in months) if p.exists()]
+            csv_path = reports_dir / f"kpi_{freq.lower()}_{year}.csv"
+            key = merged_key(paths)
+            if paths and (force or not manifest.is_fresh([csv_path], key)):
+                pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True).to_csv(csv_path, index=False)
+                manifest.record([csv_path], key)
+                print(f"KPI report saved to {csv_path}")
+
+        # Weeks across two months and the whole year are rolled up from the daily partials of all months
+        paths = [p for p in (kpi_dir / f"kpi_partials_{month_key(year, m)}.parquet" for m in months) if p.exists()]
+        for name, freq in [('weekly', 'W'), ('yearly', 'YE')]:
+            csv_path = reports_dir / f"kpi_{name}_{year}.csv"
+            key = merged_key(paths, freq=freq)
+            if paths and (force or not manifest.is_fresh([csv_path], key)):
+                partials = pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+                rollup_kpis(partials, freq).to_csv(csv_path, index=False)
+                manifest.record([csv_path], key)
+                print(f"KPI report saved to {csv_path}")
+
+        # Origin-destination flows of the year
+        paths = [p for p in (od_dir / f"od_{month_key(year, m)}.npy" for m in months) if p.exists()]
+        od_path = od_dir / f"od_{year}.npy"
+        key = merged_key(paths)
+        if paths and (force or not manifest.is_fresh([od_path], key)):
+            merge_od_files(paths).save(od_path)
+            manifest.record([od_path], key)
+            print(f"OD matrix saved to {od_path}")
+
+        # Year-long hourly demand: only the months whose cleaned file (or the store code) changed are rewritten
+        store = DemandStore(demand_dir, year)
+        for m in months:
+            cleaned_path = cleaned_dir / f"cleaned_yellow_tripdata_{month_key(year, m)}.parquet"
+            if not cleaned_path.exists():
+                continue
+            key = stage_key([manifest.artifacts.get(manifest.relative(cleaned_path))], code_version(demand))
+            if force or store.months.get(m) != key:
+                store.update_month(pd.read_parquet(cleaned_path, columns=demand_columns), m, key)
+                print(f"Demand store updated with {month_name(m)}")
+
+    monthly_csv = reports_dir / f"kpi_monthly_{year}.csv"
+    if 'figures' in stages and monthly_csv.exists():
+        output_dir = figures_dir / str(year)
+        outputs = [output_dir / 'revenue_vs_trip.png', output_dir / 'trip_distance_whole_year.png']
+        key = stage_key([manifest.artifacts.get(manifest.relative(monthly_csv))], code_version(merge_outputs, visualization), dpi=dpi)
+        if force or not manifest.is_fresh(outputs, key):
+            output_dir.mkdir(parents=True, exist_ok=True)
+            save_figures(visualize_years(pd.read_csv(monthly_csv)), output_dir, dpi)
+            manifest.record(outputs, key)
+
+    # Figure data of the whole year, the months added up
+    paths = [p for p in (figure_data_dir / f"figure_data_{month_key(year, m)}" for m in months) if p.exists()]
+    year_path = figure_data_dir / f"figure_data_{year}"
+    key = merged_key(paths)
+    if 'figures' in stages and paths and (force or not manifest.is_fresh([year_path], key)):
+        data = FigureData.load(paths[0])
+        for path in paths[1:]:
+            data = data.merge(FigureData.load(path))
+        data.label = str(year)
+        data.save(year_path)
+        manifest.record([year_path], key)
+
+'''
+    Charts of every month with figure data and of the whole year, all (month, plot type) pairs in parallel;
+    plot types whose figure data did not change are skipped (see src/utils/rendering.py).
+'''
+def render_figures(year: int, dpi: int, preview_dpi: int, workers: int, force: bool = False) -> dict:
+    jobs = [(figure_data_dir / f"figure_data_{month_key(year, m)}", figures_dir / f"{month_name(m)}_figures") for m in range(1, 13)]
+    jobs.append((figure_data_dir / f"figure_data_{year}", figures_dir / str(year)))
+    return render_all([(data, folder) for data, folder in jobs if data.exists()], dpi, preview_dpi, workers, force)
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description='Run the NYC TLC monthly pipeline for several months in parallel.')
+    parser.add_argument('--year', type=int, default=2021)
+    parser.add_argument('--months', default='1-12', help="e.g. '1-12' or '1,2,5-7'")
+    parser.add_argument('--stages', nargs='+', choices=all_stages, default=all_stages)
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--batch-size', type=int, default=500_000, help='rows per record batch when cleaning')
+    parser.add_argument('--dpi', type=int, default=300)
+    parser.add_argument('--preview-dpi', type=int, default=None, help='also save JPEG previews of the figures at this dpi')
+    parser.add_argument('--force', action='store_true', help='rebuild even if the build manifest says outputs are up to date')
+    parser.add_argument('--trace-memory', action='store_true', help='record the tracemalloc peak of every step in the run report (slower)')
+    parser.add_argument('--profile', metavar='STEP', help="cProfile one step (a stage such as 'kpi' or a function such as 'run_quality_check') into reports/profiles")
+    args = parser.parse_args(argv)
+    report_path = reports_dir / f"run_report_{datetime.now():%Y%m%d-%H%M%S}.json"
+    with instrument_run(report_path, trace_memory=args.trace_memory, profile=args.profile, profile_dir=profile_dir,
+                        argv=argv if argv is not None else sys.argv[1:], year=args.year, stages=args.stages) as run:
+        run_pipeline(args, run)
+    print(f"Run report saved to {report_path}")
+
+'''
+    The whole run: stale stages of every month on the process pool, then the yearly merge and the figures.
+    The steps of the workers are added to the run report of this process.
+'''
+def run_pipeline(args: argparse.Namespace, run: Instrumentation) -> None:
+    months = parse_months(args.months)
+    for folder in [cleaned_dir, flag_dir, dataset_dir, cluster_dir, qa_dir, kpi_dir, cube_dir, od_dir, demand_dir, figure_data_dir, fingerprint_dir, reports_dir, figures_dir]:
+        folder.mkdir(parents=True, exist_ok=True)
+
+    # Decide which stages of which month are stale
+    manifest = BuildManifest(manifest_path, project_root)
+    index = FingerprintIndex(fingerprint_dir)
+    fingerprints = fingerprint_keys(manifest, args.year)
+    plan = {}
+    for month in months:
+        keys = month_keys(manifest, args.year, month, fingerprints)
+        if not keys:
+            print(f"Skipped {month_name(month)}: no raw or cleaned data")
+            continue
+        outputs = month_outputs(args.year, month)
+        clean_stale = args.force or not manifest.is_fresh(outputs['clean'], keys['clean'])
+        if clean_stale and not ('clean' in args.stages and raw_file(args.year, month).exists()):
+            # The later stages read the cleaned file as it is: key them by it, so that they run again once it is re-cleaned
+            cleaned_path = outputs['clean'][0]
+            if not cleaned_path.exists():
+                print(f"Skipped {month_name(month)}: not cleaned yet (run the clean stage)")
+                continue
+            if 'clean' not in args.stages and raw_file(args.year, month).exists():
+                print(f"Warning: the cleaned data of {month_name(month)} is stale, the other stages use it as it is")
+            keys = month_keys(manifest, args.year, month, fingerprints, cleaned_key=cleaned_file_key(manifest, cleaned_path))
+        stale = [stage for stage in args.stages if args.force or not manifest.is_fresh(outputs[stage], keys[stage])]
+        if 'clean' in stale and not raw_file(args.year, month).exists():
+            stale.remove('clean')
+        if stale:
+            plan[month] = (stale, keys, outputs)
+        else:
+            print(f"Up to date: {month_name(month)}")
+
+    # Fingerprints of the months before the last month to clean must exist before any month is cleaned
+    last_clean = max([m for m, (stale, _, _) in plan.items() if 'clean' in stale], default=0)
+    missing = [m for m, key in fingerprints.items()
+               if m < last_clean and (args.force or not manifest.is_fresh([index.path(args.year, m)], key))]
+
+    start = time.perf_counter()
+    if missing:
+        with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(missing)))) as pool:
+            for month in pool.map(build_fingerprints, [args.year] * len(missing), missing):
+                manifest.record([index.path(args.year, month)], fingerprints[month])
+        manifest.save()
+        print(f"Fingerprinted {len(missing)} earlier month(s) for cross-month duplicates")
+
+    if plan:
+        with ProcessPoolExecutor(max_workers=max(1, min(args.workers, len(plan)))) as pool:
+            # A fingerprint file recorded with the key of the same raw file is kept as it is
+            futures = [pool.submit(run_month, args.year, m, stale, args.batch_size, args.trace_memory, args.profile,
+                                   not (m in fingerprints and manifest.is_fresh([index.path(args.year, m)], fingerprints[m])))
+                       for m, (stale, _, _) in plan.items()]
+            for future in as_completed(futures):
+                result = future.result()
+                run.records.extend(result['calls'])
+                run.profiles.extend(result['profiles'])
+                stale, keys, outputs = plan[result['month']]
+                for stage in stale:
+                    manifest.record(outputs[stage], keys[stage])
+                if 'clean' in stale:
+                    manifest.record([index.path(args.year, result['month'])], fingerprints[result['month']])
+                manifest.save()
+                steps = ', '.join(f"{stage} {seconds:.1f}s" for stage, seconds in result['timings'].items())
+                print(f"Successfully processed {month_name(result['month'])}: {steps}")
+
+    with step('merge_outputs'):
+        merge_outputs(manifest, args.year, args.stages, args.dpi, force=args.force)
+    manifest.save()
+    if 'figures' in args.stages:
+        with step('render_figures'):
+            rendered = render_figures(args.year, args.dpi, args.preview_dpi, args.workers, force=args.force)
+        print(f"Figures: {rendered['rendered']} plot type(s) rendered, {rendered['skipped']} up to date")
+    print(f"Pipeline finished in {time.perf_counter() - start:.1f}s")
+
+if __name__ == '__main__':
+    main()
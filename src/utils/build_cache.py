@@ -0,0 +1,109 @@
+import ast
+import hashlib
+import importlib
+import inspect
+import json
+import os
+from pathlib import Path
+
+project_package = 'src'
+
+'''
+    Content-addressed build manifest for the generated artifacts in processed/, reports/ and figures/.
+
+    Every stage gets a key: the hash of its input keys, of the source code of the modules that produce it
+    and of its parameters. Raw input files are keyed by the hash of their content, outputs of an earlier
+    stage by that stage's key, so keys of a whole month can be computed before anything runs.
+    A stage is up to date when all its outputs exist and were recorded with the same key; editing
+    qa_rules.py or re-downloading a raw file changes the key of every stage downstream of it.
+'''
+class BuildManifest:
+    def __init__(self, path, root):
+        self.path = Path(path)
+        self.root = Path(root)
+        if self.path.exists():
+            with open(self.path) as f:
+                data = json.load(f)
+        else:
+            data = {}
+        # artifact (path relative to root) -> key of the stage that wrote it
+        self.artifacts = data.get('artifacts', {})
+        # file (path relative to root) -> [size, mtime_ns, sha256], avoids re-hashing unchanged raw files
+        self.file_hashes = data.get('files', {})
+
+    def relative(self, path) -> str:
+        return Path(path).resolve().relative_to(self.root.resolve()).as_posix()
+
+    def file_hash(self, path) -> str:
+        stat = os.stat(path)
+        name = self.relative(path)
+        cached = self.file_hashes.get(name)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        self.file_hashes[name] = [stat.st_size, stat.st_mtime_ns, digest.hexdigest()]
+        return digest.hexdigest()
+
+    def is_fresh(self, outputs: list, key: str) -> bool:
+        return all(Path(p).exists() and self.artifacts.get(self.relative(p)) == key for p in outputs)
+
+    def record(self, outputs: list, key: str) -> None:
+        for p in outputs:
+            self.artifacts[self.relative(p)] = key
+
+    def save(self) -> None:
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'artifacts': self.artifacts, 'files': self.file_hashes}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+'''
+    Project modules (src.*) imported by the given modules, directly or through other project modules,
+    the given ones included. Imports are read from the source (ast), so imports inside functions count too.
+'''
+def module_closure(*modules) -> list:
+    seen = {}
+    pending = list(modules)
+    while pending:
+        module = pending.pop()
+        if module.__name__ in seen:
+            continue
+        seen[module.__name__] = module
+        for node in ast.walk(ast.parse(Path(module.__file__).read_text())):
+            if isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+                # from src.utils import kpi imports a module, from src.utils.kpi import rollup_kpis a name of one
+                names = [node.module] + [f"{node.module}.{alias.name}" for alias in node.names]
+            else:
+                continue
+            for name in names:
+                if name.split('.')[0] != project_package:
+                    continue
+                try:
+                    pending.append(importlib.import_module(name))
+                except ImportError:
+                    pass  # a function or class imported from a module, not a module
+    return [seen[name] for name in sorted(seen)]
+
+'''
+    Hash of the source code of the given modules or functions, used as the code version of a stage.
+    Whole modules are hashed together with every project module they import (module_closure), so that
+    editing a helper module, e.g. the sketches used by kpi.py, changes the key of the stages using it.
+'''
+def code_version(*objects) -> str:
+    digest = hashlib.sha256()
+    for module in module_closure(*(inspect.getmodule(obj) for obj in objects)):
+        digest.update(module.__name__.encode())
+        digest.update(Path(module.__file__).read_bytes())
+    return digest.hexdigest()
+
+'''
+    Key of one stage from the keys of its inputs, its code version and its parameters.
+'''
+def stage_key(inputs: list, code: str, **params) -> str:
+    payload = json.dumps({'inputs': list(inputs), 'code': code, 'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
@@ -1,17 +1,41 @@
 import pandas as pd
+import numpy as np
+
+from src.utils.qa_rules import rule_names, is_packed, packed_column, rule_mask, rule_bits
+from src.utils.instrumentation import instrumented
 
 """
     Cleans the DataFrame based on the QA flags and a "garbage threshold".
+    qa_flags can be the boolean frame of run_quality_check or its packed form (pack_flags),
+    the standard mask is returned in the same form.
+    A row is garbage when it violates more than threshold of the rules that are not removed anyway.
+    legacy_double_count=True reproduces the 2021 outputs (pipeline and notebooks): summarize_qa_flags used to leave
+    a total_violations column (violations of all rules) that was counted again, so every violated rule counted once
+    more. That count is about twice the one of the threshold from summarize_qa_flags, so many more rows are garbage.
 """
-def clean(normalized: pd.DataFrame, qa_flags: pd.DataFrame, threshold: int = 5):
+@instrumented
+def clean(normalized: pd.DataFrame, qa_flags: pd.DataFrame, threshold: int = 5, legacy_double_count: bool = False):
     # Rules to remove due to invalid values
     remove = ['is_duplicate', 'missing_datetime', 'invalid_time_order', 'invalid_month', 'invalid_duration', 'invalid_distance', 'invalid_speed']
 
-    # Columns that is not in remove and used to count total violations
-    flag_keep = [col for col in qa_flags.columns if col not in remove]
+    # Rules that are not in remove and used to count total violations
+    flag_keep = [col for col in qa_flags.columns if col in rule_names and col not in remove]
+
+    if is_packed(qa_flags):
+        bits = qa_flags[packed_column].to_numpy()
+        total_violations = np.bitwise_count(bits & rule_mask([r for r in rule_names if r not in remove]))
+        if legacy_double_count:
+            total_violations += np.bitwise_count(bits & rule_mask(rule_names))
+        bits = bits | ((total_violations > threshold).astype(np.uint32) << np.uint32(rule_bits['is_garbage_row']))
+        mask_to_keep = (bits & rule_mask(remove + ['is_garbage_row'])) == 0
+        cleaned = normalized[mask_to_keep].copy()
+        standard = pd.DataFrame({packed_column: bits[mask_to_keep]}, index=qa_flags.index[mask_to_keep])
+        return cleaned, standard
 
     # Identify rows that violates more than threshold columns
     qa_flags['total_violations'] = qa_flags[flag_keep].sum(axis=1)
+    if legacy_double_count:
+        qa_flags['total_violations'] += qa_flags[[col for col in qa_flags.columns if col in rule_names]].sum(axis=1)
     qa_flags['is_garbage_row'] = qa_flags['total_violations'] > threshold
     remove.append('is_garbage_row')
 
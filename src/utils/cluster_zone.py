@@ -1,36 +1,120 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import joblib
+import numpy as np
 import pandas as pd
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
 
-def compute_kpi_zone_time(df: pd.DataFrame, qa_flags: pd.DataFrame) -> pd.DataFrame:
-    df_calc = df.copy()
-    qa_flags = qa_flags.copy()
+from src.utils.normalizing import zone_dim
+from src.utils.build_cache import code_version, stage_key
+from src.utils.kpi import kpi_flags, masked_input, grouped_quantiles, local_nanoseconds, time_bin_codes, labels
+from src.utils.instrumentation import instrumented
+
+# Features of the zone x time bin rows used for clustering
+cluster_features = ['duration_p50', 'duration_p95', 'trips_index_100']
+
+# Name clusters based on rules
+def name_cluster(row):
+    if row['trips_index_100'] > 500 and row['duration_p95'] > 20:
+        return 'High Demand – Congested'
+    elif row['trips_index_100'] < 50 and row['duration_p50'] < 30:
+        return 'Low Demand – Smooth Flow'
+    elif row['duration_p95'] > 50:
+        return 'Unstable Traffic'
+    else:
+        return 'Efficient High Volume'
+
+cluster_descriptions = {
+    'High Demand – Congested': 'Zones and time bins with high trip volume and long 95th percentile durations, indicating congestion and high demand.',
+    'Low Demand – Smooth Flow': 'Zones and time bins with low trip volume and short median durations, suggesting smooth traffic flow.',
+    'Unstable Traffic': 'Zones and time bins with very long 95th percentile durations, indicating traffic instability.',
+    'Efficient High Volume': 'Zones and time bins with balanced high volume and reasonable durations, efficient operations.'
+}
 
-    # Define time bins
-    bin = [0, 4, 7, 10, 16, 19, 24]
-    labels = ['Early Morning', 'Morning','Morning Rush', 'Midday', 'Evening Rush', 'Late Night']
+'''
+    Centroids in feature units (one row per cluster) with their rule-based name and description.
+    The rules know four kinds of cluster: when several clusters get the same kind (e.g. k other than 4),
+    their names are suffixed with the cluster id ('Unstable Traffic #3'), so every cluster name is unique.
+'''
+def describe_centroids(centers: np.ndarray, columns: list = cluster_features) -> pd.DataFrame:
+    centroids = pd.DataFrame(centers, columns=columns)
+    centroids['cluster'] = centroids.index
+    kind = centroids.apply(name_cluster, axis=1)
+    shared = kind.duplicated(keep=False)
+    centroids['cluster_name'] = kind.where(~shared, kind + ' #' + centroids['cluster'].astype(str))
+    centroids['description'] = kind.map(cluster_descriptions)
+    return centroids
 
-    # Assign time bins based on pickup hour
-    df_calc['time_bin'] = pd.cut(df_calc['tpep_pickup_datetime'].dt.hour, bins=bin, labels=labels, right=False)
+'''
+    Feature rows of compute_kpi_zone_time indexed by (zone, time_bin), rows with a missing feature dropped.
+'''
+def cluster_feature_frame(df_kpi_zone_time: pd.DataFrame) -> pd.DataFrame:
+    return df_kpi_zone_time.set_index(['zone', 'time_bin'])[cluster_features].dropna()
 
-    # Use PU_Zone as zone
-    df_calc['zone'] = df_calc['PU_Zone']
+'''
+    Adds extra feature columns indexed by (zone name, time bin label), e.g. ODMatrix.zone_features(),
+    to the feature rows; rows without extra features get 0.
+'''
+def with_extra_features(df_cluster: pd.DataFrame, extra_features: pd.DataFrame) -> pd.DataFrame:
+    keys = pd.MultiIndex.from_arrays([df_cluster.index.get_level_values(level).astype(str) for level in ['zone', 'time_bin']])
+    extra = extra_features.reindex(keys).fillna(0)
+    return df_cluster.join(pd.DataFrame(extra.to_numpy(), index=df_cluster.index, columns=extra.columns))
 
-    # Calculation functions
-    def p50(x): return x.quantile(0.5)
-    def p95(x): return x.quantile(0.95)
+'''
+    Adds the cluster and cluster name of every row, zone and time_bin back as columns.
+'''
+def label_clusters(df_cluster: pd.DataFrame, clusters: np.ndarray, centroids: pd.DataFrame) -> pd.DataFrame:
+    df_cluster['cluster'] = clusters
+    cluster_name_map = centroids.set_index('cluster')['cluster_name']
+    df_cluster['cluster_name'] = df_cluster['cluster'].map(cluster_name_map)
+    return df_cluster.reset_index()
 
-    # Define aggregation rules
-    agg_rules = {
-        'duration_p50': ('trip_duration_minutes', p50),
-        'duration_p95': ('trip_duration_minutes', p95),
-        'speed_p50': ('avg_speed_mph', p50),
-        'avg_trip_distance': ('trip_distance', 'mean'),
-        'trips': ('trip_distance', 'count'),
-    }
+'''
+    Duration, speed and distance KPIs of every pickup zone x time bin in one pass over integer codes
+    (zone code of the zone table, time bin code of the local pickup hour), for a month or a whole year at once.
+    Inputs are masked by the same QA rules as in aggregate_kpis; trips counts every trip of the zone and time bin.
+    Rows are every (zone, time bin) pair of the zones seen, in zone name and time bin order.
+'''
+@instrumented
+def compute_kpi_zone_time(df: pd.DataFrame, qa_flags: pd.DataFrame) -> pd.DataFrame:
+    flags = kpi_flags(qa_flags)
 
-    # Group by zone and time_bin
-    df_kpi = df_calc.groupby(['zone', 'time_bin']).agg(**agg_rules).reset_index()
+    # Integer keys: zone code, time bin of the local pickup hour (-1 when missing)
+    zone_codes = zone_dim.take_codes(df['PULocationID'])[:, 1]
+    time_bins = time_bin_codes(local_nanoseconds(df['tpep_pickup_datetime']))
+    rows = np.flatnonzero((zone_codes >= 0) & (time_bins >= 0))
+
+    # Only zones seen in this data take part, numbered in zone name order
+    seen = np.bincount(zone_codes[rows], minlength=len(zone_dim.zone_categories)) > 0
+    zones = np.flatnonzero(seen)
+    zone_rank = (np.cumsum(seen) - 1)[zone_codes[rows]]
+    n_bins = len(labels)
+    n_groups = len(zones) * n_bins
+    # Small integer codes, so the stable sort by group in grouped_quantiles is a radix sort
+    group = (zone_rank * n_bins + time_bins[rows]).astype(np.int16)
+
+    df_kpi = pd.DataFrame({
+        'zone': pd.Categorical.from_codes(np.repeat(np.arange(len(zones)), n_bins), categories=zone_dim.zone_categories[zones]),
+        'time_bin': pd.Categorical.from_codes(np.tile(np.arange(n_bins), len(zones)), categories=labels, ordered=True),
+    })
+
+    # Grouped quantiles of the masked inputs, sorted once
+    for name, qs in [('duration', [0.5, 0.95]), ('speed', [0.5])]:
+        values = masked_input(df, flags, name)[rows]
+        order = np.argsort(values)[:np.count_nonzero(~np.isnan(values))]
+        for q, result in zip(qs, grouped_quantiles(values[order], group[order], n_groups, qs)):
+            df_kpi[f'{name}_p{round(q * 100)}'] = result
+
+    distance = masked_input(df, flags, 'distance')[rows]
+    valid = ~np.isnan(distance)
+    with np.errstate(invalid='ignore'):
+        df_kpi['avg_trip_distance'] = (np.bincount(group, weights=np.where(valid, distance, 0), minlength=n_groups)
+                                       / np.bincount(group, weights=valid, minlength=n_groups))
+    df_kpi['trips'] = np.bincount(group, minlength=n_groups)
 
     # Compute trips_index_100: normalize trips to index 100
     # Assuming base is the overall average trips per zone-time
@@ -39,66 +123,233 @@ def compute_kpi_zone_time(df: pd.DataFrame, qa_flags: pd.DataFrame) -> pd.DataFr
 
     return df_kpi
 
-def cluster_zone_time(df_kpi_zone_time: pd.DataFrame, n_clusters: int = 4) -> tuple:
-    features = ['duration_p50', 'duration_p95', 'trips_index_100']
-
-    df_cluster = (
-        df_kpi_zone_time
-        .set_index(['zone', 'time_bin'])
-        [features]
-        .dropna()
-    )
+'''
+    Feature rows of compute_kpi_zone_time with the extra features (if any) joined.
+'''
+def zone_time_features(df_kpi_zone_time: pd.DataFrame, extra_features: pd.DataFrame = None) -> pd.DataFrame:
+    df_cluster = cluster_feature_frame(df_kpi_zone_time)
+    if extra_features is not None:
+        df_cluster = with_extra_features(df_cluster, extra_features)
+    return df_cluster
 
+'''
+    Scaler and KMeans fitted on all feature rows.
+'''
+def fit_zone_clusters(df_cluster: pd.DataFrame, n_clusters: int, random_state: int) -> tuple:
     # Scale data
     scaler = StandardScaler()
     X = scaler.fit_transform(df_cluster)
 
     # Fit KMeans
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    df_cluster['cluster'] = kmeans.fit_predict(X)
-
-    # Analyze centroids
-    centroids = pd.DataFrame(
-        scaler.inverse_transform(kmeans.cluster_centers_),
-        columns=features
-    )
-    centroids['cluster'] = centroids.index
+    kmeans = KMeans(n_clusters=n_clusters, random_state=random_state).fit(X)
+    return scaler, kmeans
+
+'''
+    (df_cluster, centroids) of the zone x time bin rows with a fitted scaler and KMeans, e.g. those returned by
+    select_n_clusters together with its scores: scaler, kmeans, scores = select_n_clusters(df_kpi_zone_time)
+'''
+def label_zone_time(df_kpi_zone_time: pd.DataFrame, scaler: StandardScaler, kmeans: KMeans,
+                    extra_features: pd.DataFrame = None) -> tuple:
+    df_cluster = zone_time_features(df_kpi_zone_time, extra_features)
+    clusters = kmeans.predict(scaler.transform(df_cluster))
 
-    # Name clusters based on rules
-    def name_cluster(row):
-        if row['trips_index_100'] > 500 and row['duration_p95'] > 20:
-            return 'High Demand – Congested'
-        elif row['trips_index_100'] < 50 and row['duration_p50'] < 30:
-            return 'Low Demand – Smooth Flow'
-        elif row['duration_p95'] > 50:
-            return 'Unstable Traffic'
+    # Analyze and name centroids, map cluster names back to the rows
+    centroids = describe_centroids(scaler.inverse_transform(kmeans.cluster_centers_), list(df_cluster.columns))
+    return label_clusters(df_cluster, clusters, centroids), centroids
+
+'''
+    n_clusters='auto' chooses the number of clusters (and the seed) with select_n_clusters and uses the model it
+    fitted; call select_n_clusters and label_zone_time instead to keep its score table.
+'''
+@instrumented
+def cluster_zone_time(df_kpi_zone_time: pd.DataFrame, n_clusters=4, random_state: int = 42,
+                      extra_features: pd.DataFrame = None) -> tuple:
+    if n_clusters == 'auto':
+        scaler, kmeans, _ = select_n_clusters(df_kpi_zone_time, extra_features=extra_features)
+    else:
+        scaler, kmeans = fit_zone_clusters(zone_time_features(df_kpi_zone_time, extra_features), n_clusters, random_state)
+    return label_zone_time(df_kpi_zone_time, scaler, kmeans, extra_features)
+
+'''
+    Sample of the feature rows with the same share of every time bin (stratified), at most sample_size rows.
+'''
+def stratified_sample(df_cluster: pd.DataFrame, sample_size: int, random_state: int = 42) -> pd.DataFrame:
+    if len(df_cluster) <= sample_size:
+        return df_cluster
+    fraction = sample_size / len(df_cluster)
+    return (df_cluster.groupby(level='time_bin', observed=True, group_keys=False)
+            .apply(lambda rows: rows.sample(frac=fraction, random_state=random_state)))
+
+# Rows used for the silhouette (quadratic in the rows), the same rows for every fit
+silhouette_rows = 2000
+
+'''
+    Inertia and silhouette of one KMeans fit on the scaled sample. Executed in a worker process.
+'''
+def score_k(X: np.ndarray, n_clusters: int, seed: int) -> dict:
+    kmeans = KMeans(n_clusters=n_clusters, random_state=seed, n_init=1).fit(X)
+    silhouette = silhouette_score(X, kmeans.labels_, sample_size=min(silhouette_rows, len(X)), random_state=0)
+    return {'n_clusters': n_clusters, 'seed': seed, 'inertia': kmeans.inertia_, 'silhouette': silhouette}
+
+'''
+    Model selection for cluster_zone_time: fits KMeans for every k in k_range and every seed on a stratified sample
+    (by time bin) of the scaled features, in parallel worker processes, and scores each fit by inertia and silhouette
+    (on silhouette_rows of the sample).
+    The k with the best mean silhouette over the seeds is chosen, with its seed of lowest inertia, and fitted on all
+    feature rows like cluster_zone_time. With cache_dir, the score table is kept there (keyed by the sample, the
+    parameters and the code) and reused.
+    Returns (scaler, kmeans, scores): the fitted StandardScaler and KMeans of the chosen k and seed, and the scores
+    with one row per (k, seed) and a 'chosen' column.
+'''
+@instrumented
+def select_n_clusters(df_kpi_zone_time: pd.DataFrame, k_range=range(2, 9), seeds=(0, 1, 2), sample_size: int = 5000,
+                      workers: int = None, cache_dir=None, extra_features: pd.DataFrame = None) -> tuple:
+    df_cluster = zone_time_features(df_kpi_zone_time, extra_features)
+    sample = stratified_sample(df_cluster, sample_size)
+    X = StandardScaler().fit_transform(sample)
+    k_range = [k for k in k_range if 2 <= k < len(X)]
+    if not k_range:
+        raise ValueError('Not enough zone x time bin rows to compare cluster counts')
+
+    cache_path = None
+    if cache_dir is not None:
+        key = stage_key([hashlib.sha256(X.tobytes()).hexdigest()], code_version(score_k), k_range=k_range, seeds=list(seeds))
+        cache_path = Path(cache_dir) / f"k_sweep_{key[:16]}.csv"
+    if cache_path is not None and cache_path.exists():
+        scores = pd.read_csv(cache_path)
+    else:
+        grid = [(k, seed) for k in k_range for seed in seeds]
+        workers = workers or min(len(grid), os.cpu_count() or 1)
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(score_k, [X] * len(grid), *zip(*grid)))
         else:
-            return 'Efficient High Volume'
+            results = [score_k(X, k, seed) for k, seed in grid]
+        scores = pd.DataFrame(results)
 
-    centroids['cluster_name'] = centroids.apply(name_cluster, axis=1)
+    # Best mean silhouette over the seeds, then the seed of lowest inertia for that k
+    n_clusters = int(scores.groupby('n_clusters')['silhouette'].mean().idxmax())
+    candidates = scores[scores['n_clusters'] == n_clusters]
+    seed = int(candidates.loc[candidates['inertia'].idxmin(), 'seed'])
+    scores['chosen'] = (scores['n_clusters'] == n_clusters) & (scores['seed'] == seed)
 
-    # Add descriptions
-    descriptions = {
-        'High Demand – Congested': 'Zones and time bins with high trip volume and long 95th percentile durations, indicating congestion and high demand.',
-        'Low Demand – Smooth Flow': 'Zones and time bins with low trip volume and short median durations, suggesting smooth traffic flow.',
-        'Unstable Traffic': 'Zones and time bins with very long 95th percentile durations, indicating traffic instability.',
-        'Efficient High Volume': 'Zones and time bins with balanced high volume and reasonable durations, efficient operations.'
-    }
+    if cache_path is not None and not cache_path.exists():
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        scores.drop(columns='chosen').to_csv(cache_path, index=False)
+    return fit_zone_clusters(df_cluster, n_clusters, seed) + (scores,)
 
-    centroids['description'] = centroids['cluster_name'].map(descriptions)
+'''
+    Zone x time bin clustering fitted incrementally (months or chunks one after the other) with a running
+    StandardScaler and MiniBatchKMeans. Cluster IDs stay the same from one month to the next, because every
+    partial_fit starts from the current centroids; predict assigns new rows to the nearest centroid without refitting.
+    save / load persist the fitted scaler and centroids (joblib), so a new month warm-starts from the model on disk.
+    fitted_keys holds the keys (e.g. '2021-03') of the months fitted so far; a month already in it is not fitted again,
+    so re-running a month does not move the centroids.
+'''
+class ZoneClusterModel:
+    def __init__(self, n_clusters: int = 4, random_state: int = 42, batch_size: int = 1024):
+        self.scaler = StandardScaler()
+        # No random reassignment of small clusters, so cluster IDs stay stable between months
+        self.kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state, batch_size=batch_size,
+                                      n_init=3, reassignment_ratio=0)
+        self.random_state = random_state
+        self.batch_size = batch_size
+        self.n_rows = 0
+        self.fitted_keys = set()
 
-    # Map cluster names back to df_cluster
-    cluster_name_map = centroids.set_index('cluster')['cluster_name']
-    df_cluster['cluster_name'] = df_cluster['cluster'].map(cluster_name_map)
+    @property
+    def is_fitted(self) -> bool:
+        return hasattr(self.kmeans, 'cluster_centers_')
+
+    '''
+        Updates the scaler and the centroids with the rows of one month or chunk (compute_kpi_zone_time output).
+        With a key, a month already fitted is skipped and the key is recorded after the fit.
+        The first fit needs at least n_clusters rows to initialize the centroids.
+    '''
+    def partial_fit(self, df_kpi_zone_time: pd.DataFrame, key: str = None) -> 'ZoneClusterModel':
+        if key is not None and key in self.fitted_keys:
+            return self
+        X = cluster_feature_frame(df_kpi_zone_time).to_numpy(dtype='float64')
+        if len(X) == 0:
+            return self
+        if not self.is_fitted and len(X) < self.kmeans.n_clusters:
+            raise ValueError(f"The first fit of the zone cluster model needs at least n_clusters={self.kmeans.n_clusters} "
+                             f"zone x time bin rows with all features, got {len(X)}" + (f" for {key}" if key is not None else ''))
+
+        # The scaler moves with the new rows: keep the centroids where they are in feature units
+        centers = self.centroid_values() if self.is_fitted else None
+        self.scaler.partial_fit(X)
+        if centers is not None:
+            self.kmeans.cluster_centers_ = self.scaler.transform(centers)
+
+        # Mini-batch steps over the shuffled rows (the first batch also initializes the centroids)
+        X = self.scaler.transform(X)
+        order = np.random.default_rng(self.random_state + self.n_rows).permutation(len(X))
+        n_batches = max(1, len(X) // self.batch_size)
+        for batch in np.array_split(order, n_batches):
+            self.kmeans.partial_fit(X[batch])
+        self.n_rows += len(X)
+        if key is not None:
+            self.fitted_keys.add(key)
+        return self
+
+    def centroid_values(self) -> np.ndarray:
+        return self.scaler.inverse_transform(self.kmeans.cluster_centers_)
+
+    def centroids(self) -> pd.DataFrame:
+        return describe_centroids(self.centroid_values())
+
+    '''
+        Nearest cluster of every zone x time bin row, in the format of cluster_zone_time.
+    '''
+    def predict(self, df_kpi_zone_time: pd.DataFrame) -> tuple:
+        df_cluster = cluster_feature_frame(df_kpi_zone_time)
+        clusters = self.kmeans.predict(self.scaler.transform(df_cluster.to_numpy(dtype='float64')))
+        centroids = self.centroids()
+        return label_clusters(df_cluster, clusters, centroids), centroids
+
+    def save(self, path) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        joblib.dump(self, path)
 
-    # Reset index to have zone and time_bin as columns
-    df_cluster = df_cluster.reset_index()
+    @classmethod
+    def load(cls, path) -> 'ZoneClusterModel':
+        model = joblib.load(path)
+        # Models saved before fitted_keys existed
+        if not hasattr(model, 'fitted_keys'):
+            model.fitted_keys = set()
+        return model
 
-    return df_cluster, centroids
+'''
+    Clusters one month with the persisted model at model_path: warm-starts from it (or creates it),
+    updates it with the month, saves it and returns (df_cluster, centroids) like cluster_zone_time.
+    key names the month (e.g. '2021-03'): a month the model already has is only predicted, not fitted again.
+'''
+@instrumented
+def cluster_zone_time_incremental(df_kpi_zone_time: pd.DataFrame, model_path, n_clusters=4, key: str = None) -> tuple:
+    if Path(model_path).exists():
+        model = ZoneClusterModel.load(model_path)
+    elif n_clusters == 'auto':
+        _, kmeans, _ = select_n_clusters(df_kpi_zone_time)
+        model = ZoneClusterModel(kmeans.n_clusters, kmeans.random_state)
+    else:
+        model = ZoneClusterModel(n_clusters)
+    if key is None or key not in model.fitted_keys:
+        model.partial_fit(df_kpi_zone_time, key)
+        model.save(model_path)
+    return model.predict(df_kpi_zone_time)
 
-def cluster_zones_with_kpi(df: pd.DataFrame, qa_flags: pd.DataFrame, n_clusters: int = 4) -> tuple:
+'''
+    With model_path, the month updates the persisted ZoneClusterModel and cluster IDs are comparable across months;
+    key (e.g. '2021-03') keeps a re-run month from being fitted twice.
+    n_clusters='auto' selects the number of clusters with select_n_clusters.
+'''
+@instrumented
+def cluster_zones_with_kpi(df: pd.DataFrame, qa_flags: pd.DataFrame, n_clusters=4, model_path=None, key: str = None) -> tuple:
     # Compute KPIs
     kpi_df = compute_kpi_zone_time(df, qa_flags)
     
     # Perform clustering
+    if model_path is not None:
+        return cluster_zone_time_incremental(kpi_df, model_path, n_clusters, key=key)
     return cluster_zone_time(kpi_df, n_clusters)
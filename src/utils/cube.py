@@ -0,0 +1,146 @@
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.utils.normalizing import zone_dim, payment_map, day_names, lookup_rows
+from src.utils.kpi import kpi_inputs, kpi_flags, masked_input, labels, hour_bins, local_nanoseconds
+
+'''
+    Materialized KPI cube: additive measures of the cleaned trips at the grain
+        pickup hour x PULocationID x DO_Borough x payment_type x time_bin
+    stored as one parquet partition per month (<root>/pickup_month=2021-03/part-0.parquet).
+    Measures are the trips and, for every KPI input of kpi_inputs, the sum and count of its values
+    masked by the same QA rules as aggregate_kpis, so any rollup of the cube gives the same
+    totals and averages as the KPIs computed from the trips. Quantiles are not additive and are not in the cube.
+    pickup_hour is the New York wall-clock hour (naive), like the day and hour of the KPI reports.
+'''
+cube_dimensions = ['pickup_hour', 'PULocationID', 'DO_Borough', 'payment_type', 'time_bin']
+cube_measures = ['trips'] + [f'{name}_{part}' for name in kpi_inputs for part in ['sum', 'count']]
+cube_partitioning = ds.partitioning(pa.schema([('pickup_month', pa.string())]), flavor='hive')
+
+# Dimensions derived from the stored ones when querying: name -> function of the cube frame
+derived_dimensions = {
+    'date': lambda cube: cube['pickup_hour'].dt.normalize(),
+    'hour': lambda cube: cube['pickup_hour'].dt.hour,
+    'month': lambda cube: cube['pickup_hour'].dt.month,
+    # Sunday closing the week, as the labels of the weekly KPIs
+    'week': lambda cube: cube['pickup_hour'].dt.normalize() + pd.to_timedelta(6 - cube['pickup_hour'].dt.dayofweek, unit='D'),
+    'day_of_week': lambda cube: pd.Categorical.from_codes(cube['pickup_hour'].dt.dayofweek, categories=day_names),
+    'is_weekend': lambda cube: cube['pickup_hour'].dt.dayofweek >= 5,
+    'PU_Borough': lambda cube: pd.Categorical.from_codes(zone_dim.take_codes(cube['PULocationID'])[:, 0], categories=zone_dim.borough_categories),
+    'PU_Zone': lambda cube: pd.Categorical.from_codes(zone_dim.take_codes(cube['PULocationID'])[:, 1], categories=zone_dim.zone_categories),
+    'payment_type_name': lambda cube: cube['payment_type'].map(payment_map),
+}
+
+# Ratios added to every query result: name -> (numerator, denominator)
+cube_ratios = {
+    'avg_fare': ('fare_sum', 'fare_count'),
+    'avg_total': ('total_sum', 'total_count'),
+    'avg_speed': ('speed_sum', 'speed_count'),
+    'avg_duration': ('duration_sum', 'duration_count'),
+    'avg_distance': ('distance_sum', 'distance_count'),
+    'revenue_per_trip': ('valid_fare_sum', 'valid_fare_count'),
+    'revenue_per_mile': ('valid_fare_sum', 'valid_fare_distance_sum'),
+}
+
+'''
+    Cube rows of one cleaned month (data and standard or packed flags). Trips without a pickup time are left out,
+    as in aggregate_kpis; unknown zones and payment types are kept as missing values.
+'''
+def build_cube(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> pd.DataFrame:
+    flags = kpi_flags(qa_flags)
+    pickup_ns = local_nanoseconds(df_month['tpep_pickup_datetime'])
+    rows = pickup_ns != np.iinfo(np.int64).min
+
+    # Dimension codes: hour from the first hour, LocationID row of the zone table, borough code + 1, payment code
+    hours = pickup_ns[rows] // (3600 * 10**9)
+    first_hour = hours.min() if len(hours) else 0
+    pickup_zone = lookup_rows(df_month['PULocationID'], zone_dim.size)[rows]
+    dropoff_borough = zone_dim.take_codes(df_month['DOLocationID'])[rows, 0] + 1
+    payment = df_month['payment_type'].to_numpy(dtype='float64', na_value=np.nan)[rows]
+    payment_values, payment_codes = np.unique(payment, return_inverse=True)
+
+    shape = (int(hours.max() - first_hour) + 1 if len(hours) else 0, zone_dim.size + 1,
+             len(zone_dim.borough_categories) + 1, len(payment_values))
+    key = np.ravel_multi_index((hours - first_hour, pickup_zone, dropoff_borough, payment_codes.ravel()), shape)
+    cells, cell_of = np.unique(key, return_inverse=True)
+    n_cells = len(cells)
+    hour, zone, borough, payment_code = np.unravel_index(cells, shape)
+
+    hour += first_hour
+    cube = pd.DataFrame({
+        'pickup_hour': pd.to_datetime(hour * 3600, unit='s'),
+        'PULocationID': pd.arrays.IntegerArray(zone.astype(np.int16), zone == zone_dim.size),
+        'DO_Borough': pd.Categorical.from_codes(borough - 1, categories=zone_dim.borough_categories),
+        'payment_type': pd.array(payment_values[payment_code], dtype='Float64').astype('Int8'),
+        'time_bin': pd.Categorical.from_codes(hour_bins[hour % 24], categories=labels),
+    })
+
+    cube['trips'] = np.bincount(cell_of, minlength=n_cells).astype(np.int32)
+    for name in kpi_inputs:
+        values = masked_input(df_month, flags, name)[rows]
+        valid = ~np.isnan(values)
+        cube[f'{name}_sum'] = np.bincount(cell_of, weights=np.where(valid, values, 0), minlength=n_cells)
+        cube[f'{name}_count'] = np.bincount(cell_of, weights=valid, minlength=n_cells).astype(np.int32)
+    return cube
+
+'''
+    Writes the cube rows of one month into the cube store, replacing the month if it was already there.
+'''
+def append_month_cube(cube: pd.DataFrame, root, year: int, month: int) -> Path:
+    month_folder = Path(root) / f"pickup_month={year}-{month:02d}"
+    if month_folder.exists():
+        shutil.rmtree(month_folder)
+    month_folder.mkdir(parents=True)
+    pq.write_table(pa.Table.from_pandas(cube, preserve_index=False), month_folder / 'part-0.parquet')
+    return month_folder
+
+'''
+    Reads cube rows, only the months overlapping start / end ('YYYY-MM-DD', inclusive) are opened.
+'''
+def load_cube(root, start: str = None, end: str = None) -> pd.DataFrame:
+    dataset = ds.dataset(root, format='parquet', partitioning=cube_partitioning)
+    predicate = None
+    conditions = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        conditions += [ds.field('pickup_month') >= start.strftime('%Y-%m'), ds.field('pickup_hour') >= start]
+    if end is not None:
+        end = pd.Timestamp(end)
+        conditions += [ds.field('pickup_month') <= end.strftime('%Y-%m'), ds.field('pickup_hour') < end + pd.Timedelta(days=1)]
+    for condition in conditions:
+        predicate = condition if predicate is None else predicate & condition
+    return dataset.to_table(columns=cube_dimensions + cube_measures, filter=predicate).to_pandas()
+
+'''
+    Rolls the cube up along any dimensions: the stored ones (cube_dimensions) or the derived ones
+    (derived_dimensions: date, hour, week, month, day_of_week, is_weekend, PU_Borough, PU_Zone, payment_type_name).
+    where filters any dimension with a value or a list of values. Returns the measures and the ratios of cube_ratios, e.g.
+        query_cube(root, by=['PU_Borough'], where={'time_bin': 'Evening Rush', 'is_weekend': True})
+    gives the revenue per mile by pickup borough in the Evening Rush of weekends.
+'''
+def query_cube(root, by: list = (), start: str = None, end: str = None, where: dict = None) -> pd.DataFrame:
+    cube = load_cube(root, start, end)
+    by = list(by)
+
+    for name in set(by) | set(where or {}):
+        if name not in cube.columns:
+            if name not in derived_dimensions:
+                raise ValueError(f"Unknown cube dimension: {name}")
+            cube[name] = derived_dimensions[name](cube)
+    for name, value in (where or {}).items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        cube = cube[cube[name].isin(values)]
+
+    if by:
+        result = cube.groupby(by, observed=True, dropna=False)[cube_measures].sum().reset_index()
+    else:
+        result = pd.DataFrame({name: [cube[name].sum()] for name in cube_measures})
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for name, (numerator, denominator) in cube_ratios.items():
+            result[name] = result[numerator].to_numpy(dtype='float64') / result[denominator].to_numpy(dtype='float64')
+    return result
@@ -0,0 +1,97 @@
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from src.utils.normalizing import zones_lookup
+from src.utils.qa_rules import packed_column, pack_flags, is_packed
+
+'''
+    Cleaned data as a hive-partitioned parquet dataset:
+        <root>/pickup_month=2021-01/pickup_date=2021-01-05/part-0.parquet
+    Rows of a day are sorted by pickup time and PULocationID and carry their packed QA flags (qa_bits),
+    so the flags stay aligned with the data whatever is filtered. Only a date range prunes: it opens the
+    matching day folders only. A day (about 80k trips in 2021) is mostly a single row group spanning almost
+    every PULocationID, so a zone filter is applied row by row to the rows of the days read.
+'''
+partition_columns = ['pickup_month', 'pickup_date']
+partitioning = ds.partitioning(pa.schema([(name, pa.string()) for name in partition_columns]), flavor='hive')
+sort_columns = ['tpep_pickup_datetime', 'PULocationID']
+
+'''
+    Writes one cleaned month (data and its standard flags from clean(), boolean or packed) into the dataset,
+    replacing the month's partitions if they exist. Days are taken from the New York pickup time.
+'''
+def write_month_dataset(cleaned: pd.DataFrame, qa_flags: pd.DataFrame, root, year: int, month: int,
+                        row_group_size: int = 100_000) -> Path:
+    if not is_packed(qa_flags):
+        qa_flags = pack_flags(qa_flags)
+    df = cleaned.assign(**{packed_column: qa_flags[packed_column].to_numpy()})
+    df = df.sort_values(sort_columns, kind='stable', ignore_index=True)
+
+    month_folder = Path(root) / f"pickup_month={year}-{month:02d}"
+    if month_folder.exists():
+        shutil.rmtree(month_folder)
+
+    # Sorted by pickup time, so every day is one contiguous slice
+    days = df['tpep_pickup_datetime'].dt.tz_localize(None).to_numpy().astype('datetime64[D]')
+    bounds = np.flatnonzero(days[1:] != days[:-1]) + 1
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(df)]):
+        day_folder = month_folder / f"pickup_date={days[start]}"
+        day_folder.mkdir(parents=True, exist_ok=True)
+        pq.write_table(table.slice(start, end - start), day_folder / 'part-0.parquet', row_group_size=row_group_size)
+    return month_folder
+
+'''
+    LocationIDs of the given zones: LocationIDs, zone names or borough names (e.g. 'Midtown Center', 'Manhattan').
+'''
+def zone_ids(zones: list) -> list:
+    ids = []
+    for zone in zones:
+        if isinstance(zone, (int, np.integer)):
+            ids.append(int(zone))
+        else:
+            match = zones_lookup[(zones_lookup['Zone'] == zone) | (zones_lookup['Borough'] == zone)]
+            if match.empty:
+                raise ValueError(f"Unknown zone: {zone}")
+            ids.extend(match['LocationID'].astype(int).tolist())
+    return ids
+
+'''
+    Reads cleaned trips from the dataset with the filters given to the pyarrow scan:
+    - start / end: first and last pickup date (inclusive, 'YYYY-MM-DD'), only those day folders are read
+    - zones: pickup zones (see zone_ids), dropoff_zones: dropoff zones, filtered row by row in the days read
+    - columns: columns to read (all data columns by default)
+    With with_flags=True returns (data, flags), flags being the packed standard frame aligned with data,
+    as expected by aggregate_kpis, cluster_zones_with_kpi and the visualize functions.
+'''
+def load_cleaned(root, start: str = None, end: str = None, zones: list = None, dropoff_zones: list = None,
+                 columns: list = None, with_flags: bool = False):
+    dataset = ds.dataset(root, format='parquet', partitioning=partitioning)
+
+    predicate = None
+    conditions = []
+    if start is not None:
+        conditions.append(ds.field('pickup_date') >= str(start))
+    if end is not None:
+        conditions.append(ds.field('pickup_date') <= str(end))
+    if zones is not None:
+        conditions.append(ds.field('PULocationID').isin(zone_ids(zones)))
+    if dropoff_zones is not None:
+        conditions.append(ds.field('DOLocationID').isin(zone_ids(dropoff_zones)))
+    for condition in conditions:
+        predicate = condition if predicate is None else predicate & condition
+
+    data_columns = [name for name in dataset.schema.names if name not in partition_columns and name != packed_column]
+    columns = data_columns if columns is None else list(columns)
+    read_columns = columns + [packed_column] if with_flags and packed_column not in columns else columns
+
+    df = dataset.to_table(columns=read_columns, filter=predicate).to_pandas()
+    if not with_flags:
+        return df
+    flags = df[[packed_column]]
+    return df[columns], flags
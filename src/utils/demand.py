@@ -0,0 +1,146 @@
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from src.utils.normalizing import zone_dim, lookup_rows
+
+'''
+    Year-long demand store: trips per pickup zone and hour of one year as an int32 array (rows x hours),
+    saved as .npy next to its daily rollup (rows x local days) and always opened memory-mapped.
+    Row z is PULocationID z, row unknown_row counts the trips with an unknown or missing zone and total_row all trips.
+    Hours are the absolute hours from local midnight of January 1st (8760 or 8784, the DST hours included once each),
+    days the local calendar days. Months are written one at a time (update_month), the months already in the store
+    and the key of the data they came from are kept in demand_<year>.json.
+
+    Usage:
+        store = DemandStore('processed/demand', 2021)
+        store.series(236)             # hourly trips of zone 236 over the months in the store, a view of the file
+        store.series(freq='D')        # daily trips of the city
+'''
+unknown_row = zone_dim.size
+total_row = zone_dim.size + 1
+n_demand_rows = zone_dim.size + 2
+demand_columns = ['tpep_pickup_datetime', 'PULocationID']
+hour_ns = 3600 * 10**9
+
+class DemandStore:
+    def __init__(self, root, year: int, tz: str = 'America/New_York'):
+        self.root = Path(root)
+        self.year = year
+        self.tz = tz
+        self.start = pd.Timestamp(year, 1, 1).tz_localize(tz)
+        self.hour_index = pd.date_range(self.start, pd.Timestamp(year + 1, 1, 1).tz_localize(tz),
+                                        freq='h', inclusive='left', name='hour')
+        self.day_index = pd.date_range(pd.Timestamp(year, 1, 1), pd.Timestamp(year + 1, 1, 1),
+                                       freq='D', inclusive='left', name='day').tz_localize(tz)
+        # First hour of every local day, the bounds of the daily rollup
+        self.day_starts = self.hour_index.get_indexer(self.day_index)
+        self.hourly_path = self.root / f"demand_hourly_{year}.npy"
+        self.daily_path = self.root / f"demand_daily_{year}.npy"
+        self.months_path = self.root / f"demand_{year}.json"
+        self.months = {}
+        if self.months_path.exists():
+            with open(self.months_path) as f:
+                self.months = {int(month): key for month, key in json.load(f).items()}
+        self.hourly, self.daily = self.open('r')
+
+    '''
+        Memory-mapped hourly and daily arrays (None before the first month is written).
+    '''
+    def open(self, mode: str) -> tuple:
+        if not self.hourly_path.exists():
+            if mode == 'r':
+                return None, None
+            self.root.mkdir(parents=True, exist_ok=True)
+            np.lib.format.open_memmap(self.hourly_path, mode='w+', dtype=np.int32, shape=(n_demand_rows, len(self.hour_index))).flush()
+            np.lib.format.open_memmap(self.daily_path, mode='w+', dtype=np.int32, shape=(n_demand_rows, len(self.day_index))).flush()
+        return np.load(self.hourly_path, mmap_mode=mode), np.load(self.daily_path, mmap_mode=mode)
+
+    '''
+        Hour positions [first, last) of a calendar month.
+    '''
+    def month_hours(self, month: int) -> tuple:
+        first = pd.Timestamp(self.year, month, 1).tz_localize(self.tz)
+        last = first.tz_localize(None) + pd.offsets.MonthBegin(1)
+        return (int((first - self.start) / pd.Timedelta(hours=1)),
+                int((last.tz_localize(self.tz) - self.start) / pd.Timedelta(hours=1)))
+
+    '''
+        Writes the trips of one month (cleaned data, only demand_columns are needed) into the store, replacing the month.
+        Only pickups inside the month are counted, so trips of other months in the file do not leak into them.
+    '''
+    def update_month(self, df_month: pd.DataFrame, month: int, key: str = None) -> None:
+        first, last = self.month_hours(month)
+        n_hours = last - first
+        hours = pd.DatetimeIndex(df_month['tpep_pickup_datetime']).asi8 // hour_ns - self.start.value // hour_ns - first
+        zone = lookup_rows(df_month['PULocationID'], zone_dim.size)
+        rows = (hours >= 0) & (hours < n_hours) & df_month['tpep_pickup_datetime'].notna().to_numpy()
+
+        counts = np.bincount(zone[rows] * n_hours + hours[rows], minlength=(zone_dim.size + 1) * n_hours)
+        counts = counts.reshape(zone_dim.size + 1, n_hours)
+        hourly, daily = self.open('r+')
+        hourly[:total_row, first:last] = counts
+        hourly[total_row, first:last] = counts.sum(axis=0)
+
+        # Daily rollup of the days of the month
+        days = np.flatnonzero((self.day_starts >= first) & (self.day_starts < last))
+        daily[:, days] = np.add.reduceat(hourly[:, first:last], self.day_starts[days] - first, axis=1)
+        hourly.flush()
+        daily.flush()
+
+        self.months[month] = key
+        with open(self.months_path, 'w') as f:
+            json.dump({str(m): self.months[m] for m in sorted(self.months)}, f)
+        self.hourly, self.daily = self.open('r')
+
+    '''
+        Positions [first, last) of the hours (or days) between start and end ('YYYY-MM-DD', inclusive),
+        by default from the first to the last month in the store.
+    '''
+    def span(self, freq: str = 'H', start: str = None, end: str = None) -> slice:
+        if not self.months:
+            raise ValueError(f"No month in the demand store of {self.year}")
+        index = self.hour_index if freq == 'H' else self.day_index
+        first_month, last_month = min(self.months), max(self.months)
+        start = pd.Timestamp(start or f"{self.year}-{first_month:02d}-01").tz_localize(self.tz)
+        end = (pd.Timestamp(end) + pd.Timedelta(days=1) if end is not None
+               else pd.Timestamp(f"{self.year}-{last_month:02d}-01") + pd.offsets.MonthBegin(1)).tz_localize(self.tz)
+        return slice(index.searchsorted(start), index.searchsorted(end))
+
+    '''
+        Trips per hour ('H') or day ('D') of one zone (PULocationID, None for the whole city) as a Series
+        over a view of the memory-mapped file: nothing is copied or read before the values are used.
+    '''
+    def series(self, zone: int = None, freq: str = 'H', start: str = None, end: str = None) -> pd.Series:
+        if freq not in ('H', 'D'):
+            raise ValueError("Unsupported freq")
+        row = total_row if zone is None else int(zone)
+        if not 0 <= row < n_demand_rows:
+            raise ValueError(f"Unknown zone: {zone}")
+        positions = self.span(freq, start, end)
+        values = (self.hourly if freq == 'H' else self.daily)[row, positions]
+        index = (self.hour_index if freq == 'H' else self.day_index)[positions]
+        return pd.Series(values, index=index, name='trips', copy=False)
+
+    '''
+        Periods x zones frame of several zones like forecasting.zone_series (the zones with trips by default).
+    '''
+    def frame(self, freq: str = 'H', zones: list = None, start: str = None, end: str = None) -> pd.DataFrame:
+        positions = self.span(freq, start, end)
+        values = (self.hourly if freq == 'H' else self.daily)[:, positions]
+        if zones is None:
+            zones = np.flatnonzero(values[:zone_dim.size].sum(axis=1))
+        zones = np.asarray(zones, dtype=np.intp)
+        index = (self.hour_index if freq == 'H' else self.day_index)[positions]
+        return pd.DataFrame(np.asarray(values[zones]).T, index=index, columns=pd.Index(zones, name='PULocationID'))
+
+    '''
+        Trips per local hour of day (0-23) of one zone (None for the whole city) over one month or the whole store.
+    '''
+    def hour_of_day(self, zone: int = None, month: int = None) -> pd.Series:
+        first, last = self.month_hours(month) if month is not None else (0, len(self.hour_index))
+        row = total_row if zone is None else int(zone)
+        hours = self.hour_index[first:last].hour
+        return pd.Series(np.bincount(hours, weights=self.hourly[row, first:last], minlength=24).astype(np.int64),
+                         index=pd.RangeIndex(24, name='hour'))
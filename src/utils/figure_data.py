@@ -0,0 +1,196 @@
+import json
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from src.utils.normalizing import day_names
+from src.utils.qa_rules import violated
+from src.utils.kpi import local_nanoseconds
+
+'''
+    Figure data: the small frames the visualize_* functions plot, computed from a month of trips in one pass
+    (every mask and every group code once), so that rendering never touches the trips.
+    All frames are additive (counts, sums, histogram counts, moments), so the figure data of several months
+    (or of the chunks of a month) are merged by addition, e.g. the months of a year for the yearly charts;
+    averages, correlations, top zones and KDE curves are derived when plotting.
+
+    Frames (figure_parts lists which visualize_* function uses which):
+        daily              Total_fare and Total_trips of the daily KPIs (only with kpi_daily)
+        hour_day_of_week   trips per day of week (rows) and local hour (columns)
+        hourly             per local hour: speed sum / count, trips and revenue of the trips kept by the QA rules
+        payment            trips per payment type name
+        group_rides        trips with more than 2 passengers per day of month
+        tip_moments        pairwise moments of tip, distance and duration (for the correlation matrix)
+        distance_hist      log1p(trip_distance) histogram on fixed bins
+        duration_hist      log1p(trip_duration_minutes) histogram on fixed bins
+        zones              pickup and dropoff trips per zone name
+'''
+figure_parts = {
+    'summary': ['daily', 'hour_day_of_week'],
+    'customer_segments': ['payment', 'group_rides', 'tip_moments'],
+    'temporal_trends': ['hourly'],
+    'trip_characteristics': ['distance_hist', 'duration_hist'],
+    'geographical_analysis': ['zones'],
+}
+
+# QA rules excluding the rows of each frame, as in the original plots
+hourly_rules = ['suspicious_zero_fare', 'short_duration_long_distance', 'excessive_speed', 'excessive_duration']
+characteristics_rules = ['invalid_tip_amount', 'suspicious_zero_fare', 'short_duration_long_distance', 'excessive_speed', 'excessive_duration']
+correlation_columns = ['tip_amount', 'trip_distance', 'trip_duration_minutes']
+
+# Fixed log1p bins, the same for every month so that histograms add up (values outside go to the end bins)
+histogram_bins = {
+    'distance_hist': ('trip_distance', np.linspace(0, 6, 121)),
+    'duration_hist': ('trip_duration_minutes', np.linspace(0, 7.5, 151)),
+}
+day_ns = 24 * 3600 * 10**9
+
+class FigureData:
+    def __init__(self, frames: dict, label: str, months: list = ()):
+        self.frames = frames
+        self.label = label
+        self.months = sorted(months)
+
+    def __getitem__(self, name: str) -> pd.DataFrame:
+        return self.frames[name]
+
+    '''
+        Figure data of one month (data and standard or packed flags); parts limits the frames to the given
+        visualize_* names of figure_parts (all by default). The label is the month name used in the titles,
+        months the month of the first pickup.
+    '''
+    @classmethod
+    def from_trips(cls, df_month: pd.DataFrame, qa_flags: pd.DataFrame, kpi_daily: pd.DataFrame = None,
+                   parts: list = None) -> 'FigureData':
+        names = {name for part in (parts or figure_parts) for name in figure_parts[part]}
+        pickup = df_month['tpep_pickup_datetime']
+        first_pickup = pickup.dropna().iloc[0] if pickup.notna().any() else None
+        label = first_pickup.strftime('%B') if first_pickup is not None else ''
+        months = [first_pickup.month] if first_pickup is not None else []
+
+        # Local hour, day of week and day of month of every pickup, -1 where the pickup is missing
+        local_ns = local_nanoseconds(pickup)
+        has_pickup = local_ns != np.iinfo(np.int64).min
+        hour = np.where(has_pickup, (local_ns // (3600 * 10**9)) % 24, -1)
+        day_of_week = np.where(has_pickup, (local_ns // day_ns + 3) % 7, -1)  # 1970-01-01 was a Thursday
+        local_days = local_ns.astype('datetime64[ns]').astype('datetime64[D]')
+        day = np.where(has_pickup, (local_days - local_days.astype('datetime64[M]')).astype(np.int64) + 1, -1)
+
+        frames = {}
+        if 'daily' in names and kpi_daily is not None:
+            frames['daily'] = kpi_daily[['Total_fare', 'Total_trips']].copy()
+        if 'hour_day_of_week' in names:
+            counts = np.bincount((day_of_week * 24 + hour)[has_pickup], minlength=7 * 24).reshape(7, 24)
+            frames['hour_day_of_week'] = pd.DataFrame(counts, index=pd.Index(day_names, name='pickup_day_of_week'),
+                                                      columns=pd.RangeIndex(24, name='pickup_hour'))
+        if 'hourly' in names:
+            speed_rows = has_pickup & ~violated(qa_flags, ['excessive_speed']).to_numpy()
+            rows = has_pickup & ~violated(qa_flags, hourly_rules).to_numpy()
+            speed = df_month['avg_speed_mph'].to_numpy(dtype='float64', na_value=np.nan)
+            revenue = df_month['total_amount'].to_numpy(dtype='float64', na_value=np.nan)
+            speed_rows &= ~np.isnan(speed)
+            frames['hourly'] = pd.DataFrame({
+                'speed_sum': np.bincount(hour[speed_rows], weights=speed[speed_rows], minlength=24),
+                'speed_count': np.bincount(hour[speed_rows], minlength=24),
+                'trips': np.bincount(hour[rows], minlength=24),
+                'revenue': np.bincount(hour[rows], weights=np.nan_to_num(revenue[rows]), minlength=24),
+            }, index=pd.RangeIndex(24, name='hour'))
+        if 'payment' in names:
+            payment = df_month['payment_type_name'][~violated(qa_flags, ['invalid_payment_type'])].value_counts()
+            frames['payment'] = payment.rename('trips').to_frame()
+        if 'group_rides' in names:
+            rows = (has_pickup & ~violated(qa_flags, ['unusual_passenger_count']).to_numpy()
+                    & (df_month['passenger_count'].to_numpy(dtype='float64', na_value=np.nan) > 2))
+            frames['group_rides'] = pd.DataFrame({'trips': np.bincount(day[rows], minlength=32)[1:]},
+                                                 index=pd.RangeIndex(1, 32, name='day'))
+        if names & {'tip_moments', *histogram_bins}:
+            kept = ~violated(qa_flags, characteristics_rules).to_numpy()
+        if 'tip_moments' in names:
+            frames['tip_moments'] = moments_frame(df_month.loc[kept, correlation_columns])
+        for name, (column, edges) in histogram_bins.items():
+            if name in names:
+                values = np.log1p(df_month[column].to_numpy(dtype='float64', na_value=np.nan)[kept])
+                values = values[~np.isnan(values)]
+                bins = np.clip(np.searchsorted(edges, values, side='right') - 1, 0, len(edges) - 2)
+                frames[name] = histogram_frame(edges, np.bincount(bins, minlength=len(edges) - 1))
+        if 'zones' in names:
+            frames['zones'] = pd.DataFrame({'pickup': df_month['PU_Zone'].value_counts(),
+                                            'dropoff': df_month['DO_Zone'].value_counts()}).fillna(0).astype(np.int64)
+        return cls(frames, label, months)
+
+    '''
+        Adds the frames of another figure data (e.g. the next month); the label becomes the given one.
+    '''
+    def merge(self, other: 'FigureData', label: str = None) -> 'FigureData':
+        frames = {}
+        for name in self.frames.keys() & other.frames.keys():
+            if name == 'daily':
+                frames[name] = pd.concat([self.frames[name], other.frames[name]], ignore_index=True)
+            elif name in histogram_bins:
+                frames[name] = histogram_frame(histogram_bins[name][1], self.frames[name]['count'].to_numpy() + other.frames[name]['count'].to_numpy())
+            else:
+                frames[name] = self.frames[name].add(other.frames[name], fill_value=0)
+        return FigureData(frames, label or self.label, set(self.months) | set(other.months))
+
+    '''
+        One parquet file per frame and the label and months in meta.json, in the given folder.
+    '''
+    def save(self, folder) -> Path:
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        for name, frame in self.frames.items():
+            frame.to_parquet(folder / f"{name}.parquet")
+        with open(folder / 'meta.json', 'w') as f:
+            json.dump({'label': self.label, 'months': self.months, 'frames': sorted(self.frames)}, f)
+        return folder
+
+    @classmethod
+    def load(cls, folder) -> 'FigureData':
+        folder = Path(folder)
+        with open(folder / 'meta.json') as f:
+            meta = json.load(f)
+        return cls({name: pd.read_parquet(folder / f"{name}.parquet") for name in meta['frames']}, meta['label'], meta['months'])
+
+'''
+    Sums of every pair of columns over the rows where both are present: n, sum_x, sum_y, sum_xx, sum_yy, sum_xy.
+'''
+def moments_frame(df: pd.DataFrame) -> pd.DataFrame:
+    values = df.to_numpy(dtype='float64', na_value=np.nan)
+    present = ~np.isnan(values)
+    values = np.nan_to_num(values)
+    rows = []
+    for i, x in enumerate(df.columns):
+        for j, y in enumerate(df.columns):
+            both = present[:, i] & present[:, j]
+            a, b = values[both, i], values[both, j]
+            rows.append({'x': x, 'y': y, 'n': both.sum(), 'sum_x': a.sum(), 'sum_y': b.sum(),
+                         'sum_xx': a @ a, 'sum_yy': b @ b, 'sum_xy': a @ b})
+    return pd.DataFrame(rows).set_index(['x', 'y'])
+
+'''
+    Pearson correlation matrix from the moments of moments_frame (pairwise complete rows, like DataFrame.corr).
+'''
+def correlation_matrix(moments: pd.DataFrame) -> pd.DataFrame:
+    m = moments
+    with np.errstate(invalid='ignore', divide='ignore'):
+        corr = ((m['n'] * m['sum_xy'] - m['sum_x'] * m['sum_y'])
+                / np.sqrt((m['n'] * m['sum_xx'] - m['sum_x'] ** 2) * (m['n'] * m['sum_yy'] - m['sum_y'] ** 2)))
+    columns = list(dict.fromkeys(m.index.get_level_values('x')))
+    return corr.unstack('y').reindex(index=columns, columns=columns).rename_axis(index=None, columns=None)
+
+'''
+    Histogram counts on the given edges with the Gaussian KDE of the binned values (Scott's bandwidth),
+    scaled to counts per bin like the kde curve of sns.histplot.
+'''
+def histogram_frame(edges: np.ndarray, counts: np.ndarray) -> pd.DataFrame:
+    centers = (edges[:-1] + edges[1:]) / 2
+    width = edges[1] - edges[0]
+    n = counts.sum()
+    kde = np.zeros(len(centers))
+    if n > 1:
+        mean = counts @ centers / n
+        std = np.sqrt(counts @ (centers - mean) ** 2 / (n - 1))
+        bandwidth = max(std * n ** (-1 / 5), width)
+        kernel = np.exp(-0.5 * ((centers[:, None] - centers[None, :]) / bandwidth) ** 2) / (bandwidth * np.sqrt(2 * np.pi))
+        kde = kernel @ counts * width
+    return pd.DataFrame({'left': edges[:-1], 'right': edges[1:], 'count': counts.astype(np.int64), 'kde': kde})
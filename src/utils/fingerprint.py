@@ -0,0 +1,96 @@
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+# Raw fields that identify a trip. Everything else in the normalized frame is derived from them,
+# except mta_tax and improvement_surcharge which normalize() only keeps inside computed_total_amount.
+fingerprint_fields = ['tpep_pickup_datetime', 'tpep_dropoff_datetime', 'passenger_count', 'trip_distance',
+                      'RatecodeID', 'PULocationID', 'DOLocationID', 'payment_type', 'fare_amount', 'extra',
+                      'tip_amount', 'tolls_amount', 'total_amount', 'congestion_surcharge']
+datetime_fields = ['tpep_pickup_datetime', 'tpep_dropoff_datetime']
+# Columns summed into computed_total_amount by normalize()
+total_components = ['fare_amount', 'tolls_amount', 'tip_amount', 'extra', 'congestion_surcharge', 'mta_tax', 'improvement_surcharge']
+# Columns to read from a raw file to fingerprint it
+raw_fingerprint_columns = fingerprint_fields + ['mta_tax', 'improvement_surcharge']
+
+'''
+    64-bit fingerprint of every trip of a raw frame, from its raw fields: datetimes as wall time, amounts and
+    distance as whole cents (float32 and float64 agree), so two rows get the same fingerprint when their raw
+    fields are equal. A normalized frame gives the same values except for the wall times that do not exist or
+    are ambiguous in New York (DST changes), which normalize() turns into NaT; every fingerprint of the
+    pipeline (raw_file_fingerprints, stream_normalize_clean) is therefore taken from the raw frame.
+'''
+def trip_fingerprints(df: pd.DataFrame) -> np.ndarray:
+    keys = {}
+    for col in fingerprint_fields:
+        column = df[col]
+        if col in datetime_fields:
+            if isinstance(column.dtype, pd.DatetimeTZDtype):
+                column = column.dt.tz_localize(None)
+            keys[col] = pd.to_datetime(column).astype('datetime64[ns]').to_numpy().view('int64')
+        else:
+            keys[col] = np.round(column.to_numpy(dtype='float64', na_value=np.nan) * 100)
+
+    if 'computed_total_amount' in df.columns:
+        computed_total = df['computed_total_amount'].to_numpy(dtype='float64')
+    else:
+        computed_total = df[total_components].fillna(0).sum(axis=1).to_numpy(dtype='float64')
+    keys['computed_total_amount'] = np.round(computed_total * 100)
+
+    return pd.util.hash_pandas_object(pd.DataFrame(keys, copy=False), index=False).to_numpy()
+
+'''
+    Fingerprints of a raw parquet file, read batch by batch and only the fields in raw_fingerprint_columns.
+    Returns the sorted unique fingerprints of the file.
+'''
+def raw_file_fingerprints(raw_path, batch_size: int = 1_000_000) -> np.ndarray:
+    parts = [trip_fingerprints(batch.to_pandas())
+             for batch in pq.ParquetFile(raw_path).iter_batches(batch_size=batch_size, columns=raw_fingerprint_columns)]
+    return np.unique(np.concatenate(parts)) if parts else np.empty(0, dtype=np.uint64)
+
+'''
+    Persistent index of trip fingerprints, one sorted uint64 .npy file per processed month (8 bytes per trip,
+    about 250 MB for a year of yellow taxi trips).
+    Files are memory-mapped when searched, so checking a month against the earlier ones does not load them.
+'''
+class FingerprintIndex:
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+
+    def path(self, year: int, month: int) -> Path:
+        return self.folder / f"fingerprints_{year}-{month:02d}.npy"
+
+    def months(self) -> list:
+        found = []
+        for p in sorted(self.folder.glob('fingerprints_*.npy')):
+            year, month = p.stem.split('_')[1].split('-')
+            found.append((int(year), int(month)))
+        return found
+
+    def save(self, year: int, month: int, fingerprints: np.ndarray) -> None:
+        path = self.path(year, month)
+        tmp = path.with_name('.' + path.name)
+        np.save(tmp, np.unique(fingerprints))
+        os.replace(tmp, path)
+
+    def load(self, year: int, month: int) -> np.ndarray:
+        return np.load(self.path(year, month), mmap_mode='r')
+
+    '''
+        Marks the fingerprints that were already seen in a month before (year, month).
+        Later months are not checked, so a re-sent trip is flagged in the later file and kept in the first one.
+    '''
+    def seen_before(self, fingerprints: np.ndarray, year: int, month: int) -> np.ndarray:
+        seen = np.zeros(len(fingerprints), dtype=bool)
+        for key in self.months():
+            if key >= (year, month):
+                continue
+            known = self.load(*key)
+            if len(known) == 0:
+                continue
+            pos = np.searchsorted(known, fingerprints).clip(max=len(known) - 1)
+            seen |= known[pos] == fingerprints
+        return seen
@@ -1,12 +1,21 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
 from statsmodels.tsa.arima.model import ARIMA
+from statsmodels.tools.sm_exceptions import ConvergenceWarning
 from sklearn.metrics import mean_absolute_error, mean_absolute_percentage_error, mean_squared_error
 from sklearn.linear_model import LinearRegression
 import warnings
 warnings.filterwarnings('ignore')
 
+from src.utils.normalizing import zone_dim, lookup_rows
+from src.utils.kpi import local_nanoseconds
+from src.utils.demand import DemandStore
+from src.utils.instrumentation import instrumented
 
+
+@instrumented
 def aggregate_trips(df1, freq='H'):
     if freq == 'H':
         time_col = 'hour'
@@ -28,78 +37,299 @@ def aggregate_trips(df1, freq='H'):
     return df_agg
 
 
-def forecast_and_evaluate(df1, freq, test_periods, arima_order=(1, 0, 1)):
-    # Aggregate trips
-    df = aggregate_trips(df1, freq)
-    value_col = 'trips'
-    
-    # Split train/test
-    train = df.iloc[:-test_periods]
-    test = df.iloc[-test_periods:]
-    
+'''
+    Trips per pickup zone and hour (or day) for all zones at once: one np.bincount over zone x period codes.
+    Returns a (periods x zones) frame with one column per PULocationID that has at least one trip
+    (or the given zones), indexed by every hour (or local day) from the first to the last pickup, empty ones included.
+    Hours are counted in UTC, so the repeated hour of the DST change stays two hours, as in aggregate_trips.
+'''
+@instrumented
+def zone_series(df1: pd.DataFrame, freq: str = 'H', zones: list = None) -> pd.DataFrame:
+    pickup = df1['tpep_pickup_datetime']
+    tz = pickup.dt.tz
+    if freq == 'H':
+        period_ns = 3600 * 10**9
+        periods = pd.DatetimeIndex(pickup).asi8 // period_ns
+    elif freq == 'D':
+        period_ns = 24 * 3600 * 10**9
+        periods = local_nanoseconds(pickup) // period_ns
+    else:
+        raise ValueError("Unsupported freq")
+
+    zone = lookup_rows(df1['PULocationID'], zone_dim.size)
+    rows = (pickup.notna().to_numpy()) & (zone < zone_dim.size)
+    periods, zone = periods[rows], zone[rows]
+    first = periods.min() if len(periods) else 0
+    n_periods = int(periods.max() - first) + 1 if len(periods) else 0
+
+    counts = np.bincount(zone * n_periods + (periods - first), minlength=zone_dim.size * n_periods)
+    counts = counts.reshape(zone_dim.size, n_periods)
+    if zones is None:
+        zones = np.flatnonzero(counts.sum(axis=1))
+    zones = np.asarray(zones, dtype=np.intp)
+
+    if freq == 'H':
+        index = pd.to_datetime((first + np.arange(n_periods)) * period_ns, utc=True)
+        index = index.tz_convert(tz) if tz is not None else index.tz_localize(None)
+    else:
+        index = pd.to_datetime((first + np.arange(n_periods)) * period_ns)
+        index = index.tz_localize(tz) if tz is not None else index
+    return pd.DataFrame(counts[zones].T, index=pd.DatetimeIndex(index, name='hour' if freq == 'H' else 'day'),
+                        columns=pd.Index(zones, name='PULocationID'))
+
+
+# Seasonal period of the baseline (same hour of the previous week, same day of the previous week)
+season_lengths = {'H': 168, 'D': 7}
+season_offsets = {'H': pd.Timedelta(hours=168), 'D': pd.Timedelta(days=7)}
+period_freqs = {'H': 'h', 'D': 'D'}
+
+
+'''
+    The forecasting models: name -> function (train series, test index, freq, arima_order) -> predictions on the test index.
+'''
+@instrumented
+def baseline_forecast(train, test_index, freq, arima_order):
     # Baseline: same day of week, same hour (for hourly), previous week
-    baseline_preds = []
-    for idx in test.index:
-        if freq == 'D':
-            # Same weekday, previous week
-            lag_days = 7
-            baseline_idx = idx - pd.Timedelta(days=lag_days)
-        elif freq == 'H':
-            # Same weekday, same hour, previous week
-            lag_hours = 168  # 7*24
-            baseline_idx = idx - pd.Timedelta(hours=lag_hours)
-        else:
-            raise ValueError("Unsupported freq")
-        
-        if baseline_idx in train.index:
-            baseline_preds.append(train.loc[baseline_idx, value_col])
-        else:
-            # If not available, use train mean
-            baseline_preds.append(train[value_col].mean())
-    
-    baseline_preds = pd.Series(baseline_preds, index=test.index)
-    
-    # ARIMA model
-    model = ARIMA(train[value_col], order=arima_order)
+    if freq not in season_lengths:
+        raise ValueError("Unsupported freq")
+    # Position of the previous week in train (-1 if not available, then the train mean is used)
+    positions = train.index.get_indexer(test_index - season_offsets[freq])
+    baseline_preds = train.to_numpy()[positions]
+    if (positions < 0).any():
+        baseline_preds = np.where(positions >= 0, baseline_preds, train.mean())
+    return pd.Series(baseline_preds, index=test_index)
+
+
+@instrumented
+def arima_forecast(train, test_index, freq, arima_order):
+    model = ARIMA(train, order=arima_order)
     model_fit = model.fit()
-    arima_preds = model_fit.forecast(steps=test_periods)
-    arima_preds.index = test.index
-    
+    arima_preds = model_fit.forecast(steps=len(test_index))
+    arima_preds.index = test_index
+    return arima_preds
+
+
+@instrumented
+def linear_forecast(train, test_index, freq, arima_order):
     # Linear Regression (simple: time as feature)
     # Create time feature: days since start
     train_time = (train.index - train.index[0]).total_seconds() / (24*3600)
-    test_time = (test.index - train.index[0]).total_seconds() / (24*3600)
+    test_time = (test_index - train.index[0]).total_seconds() / (24*3600)
     
     lr = LinearRegression()
-    lr.fit(train_time.values.reshape(-1, 1), train[value_col])
+    lr.fit(train_time.values.reshape(-1, 1), train)
     lr_preds = lr.predict(test_time.values.reshape(-1, 1))
-    lr_preds = pd.Series(lr_preds, index=test.index)
-    
-    # Calculate metrics
-    def calc_metrics(actual, pred):
-        mae = mean_absolute_error(actual, pred)
-        mape = mean_absolute_percentage_error(actual, pred)
-        rmse = np.sqrt(mean_squared_error(actual, pred))
-        return {'MAE': mae, 'MAPE': mape, 'RMSE': rmse}
-    
-    baseline_metrics = calc_metrics(test[value_col], baseline_preds)
-    arima_metrics = calc_metrics(test[value_col], arima_preds)
-    lr_metrics = calc_metrics(test[value_col], lr_preds)
-    
-    metrics_df = pd.DataFrame({
-        'Baseline': baseline_metrics,
-        'ARIMA': arima_metrics,
-        'Linear Regression': lr_metrics
-    }).T
-    
-    predictions_df = pd.DataFrame({
-        'Actual': test[value_col],
-        'Baseline': baseline_preds,
-        'ARIMA': arima_preds,
-        'Linear Regression': lr_preds
-    })
-    
+    return pd.Series(lr_preds, index=test_index)
+
+
+forecast_models = {
+    'Baseline': baseline_forecast,
+    'ARIMA': arima_forecast,
+    'Linear Regression': linear_forecast,
+}
+
+
+def calc_metrics(actual, pred):
+    mae = mean_absolute_error(actual, pred)
+    mape = mean_absolute_percentage_error(actual, pred)
+    rmse = np.sqrt(mean_squared_error(actual, pred))
+    return {'MAE': mae, 'MAPE': mape, 'RMSE': rmse}
+
+
+'''
+    Train/test split of one series (trips per period) and the metrics and predictions of every model.
+'''
+@instrumented
+def forecast_series(series: pd.Series, freq, test_periods, arima_order=(1, 0, 1)):
+    # Split train/test
+    train = series.iloc[:-test_periods]
+    test = series.iloc[-test_periods:]
+
+    predictions = {name: model(train, test.index, freq, arima_order) for name, model in forecast_models.items()}
+    metrics_df = pd.DataFrame({name: calc_metrics(test, preds) for name, preds in predictions.items()}).T
+    predictions_df = pd.DataFrame({'Actual': test, **predictions})
+
     return {
         'metrics': metrics_df,
         'predictions': predictions_df
     }
+
+
+'''
+    df1 is one month of cleaned trips, or a DemandStore: then the series of the zone (None for the whole city)
+    over all the months in the store is used without aggregating any trip.
+'''
+@instrumented
+def forecast_and_evaluate(df1, freq, test_periods, arima_order=(1, 0, 1), zone=None):
+    if isinstance(df1, DemandStore):
+        return forecast_series(df1.series(zone, freq), freq, test_periods, arima_order)
+    # Aggregate trips
+    df = aggregate_trips(df1, freq)
+    return forecast_series(df['trips'], freq, test_periods, arima_order)
+
+
+'''
+    Every model on the series of one zone, each in its own try: a model that raises gets NaN predictions
+    and its error as status, a fit with a convergence warning is kept with status 'not converged'.
+    Executed in a worker process.
+'''
+def forecast_zone(zone: int, values: np.ndarray, index: pd.DatetimeIndex, freq: str, test_periods: int,
+                  arima_order: tuple) -> tuple:
+    series = pd.Series(values, index=index, dtype='float64')
+    train, test = series.iloc[:-test_periods], series.iloc[-test_periods:]
+    metrics, predictions = [], {'Actual': test.to_numpy()}
+    for name, model in forecast_models.items():
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            try:
+                preds = model(train, test.index, freq, arima_order).to_numpy(dtype='float64')
+                status = 'ok'
+                if any(issubclass(w.category, ConvergenceWarning) for w in caught):
+                    status = 'not converged'
+            except Exception as error:
+                preds = np.full(len(test), np.nan)
+                status = f'failed: {type(error).__name__}: {error}'
+        if np.isnan(preds).any():
+            scores = {'MAE': np.nan, 'MAPE': np.nan, 'RMSE': np.nan}
+        else:
+            scores = calc_metrics(test, preds)
+        metrics.append({'PULocationID': zone, 'Model': name, **scores, 'status': status})
+        predictions[name] = preds
+    return metrics, predictions
+
+
+'''
+    Hourly (or daily) forecasts of every pickup zone: all zone series are built at once by zone_series, then
+    forecast_zone runs the baseline, ARIMA and linear regression of each zone in parallel worker processes.
+    With a DemandStore instead of df1, the zone series are the columns of DemandStore.frame.
+    Zones with fewer than min_trips trips are skipped. A failing or non-converging zone only marks its own rows.
+    Returns {'metrics': one row per zone and model (MAE, MAPE, RMSE, status),
+             'predictions': one row per zone and test period (Actual and the prediction of every model)}.
+'''
+@instrumented
+def forecast_zones(df1: pd.DataFrame, freq: str = 'H', test_periods: int = 168, arima_order=(1, 0, 1),
+                   zones: list = None, min_trips: int = 1, workers: int = None) -> dict:
+    series = df1.frame(freq, zones) if isinstance(df1, DemandStore) else zone_series(df1, freq, zones)
+    series = series.loc[:, series.sum() >= min_trips]
+    if len(series) <= test_periods:
+        raise ValueError(f"Not enough periods ({len(series)}) for {test_periods} test periods")
+
+    tasks = [(zone, series[zone].to_numpy()) for zone in series.columns]
+    workers = workers or min(len(tasks), os.cpu_count() or 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(forecast_zone, *zip(*tasks), [series.index] * len(tasks), [freq] * len(tasks),
+                                    [test_periods] * len(tasks), [arima_order] * len(tasks),
+                                    chunksize=max(1, len(tasks) // (4 * workers))))
+    else:
+        results = [forecast_zone(zone, values, series.index, freq, test_periods, arima_order) for zone, values in tasks]
+
+    metrics = pd.DataFrame([row for zone_metrics, _ in results for row in zone_metrics],
+                           columns=['PULocationID', 'Model', 'MAE', 'MAPE', 'RMSE', 'status'])
+    test_index = series.index[-test_periods:]
+    predictions = pd.DataFrame({
+        'PULocationID': np.repeat(series.columns.to_numpy(), test_periods),
+        test_index.name: test_index[np.tile(np.arange(test_periods), len(results))],
+        **{name: np.concatenate([preds[name] for _, preds in results] or [np.zeros(0)])
+           for name in ['Actual', *forecast_models]},
+    })
+    return {
+        'metrics': metrics,
+        'predictions': predictions
+    }
+
+
+'''
+    Rolling-origin backtest of the three models on one series (e.g. forecast_and_evaluate's trips, a column of zone_series
+    or a year of hourly demand): the models are trained on everything before each origin and forecast the next horizon periods.
+    Origins start after initial periods (4 weeks by default) and move by step periods (horizon by default); missing periods count 0 trips.
+    - Baseline: the seasonal shift of the whole series (previous week, train mean where the previous week is not in train)
+    - Linear Regression: least squares on the time of every train window from cumulative sums, all origins at once
+    - ARIMA: fitted once (again every refit_every origins) and the rest of the series appended to that fit with the same
+      parameters, so one Kalman filter pass gives the state at every origin and the forecasts are propagated from there
+    Returns one row per origin and horizon step: origin (first forecast period), horizon (1..), the period, Actual and the models.
+'''
+@instrumented
+def backtest(series: pd.Series, freq: str = 'H', horizon: int = 24, step: int = None, initial: int = None,
+             arima_order=(1, 0, 1), refit_every: int = None) -> pd.DataFrame:
+    if freq not in season_lengths:
+        raise ValueError("Unsupported freq")
+    series = series.asfreq(period_freqs[freq], fill_value=0)
+    y = series.to_numpy(dtype='float64')
+    step = step or horizon
+    initial = initial or 4 * season_lengths[freq]
+    origins = np.arange(initial, len(y) - horizon + 1, step)
+    if len(origins) == 0:
+        raise ValueError(f"Not enough periods ({len(y)}) for {initial} train periods and a horizon of {horizon}")
+    positions = origins[:, None] + np.arange(horizon)
+
+    days = np.asarray((series.index - series.index[0]).total_seconds() / (24*3600))
+    predictions = {
+        'Baseline': baseline_paths(y, origins, horizon, season_lengths[freq]),
+        'ARIMA': arima_paths(y, origins, horizon, arima_order, refit_every),
+        'Linear Regression': linear_paths(y, days, origins, horizon),
+    }
+    return pd.DataFrame({
+        'origin': series.index[np.repeat(origins, horizon)],
+        'horizon': np.tile(np.arange(1, horizon + 1), len(origins)),
+        series.index.name or 'time': series.index[positions.ravel()],
+        'Actual': y[positions.ravel()],
+        **{name: preds.ravel() for name, preds in predictions.items()},
+    })
+
+
+'''
+    Seasonal baseline of every origin (rows) and horizon step (columns) as one shifted take of the series.
+'''
+def baseline_paths(y: np.ndarray, origins: np.ndarray, horizon: int, season: int) -> np.ndarray:
+    positions = origins[:, None] + np.arange(horizon)
+    lagged = positions - season
+    train_mean = np.cumsum(y)[origins - 1] / origins
+    return np.where((lagged >= 0) & (lagged < origins[:, None]), y[lagged.clip(min=0)], train_mean[:, None])
+
+
+'''
+    Linear trend of every train window y[:origin] on x, from the cumulative sums of x, y, x * x and x * y.
+'''
+def linear_paths(y: np.ndarray, x: np.ndarray, origins: np.ndarray, horizon: int) -> np.ndarray:
+    n = origins.astype('float64')
+    sum_x, sum_y = np.cumsum(x)[origins - 1], np.cumsum(y)[origins - 1]
+    sum_xx, sum_xy = np.cumsum(x * x)[origins - 1], np.cumsum(x * y)[origins - 1]
+    slope = (n * sum_xy - sum_x * sum_y) / (n * sum_xx - sum_x * sum_x)
+    intercept = (sum_y - slope * sum_x) / n
+    return intercept[:, None] + slope[:, None] * x[origins[:, None] + np.arange(horizon)]
+
+
+'''
+    ARIMA forecasts of every origin. Each fit (the first origin, then every refit_every origins) is extended with
+    the rest of the series by results.append (no refit), and the predicted state of each origin is propagated
+    horizon steps through the transition matrix, for all origins of the fit at once.
+'''
+def arima_paths(y: np.ndarray, origins: np.ndarray, horizon: int, arima_order: tuple, refit_every: int = None) -> np.ndarray:
+    paths = np.empty((len(origins), horizon))
+    refits = range(0, len(origins), refit_every or len(origins))
+    for start in refits:
+        fold = origins[start:start + (refit_every or len(origins))]
+        model_fit = ARIMA(y[:fold[0]], order=arima_order).fit()
+        states = model_fit.append(y[fold[0]:]).filter_results
+        # Time-invariant ARIMA system matrices, the observation intercept carries the constant
+        design, transition = states.design[:, :, 0], states.transition[:, :, 0]
+        obs_intercept = states.obs_intercept[0]
+        state = states.predicted_state[:, fold]
+        for k in range(horizon):
+            paths[start:start + len(fold), k] = (design @ state)[0] + obs_intercept[np.minimum(fold + k, len(obs_intercept) - 1)]
+            state = states.state_intercept[:, [0]] + transition @ state
+    return paths
+
+
+'''
+    MAE, MAPE and RMSE of every model in a backtest frame, per value of by (e.g. 'horizon', 'origin', None for all rows).
+'''
+@instrumented
+def backtest_metrics(results: pd.DataFrame, by: str = 'horizon') -> pd.DataFrame:
+    rows = []
+    groups = results.groupby(by, sort=True) if by is not None else [(None, results)]
+    for key, group in groups:
+        for name in forecast_models:
+            rows.append({**({by: key} if by is not None else {}), 'Model': name, **calc_metrics(group['Actual'], group[name])})
+    return pd.DataFrame(rows)
@@ -0,0 +1,229 @@
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+'''
+    Lightweight instrumentation of the pipeline steps. Functions decorated with @instrumented and blocks in
+    `with step(name):` record, while a run is active (instrument_run), one row per call: wall and CPU seconds,
+    rows in and out, the change of the resident set size and, with trace_memory=True, the tracemalloc peak
+    above the memory at the start of the call. Nested calls (e.g. forecast_and_evaluate inside a stage) get
+    their parent and depth, so the report shows which step of a slow or heavy stage is responsible.
+    Without an active run a decorated function costs one global lookup per call. Worker processes forked during
+    a run do not record into the copy of the run they inherit: only a worker that starts its own instrument_run
+    and hands its records back is covered, which pipeline.run_month does for the month workers. The process
+    pools of forecast_zones, select_n_clusters and render_all record nothing inside their workers (the call of
+    the function that starts the pool is recorded in the parent as a whole).
+
+    One step (function name or stage name) can also be profiled: its first call runs under cProfile and
+    the stats are dumped to <profile_dir>/<name>_<time>.prof (open with pstats or snakeviz).
+
+    Usage:
+        with instrument_run('reports/run_report.json', trace_memory=True, profile='run_quality_check'):
+            df = normalize(df_raw)
+            with step('qa', month=1):
+                qa_flags = run_quality_check(df, 1)
+'''
+current = None  # the active Instrumentation, None when disabled
+mb = 1024 ** 2
+
+'''
+    Resident set size of this process now (Linux /proc), or the max RSS so far where /proc is missing.
+'''
+def rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+'''
+    Rows of a frame-like value: the length of a DataFrame, Series or array, of the first element of a tuple
+    (e.g. the cleaned frame of clean()), None for anything else.
+'''
+def row_count(value):
+    if isinstance(value, tuple) and value:
+        value = value[0]
+    if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+        return len(value)
+    return None
+
+class Instrumentation:
+    def __init__(self, trace_memory: bool = False, profile: str = None, profile_dir=None, labels: dict = None):
+        self.trace_memory = trace_memory
+        self.profile = profile
+        self.profile_dir = Path(profile_dir) if profile_dir is not None else None
+        self.labels = dict(labels or {})
+        self.records = []
+        self.profiles = []
+        self.stack = []
+        self.profiling = False
+        self.started = datetime.now()
+        self.pid = os.getpid()
+
+    '''
+        Starts the record of one step (kind 'function' for a decorated call, 'step' for a block);
+        extra labels (e.g. month=3) are stored with it.
+        Steps nest: end() closes the innermost one.
+    '''
+    def begin(self, name: str, rows_in: int = None, kind: str = 'function', **labels) -> dict:
+        record = {'name': name, 'kind': kind, 'parent': self.stack[-1]['record']['name'] if self.stack else None, 'depth': len(self.stack),
+                  **self.labels, **labels, 'rows_in': rows_in}
+        frame = {'record': record, 'peak': 0, 'profiler': None}
+        if self.trace_memory:
+            # The peak of the parent so far is kept before the counter is reset for this step
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            frame['start_memory'] = tracemalloc.get_traced_memory()[0]
+        if self.profile == name and not self.profiling:
+            frame['profiler'], self.profiling = cProfile.Profile(), True
+        self.stack.append(frame)
+        frame['rss'] = rss_bytes()
+        frame['start'], frame['start_cpu'] = time.perf_counter(), time.process_time()
+        if frame['profiler'] is not None:
+            frame['profiler'].enable()
+        return record
+
+    '''
+        Ends the innermost step with the result of the call (for rows_out) or the error it raised.
+    '''
+    def end(self, result=None, error: BaseException = None) -> dict:
+        frame = self.stack.pop()
+        record = frame['record']
+        if frame['profiler'] is not None:
+            frame['profiler'].disable()
+            self.profiling = False
+        record['wall_seconds'] = time.perf_counter() - frame['start']
+        record['cpu_seconds'] = time.process_time() - frame['start_cpu']
+        record['rss_delta_mb'] = (rss_bytes() - frame['rss']) / mb
+        if self.trace_memory:
+            peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+            record['peak_mb'] = (peak - frame['start_memory']) / mb
+            if self.stack:
+                self.stack[-1]['peak'] = max(self.stack[-1]['peak'], peak)
+        if 'rows_out' not in record:
+            record['rows_out'] = row_count(result)
+        if error is not None:
+            record['error'] = f"{type(error).__name__}: {error}"
+        if frame['profiler'] is not None:
+            self.dump_profile(frame['profiler'], record)
+        self.records.append(record)
+        return record
+
+    def call(self, func, args: tuple, kwargs: dict):
+        self.begin(func.__name__, next((n for n in map(row_count, args) if n is not None), None))
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as error:
+            self.end(error=error)
+            raise
+        self.end(result)
+        return result
+
+    def dump_profile(self, profiler: cProfile.Profile, record: dict) -> None:
+        folder = self.profile_dir or Path('.')
+        folder.mkdir(parents=True, exist_ok=True)
+        path = folder / f"{record['name']}_{datetime.now():%Y%m%d-%H%M%S}_{os.getpid()}.prof"
+        profiler.dump_stats(path)
+        record['profile'] = str(path)
+        self.profiles.append(str(path))
+
+    '''
+        Calls, seconds and memory per step over all records (e.g. the batches of a streamed month added up).
+    '''
+    def summary(self) -> pd.DataFrame:
+        if not self.records:
+            return pd.DataFrame()
+        df = pd.DataFrame(self.records)
+        aggregations = {'calls': ('name', 'size'), 'wall_seconds': ('wall_seconds', 'sum'), 'cpu_seconds': ('cpu_seconds', 'sum'),
+                        'max_rss_delta_mb': ('rss_delta_mb', 'max')}
+        if 'peak_mb' in df.columns:
+            aggregations['max_peak_mb'] = ('peak_mb', 'max')
+        return df.groupby(['name', 'kind'], sort=False).agg(**aggregations).sort_values('wall_seconds', ascending=False)
+
+    def report(self, **meta) -> dict:
+        summary = self.summary()
+        return {
+            'started': self.started.isoformat(timespec='seconds'),
+            'seconds': (datetime.now() - self.started).total_seconds(),
+            'trace_memory': self.trace_memory,
+            'profiles': self.profiles,
+            **meta,
+            'summary': summary.reset_index().to_dict(orient='records'),
+            'calls': self.records,
+        }
+
+    '''
+        Writes the report as JSON (NumPy numbers as plain numbers).
+    '''
+    def save(self, path, **meta) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(**meta), f, indent=1, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+        return path
+
+'''
+    Decorator recording every call of a function while a run is active, rows_in being the rows of the first
+    frame argument and rows_out those of the result (see row_count).
+'''
+def instrumented(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if current is None or current.pid != os.getpid():
+            return func(*args, **kwargs)
+        return current.call(func, args, kwargs)
+    return wrapper
+
+'''
+    Records a block of code as one step (nothing is recorded without an active run). The yielded record
+    can be given rows_out or other fields: with step('kpi', month=3) as record: ...; record['rows_out'] = len(df)
+'''
+@contextmanager
+def step(name: str, rows_in: int = None, **labels):
+    run = current
+    if run is None or run.pid != os.getpid():
+        yield {}
+        return
+    record = run.begin(name, rows_in, kind='step', **labels)
+    try:
+        yield record
+    except BaseException as error:
+        run.end(error=error)
+        raise
+    run.end()
+
+'''
+    Starts a run: instrumented functions record their calls until the end of the block, then the report is
+    saved to path (if given). Runs do not nest, an inner instrument_run inside an active one adds to the outer.
+    In a worker process forked during a run it starts a new run of the worker, whose records the caller has to
+    hand back to the parent itself (pipeline.run_month returns them); see the module comment for the pools that do not.
+'''
+@contextmanager
+def instrument_run(path=None, trace_memory: bool = False, profile: str = None, profile_dir=None, labels: dict = None, **meta):
+    global current
+    if current is not None and current.pid == os.getpid():
+        yield current
+        return
+    current = Instrumentation(trace_memory, profile, profile_dir, labels)
+    if trace_memory:
+        tracemalloc.start()
+    try:
+        yield current
+    finally:
+        run, current = current, None
+        if trace_memory:
+            tracemalloc.stop()
+        if path is not None:
+            run.save(path, **meta)
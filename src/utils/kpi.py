@@ -1,111 +1,309 @@
+import numpy as np
 import pandas as pd
 
-def aggregate_kpis(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> dict:
-    df_calc = df_month.copy()
-
-    # Define time bins
-    bin = [0, 4, 7, 10, 16, 19, 24]
-    labels = ['Early Morning', 'Morning','Morning Rush', 'Midday', 'Evening Rush', 'Late Night']
-
-    # Assign time bins based on pickup and dropoff hours
-    df_calc['pickup_bin'] = pd.cut(df_calc['tpep_pickup_datetime'].dt.hour, bins=bin, labels=labels, right=False)
-    df_calc['dropoff_bin'] = pd.cut(df_calc['tpep_dropoff_datetime'].dt.hour, bins=bin, labels=labels, right=False)
-
-    # Define aggregation rules
-    agg_rules = {
-        'Date': ('tpep_pickup_datetime', lambda x: x.dt.date.iloc[0]),
-        'Day_of_Week': ('pickup_day_of_week', 'first'),
-        'Total_trips': ('tpep_pickup_datetime', 'count'),
-        'Total_fare': (
-            'fare_amount', 
-            lambda x: x[
-                (~qa_flags.loc[x.index, 'invalid_fare_amount']) & 
-                (~qa_flags.loc[x.index, 'suspicious_zero_fare'])
-                ].sum()),
-
-        'Total_amount': ('total_amount', lambda x: x[(~qa_flags.loc[x.index, 'invalid_total_amount']) & (~qa_flags.loc[x.index, 'fare_total_mismatch'])].sum()),
-        
-        'speed_p50':    ('avg_speed_mph', lambda x: x[~qa_flags.loc[x.index, 'excessive_speed']].quantile(0.5)),
-
-        'duration_p50': (
-            'trip_duration_minutes', 
-            lambda x: x[
-                (~qa_flags.loc[x.index, 'excessive_duration']) & 
-                (~qa_flags.loc[x.index, 'short_duration_long_distance'])
-            ].quantile(0.5)),
-        
-        'duration_p95': (
-            'trip_duration_minutes', 
-            lambda x: x[
-                (~qa_flags.loc[x.index, 'excessive_duration']) & 
-                (~qa_flags.loc[x.index, 'short_duration_long_distance'])
-            ].quantile(0.95)),
-        
-        'distance_p50': (
-            'trip_distance', 
-            lambda x: x[
-                (~qa_flags.loc[x.index, 'suspicious_zero_fare']) & 
-                (~qa_flags.loc[x.index, 'short_duration_long_distance'])
-            ].quantile(0.5)),
-        
-        'distance_p95': (
-            'trip_distance', 
-            lambda x: x[
-                (~qa_flags.loc[x.index, 'suspicious_zero_fare']) & 
-                (~qa_flags.loc[x.index, 'short_duration_long_distance'])
-            ].quantile(0.95)),
-        
-        'avg_distance': (
-            'trip_distance', 
-            lambda x: x[
-                (~qa_flags.loc[x.index, 'suspicious_zero_fare']) & 
-                (~qa_flags.loc[x.index, 'short_duration_long_distance'])
-            ].mean()),
-        
-        'revenue_per_trip': ('fare_amount', lambda x: x[~qa_flags.loc[x.index, 'invalid_fare_amount']].sum() /
-                                                        x[~qa_flags.loc[x.index, 'invalid_fare_amount']].count() ),
-        'revenue_per_mile': ('fare_amount', lambda x: x[~qa_flags.loc[x.index, 'invalid_fare_amount']].sum() / 
-                                                       df_calc.loc[x[~qa_flags.loc[x.index, 'invalid_fare_amount']].index, 'trip_distance'].sum())
-    }
+from src.utils.qa_rules import flag_frame
+from src.utils.sketch import QuantileSketch
+from src.utils.instrumentation import instrumented
+
+# QA rules used to mask KPI inputs
+kpi_rules = ['invalid_fare_amount', 'suspicious_zero_fare', 'invalid_total_amount', 'fare_total_mismatch',
+             'excessive_speed', 'excessive_duration', 'short_duration_long_distance']
+
+# Time bins of the pickup / dropoff hour: [0, 4), [4, 7), ... [19, 24)
+bin = [0, 4, 7, 10, 16, 19, 24]
+labels = ['Early Morning', 'Morning','Morning Rush', 'Midday', 'Evening Rush', 'Late Night']
+kpi_frequencies = {'Daily': 'D', 'Weekly': 'W', 'Monthly': 'ME'}
+
+# Time bin of every hour of the day
+hour_bins = np.searchsorted(bin[1:-1], np.arange(24), side='right')
+
+'''
+    Local wall time of a tz-aware datetime column as int64 nanoseconds (missing = minimum int64).
+'''
+def local_nanoseconds(times: pd.Series) -> np.ndarray:
+    return times.dt.tz_localize(None).to_numpy().view('int64')
+
+'''
+    Time bin of each time as an int code (index in labels), -1 for a missing time.
+'''
+def time_bin_codes(local_ns: np.ndarray) -> np.ndarray:
+    hours = (local_ns // (3600 * 10**9)) % 24
+    return np.where(local_ns == np.iinfo(np.int64).min, -1, hour_bins[hours])
+
+'''
+    Period of every day (naive local dates) for a Grouper frequency ('D', 'W', 'ME', 'YE', ...) as int codes
+    into the period labels. Labels are the tz-aware labels of pd.Grouper on the pickup time (local midnight of
+    the day, of the week's Sunday, of the month's last day ...), empty periods between the first and last day included.
+'''
+def period_codes(days: pd.DatetimeIndex, tz, freq: str) -> tuple:
+    if len(days) == 0:
+        return np.empty(0, dtype=np.int16), pd.DatetimeIndex([], tz=tz)
+    # Smallest period end on or after each day
+    day_labels = days - pd.Timedelta(days=1) + pd.tseries.frequencies.to_offset(freq)
+    period_labels = pd.date_range(day_labels.min(), day_labels.max(), freq=freq)
+    return np.searchsorted(period_labels, day_labels).astype(np.int16), period_labels.tz_localize(tz)
+
+'''
+    Per-group linear-interpolation quantiles (same as Series.quantile).
+    sorted_values are the values of a column without NaN, sorted once and shared by every frequency,
+    group_of the group code of each of them.
+'''
+def grouped_quantiles(sorted_values: np.ndarray, group_of: np.ndarray, n_groups: int, qs: list) -> list:
+    # Radix sort of the small codes, stable so the values stay sorted inside each group
+    sorted_values = sorted_values[np.argsort(group_of, kind='stable')]
+    if len(sorted_values) == 0:
+        return [np.full(n_groups, np.nan) for _ in qs]
+
+    counts = np.bincount(group_of, minlength=n_groups)
+    starts = np.cumsum(counts) - counts
+    last = len(sorted_values) - 1
+    results = []
+    for q in qs:
+        position = (counts - 1) * q
+        lower = np.floor(position).astype(np.int64)
+        upper = np.minimum(lower + 1, counts - 1)
+        fraction = position - lower
+        # Empty groups read any value, they are set to NaN below
+        a = sorted_values[np.clip(starts + lower, 0, last)]
+        b = sorted_values[np.clip(starts + upper, 0, last)]
+        # Same interpolation as numpy.percentile
+        diff = b - a
+        result = np.where(fraction >= 0.5, b - diff * (1 - fraction), a + diff * fraction)
+        results.append(np.where(counts > 0, result, np.nan))
+    return results
+
+# KPI inputs masked by QA rules: name -> (column, rules that exclude the row)
+kpi_inputs = {
+    'fare': ('fare_amount', ['invalid_fare_amount', 'suspicious_zero_fare']),
+    'total': ('total_amount', ['invalid_total_amount', 'fare_total_mismatch']),
+    'speed': ('avg_speed_mph', ['excessive_speed']),
+    'duration': ('trip_duration_minutes', ['excessive_duration', 'short_duration_long_distance']),
+    'distance': ('trip_distance', ['suspicious_zero_fare', 'short_duration_long_distance']),
+    'valid_fare': ('fare_amount', ['invalid_fare_amount']),
+    # Distance of the trips with a valid fare, even if the fare itself is missing
+    'valid_fare_distance': ('trip_distance', ['invalid_fare_amount']),
+}
+quantile_inputs = {'speed': [0.5], 'duration': [0.5, 0.95], 'distance': [0.5, 0.95]}
+
+'''
+    Boolean array of every rule in kpi_rules, from standard or packed flags.
+'''
+def kpi_flags(qa_flags: pd.DataFrame) -> dict:
+    flags = flag_frame(qa_flags, kpi_rules)
+    return {name: flags[name].to_numpy(dtype=bool) for name in kpi_rules}
+
+'''
+    Values of one KPI input (a key of kpi_inputs) as float64, NaN where a rule of the input excludes the row.
+'''
+def masked_input(df_month: pd.DataFrame, flags: dict, name: str) -> np.ndarray:
+    column, rules = kpi_inputs[name]
+    values = df_month[column].to_numpy(dtype='float64', na_value=np.nan)
+    exclude = np.zeros(len(values), dtype=bool)
+    for rule in rules:
+        exclude |= flags[rule]
+    return np.where(exclude, np.nan, values)
 
-    # Create binary columns for each time bin
-    for lb in labels:
-        df_calc[f'pickup_bin_{lb}'] = (df_calc['pickup_bin'] == lb).astype(int)
-        df_calc[f'dropoff_bin_{lb}'] = (df_calc['dropoff_bin'] == lb).astype(int)
+'''
+    One pass over the rows: every KPI input masked (NaN) by its QA rules, then per local pickup day the sums,
+    counts, trips per time bin and first trip. Weekly and monthly KPIs combine the days, only the quantiles
+    need the rows again (kept sorted by value).
+'''
+def kpi_columns(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> dict:
+    flags = kpi_flags(qa_flags)
 
-    # Add aggregation rules for trips per hour in each time bin
+    # Local pickup day as an offset from the first day (-1 for a missing pickup)
+    pickup_ns = local_nanoseconds(df_month['tpep_pickup_datetime'])
+    has_pickup = pickup_ns != np.iinfo(np.int64).min
+    # Rows without a pickup time are in no period; skip the row selection when there are none
+    rows = slice(None) if has_pickup.all() else has_pickup
+    day_number = pickup_ns // (24 * 3600 * 10**9)
+    first_day = day_number[rows].min() if has_pickup.any() else 0
+    pickup_days = np.where(has_pickup, day_number - first_day, -1).astype(np.int16)
+    n_days = int(pickup_days.max()) + 1 if has_pickup.any() else 0
+    days = pickup_days[rows]
+
+    calc = {'days': pd.DatetimeIndex(np.datetime64(int(first_day), 'D') + np.arange(n_days)),
+            'tz': df_month['tpep_pickup_datetime'].dt.tz,
+            'day_trips': np.bincount(days, minlength=n_days)}
+
+    for name in kpi_inputs:
+        values = np.where(has_pickup, masked_input(df_month, flags, name), np.nan)
+        valid = ~np.isnan(values)
+        calc[f'{name}_sum'] = np.bincount(days, weights=np.where(valid, values, 0)[rows], minlength=n_days)
+        calc[f'{name}_count'] = np.bincount(days, weights=valid[rows], minlength=n_days)
+        if name in quantile_inputs:
+            # Values sorted once (NaN last, cut off) with the day of each
+            order = np.argsort(values)[:np.count_nonzero(valid)]
+            calc[f'{name}_sorted'] = values[order]
+            calc[f'{name}_days'] = pickup_days[order]
+
+    # Trips per day and time bin
+    n_bins = len(labels)
+    dropoff_ns = local_nanoseconds(df_month['tpep_dropoff_datetime'])
+    for side, local_ns in [('pickup', pickup_ns), ('dropoff', dropoff_ns)]:
+        bins = time_bin_codes(local_ns)[rows]
+        in_bin = bins >= 0
+        calc[f'{side}_bins'] = np.bincount(days[in_bin] * n_bins + bins[in_bin], minlength=n_days * n_bins).reshape(n_days, n_bins)
+
+    # First trip of each day in pickup time order (the earliest pickup, ties keep the row order as in Grouper)
+    day_min = np.full(n_days, np.iinfo(np.int64).max)
+    np.minimum.at(day_min, days, pickup_ns[rows])
+    candidates = np.flatnonzero(has_pickup & (pickup_ns == day_min[pickup_days.clip(min=0)]))
+    first_days, first_index = np.unique(pickup_days[candidates], return_index=True)
+    day_first_row = np.full(n_days, -1)
+    day_first_row[first_days] = candidates[first_index]
+    calc['day_first_pickup'] = df_month['tpep_pickup_datetime'].array.take(day_first_row, allow_fill=True)
+    calc['day_of_week'] = df_month['pickup_day_of_week'].array.take(day_first_row, allow_fill=True)
+    return calc
+
+'''
+    KPI frame of the periods from per-day values (from kpi_columns or daily partials) and the period quantiles.
+    The time-bin columns keep the "pickups / dropoffs per hour" string of the report,
+    the same numbers are added as numeric columns '<bin>_pickups_per_hour' and '<bin>_dropoffs_per_hour'.
+'''
+def period_frame(day_values: dict, day_codes: np.ndarray, period_labels: pd.DatetimeIndex, quantiles: dict) -> tuple:
+    n_groups = len(period_labels)
+
+    def combine(values: np.ndarray) -> np.ndarray:
+        return np.bincount(day_codes, weights=values, minlength=n_groups)
+
+    # First trip of the period: the earliest first trip of its days
+    first_pickup = day_values['day_first_pickup']
+    first_days = np.full(n_groups, -1)
+    for day in np.argsort(first_pickup.asi8)[::-1]:
+        if not pd.isna(first_pickup[day]):
+            first_days[day_codes[day]] = day
+
+    out = pd.DataFrame(index=pd.Index(period_labels, name='tpep_pickup_datetime'))
+    out['Date'] = pd.Series(first_pickup.take(first_days, allow_fill=True), index=out.index).dt.date
+    out['Day_of_Week'] = day_values['day_of_week'].take(first_days, allow_fill=True)
+    out['Total_trips'] = combine(day_values['day_trips']).astype(np.int64)
+    out['Total_fare'] = combine(day_values['fare_sum'])
+    out['Total_amount'] = combine(day_values['total_sum'])
+    for name in ['speed_p50', 'duration_p50', 'duration_p95', 'distance_p50', 'distance_p95']:
+        out[name] = quantiles[name]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['avg_distance'] = combine(day_values['distance_sum']) / combine(day_values['distance_count'])
+        out['revenue_per_trip'] = combine(day_values['valid_fare_sum']) / combine(day_values['valid_fare_count'])
+        out['revenue_per_mile'] = combine(day_values['valid_fare_sum']) / combine(day_values['valid_fare_distance_sum'])
+
+    # Trips per hour in each time bin (pickups / dropoffs)
+    per_hour = {}
     for i, lb in enumerate(labels):
         bin_hours = bin[i+1] - bin[i]
+        per_hour[f'{lb}_pickups_per_hour'] = np.round(combine(day_values['pickup_bins'][:, i]) / bin_hours, 2)
+        per_hour[f'{lb}_dropoffs_per_hour'] = np.round(combine(day_values['dropoff_bins'][:, i]) / bin_hours, 2)
+        out[lb] = [f"{pickups} / {dropoffs}" for pickups, dropoffs in zip(per_hour[f'{lb}_pickups_per_hour'], per_hour[f'{lb}_dropoffs_per_hour'])]
+    return out, pd.DataFrame(per_hour, index=out.index)
 
-        agg_rules[f'{lb}'] = (
-            'trip_distance',
-            lambda x, lb=lb, h=bin_hours: (
-                f"{round(df_calc.loc[x.index, f'pickup_bin_{lb}'].sum() / h, 2)} / {round(df_calc.loc[x.index, f'dropoff_bin_{lb}'].sum() / h, 2)}"
-            )
-        )
+'''
+    Adds the trip index of the daily KPIs (trips of each day, first day = 100) and the numeric time-bin columns.
+'''
+def finish_kpi_frame(kpi: pd.DataFrame, per_hour: pd.DataFrame, daily: bool) -> pd.DataFrame:
+    if daily:
+        base_value = kpi['Total_trips'].iloc[0] if len(kpi) else 0
+        if base_value == 0:
+            base_value = 1  # To avoid division by zero
+        kpi['index_100_by_day_by_trips'] = kpi['Total_trips'] / base_value * 100
+    return pd.concat([kpi, per_hour], axis=1).reset_index()
 
-    # A. Daily
-    df_daily = df_calc.groupby(pd.Grouper(key='tpep_pickup_datetime', freq='D')).agg(**agg_rules).reset_index()
+'''
+    Daily, weekly and monthly KPIs of one month. Trips flagged by the rules in kpi_rules are left out
+    of the KPIs they would distort (e.g. suspicious fares out of Total_fare, excessive durations out of duration_p50).
+    All KPIs are exact; use daily_partials and rollup_kpis for periods across months.
+'''
+@instrumented
+def aggregate_kpis(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> dict:
+    calc = kpi_columns(df_month, qa_flags)
+
+    results = {}
+    for name, freq in kpi_frequencies.items():
+        day_codes, period_labels = period_codes(calc['days'], calc['tz'], freq)
+        quantiles = {}
+        for column, qs in quantile_inputs.items():
+            group_of = day_codes[calc[f'{column}_days']]
+            for q, result in zip(qs, grouped_quantiles(calc[f'{column}_sorted'], group_of, len(period_labels), qs)):
+                quantiles[f'{column}_p{round(q * 100)}'] = result
+        kpi, per_hour = period_frame(calc, day_codes, period_labels, quantiles)
+        results[name] = finish_kpi_frame(kpi, per_hour, name == 'Daily')
+    return results
 
-    base_value = df_daily.loc[0, 'Total_trips']
+'''
+    Daily partial aggregates of one month, one row per local pickup day: trips, sums and counts of the masked
+    KPI inputs, trips per time bin, the first trip and a QuantileSketch (serialized) of speed, duration and distance.
+    Partials of any months can be concatenated and rolled up with rollup_kpis without the trip rows.
+'''
+@instrumented
+def daily_partials(df_month: pd.DataFrame, qa_flags: pd.DataFrame, relative_accuracy: float = 0.01) -> pd.DataFrame:
+    calc = kpi_columns(df_month, qa_flags)
+    n_days = len(calc['days'])
 
-    if base_value == 0:
-        base_value = 1  # To avoid division by zero
+    partials = pd.DataFrame({
+        'day': calc['days'].tz_localize(calc['tz']),
+        'first_pickup': calc['day_first_pickup'],
+        'Day_of_Week': calc['day_of_week'],
+        'trips': calc['day_trips'],
+    })
+    for name in kpi_inputs:
+        partials[f'{name}_sum'] = calc[f'{name}_sum']
+        partials[f'{name}_count'] = calc[f'{name}_count'].astype(np.int64)
+    for side in ['pickup', 'dropoff']:
+        for i, lb in enumerate(labels):
+            partials[f'{side}_bin_{lb}'] = calc[f'{side}_bins'][:, i]
 
-    df_daily[f'index_100_by_day_by_trips'] = (
-        df_daily['Total_trips'] / base_value * 100
-    )
+    for name in quantile_inputs:
+        # Values grouped by day (stable sort of the day codes keeps them sorted)
+        days = calc[f'{name}_days']
+        by_day = calc[f'{name}_sorted'][np.argsort(days, kind='stable')]
+        bounds = np.cumsum(np.bincount(days, minlength=n_days))
+        partials[f'{name}_sketch'] = [QuantileSketch(relative_accuracy).add(values).to_bytes()
+                                      for values in np.split(by_day, bounds[:-1])]
+    return partials
 
-    # B. Weekly
-    df_weekly = df_calc.groupby(pd.Grouper(key='tpep_pickup_datetime', freq='W')).agg(**agg_rules).reset_index()
+'''
+    KPIs of any period from daily partials (of one or several months), without reading trips:
+    freq is a Grouper frequency ('D', 'W', 'ME', 'YE', ...), or None for one row over the whole selection.
+    start / end select the days (inclusive, e.g. '2021-03-29', '2021-04-04').
+    Weeks across month boundaries are complete when the partials of both months are given.
+    Sums, counts and trips per time bin are exact, p50 / p95 come from the merged sketches
+    (within their relative accuracy, 1% by default, of the exact value; see QuantileSketch).
+'''
+@instrumented
+def rollup_kpis(partials: pd.DataFrame, freq: str = 'W', start=None, end=None) -> pd.DataFrame:
+    tz = partials['day'].dt.tz
+    if start is not None:
+        partials = partials[partials['day'] >= pd.Timestamp(start).tz_localize(tz)]
+    if end is not None:
+        partials = partials[partials['day'] <= pd.Timestamp(end).tz_localize(tz)]
+    partials = partials.sort_values('day', kind='stable', ignore_index=True)
+    days = pd.DatetimeIndex(partials['day'].dt.tz_localize(None))
 
-    # C. Monthly
-    df_monthly = df_calc.groupby(pd.Grouper(key='tpep_pickup_datetime', freq='M')).agg(**agg_rules).reset_index()
+    if freq is None:
+        day_codes = np.zeros(len(partials), dtype=np.int16)
+        period_labels = pd.DatetimeIndex(partials['day'].iloc[:1])
+    else:
+        day_codes, period_labels = period_codes(days, tz, freq)
 
-    results = {
-        "Daily": df_daily,
-        "Weekly": df_weekly,
-        "Monthly": df_monthly,
+    day_values = {
+        'day_first_pickup': partials['first_pickup'].array,
+        'day_of_week': partials['Day_of_Week'].array,
+        'day_trips': partials['trips'].to_numpy(),
+        'pickup_bins': partials[[f'pickup_bin_{lb}' for lb in labels]].to_numpy(),
+        'dropoff_bins': partials[[f'dropoff_bin_{lb}' for lb in labels]].to_numpy(),
     }
+    for name in kpi_inputs:
+        day_values[f'{name}_sum'] = partials[f'{name}_sum'].to_numpy()
+        day_values[f'{name}_count'] = partials[f'{name}_count'].to_numpy()
+
+    quantiles = {}
+    for name, qs in quantile_inputs.items():
+        sketches = [None] * len(period_labels)
+        for code, data in zip(day_codes, partials[f'{name}_sketch']):
+            sketch = QuantileSketch.from_bytes(data)
+            sketches[code] = sketch if sketches[code] is None else sketches[code].merge(sketch)
+        for q in qs:
+            quantiles[f'{name}_p{round(q * 100)}'] = [np.nan if sketch is None else sketch.quantile(q) for sketch in sketches]
 
-    return results
\ No newline at end of file
+    kpi, per_hour = period_frame(day_values, day_codes, period_labels, quantiles)
+    return finish_kpi_frame(kpi, per_hour, freq == 'D')
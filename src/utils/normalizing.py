@@ -2,6 +2,8 @@ import pandas as pd
 import numpy as np
 import os
 
+from src.utils.instrumentation import instrumented
+
 """
 This function normalize a dataframe of a month
 Columns before: ['VendorID', 'tpep_pickup_datetime', 'tpep_dropoff_datetime','passenger_count', 
@@ -17,52 +19,119 @@ Columns after: ['tpep_pickup_datetime', 'tpep_dropoff_datetime', 'passenger_coun
 
 """
 
-# Load and prepare the taxi zone lookup table for merging
-zones_df_raw = pd.read_csv(os.path.join('../raw/', 'taxi_zone_lookup.csv'))
+'''
+    Turns a column of integer keys into row positions of a dense lookup array of length size + 1.
+    Missing, fractional or out of range keys point to the sentinel row at position size.
+'''
+def lookup_rows(keys: pd.Series, size: int) -> np.ndarray:
+    ids = keys.to_numpy(dtype='float64', na_value=np.nan)
+    valid = (ids >= 0) & (ids < size) & (ids == np.floor(ids))
+    return np.where(valid, ids, size).astype(np.intp)
+
+'''
+    Dense, array-backed version of the taxi zone lookup table.
+    Borough and Zone are stored as categorical codes in a (max LocationID + 2, 2) array,
+    so a whole column of LocationIDs is decoded with one fancy-index take instead of a merge.
+    The last row is a sentinel of -1 codes: out of range or missing IDs land there and become NaN,
+    exactly like the unmatched rows of the old left merge.
+'''
+class ZoneDimension:
+    def __init__(self, lookup: pd.DataFrame):
+        # Sorted categories keep the same order as grouping/sorting on the zone strings
+        self.borough_categories = pd.Index(sorted(lookup['Borough'].dropna().unique()))
+        self.zone_categories = pd.Index(sorted(lookup['Zone'].dropna().unique()))
+
+        # Row i holds the (borough code, zone code) of LocationID i, -1 means NaN
+        self.size = int(lookup['LocationID'].max()) + 1
+        self.codes = np.full((self.size + 1, 2), -1, dtype=np.int16)
+        location_ids = lookup['LocationID'].to_numpy()
+        self.codes[location_ids, 0] = self.borough_categories.get_indexer(lookup['Borough'])
+        self.codes[location_ids, 1] = self.zone_categories.get_indexer(lookup['Zone'])
+
+    def take_codes(self, location_ids: pd.Series) -> np.ndarray:
+        # Unknown or missing IDs point to the sentinel row
+        return self.codes[lookup_rows(location_ids, self.size)]
+
+    def take(self, location_ids: pd.Series) -> tuple:
+        codes = self.take_codes(location_ids)
+        borough = pd.Series(pd.Categorical.from_codes(codes[:, 0], categories=self.borough_categories), index=location_ids.index)
+        zone = pd.Series(pd.Categorical.from_codes(codes[:, 1], categories=self.zone_categories), index=location_ids.index)
+        return borough, zone
+
+# Load and prepare the taxi zone lookup table (relative to the project root, so it works from notebooks/ and from the root)
+zones_df_raw = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'raw', 'taxi_zone_lookup.csv'))
 zones_lookup = zones_df_raw[['LocationID', 'Borough', 'Zone']].copy()
+zone_dim = ZoneDimension(zones_lookup)
 
 # Define mappings for categorical features based on the official data dictionary.
 payment_map = {0: 'Flex Fare trip', 1: 'Credit card', 2: 'Cash', 3: 'No charge', 4: 'Dispute', 5: 'Unknown', 6: 'Voided trip'}
 ratecodeID_map = {1: 'Standard rate', 2: 'JFK', 3: 'Newark', 4: 'Nassau or Westchester', 5: 'Negotiated fare', 6: 'Group ride', 99: 'Unknown'}
+day_names = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# Dtypes used by normalize(..., compact=True)
+compact_float_cols = ['trip_distance', 'fare_amount', 'extra', 'mta_tax', 'tip_amount', 'tolls_amount',
+                      'improvement_surcharge', 'total_amount', 'congestion_surcharge']
+compact_int_cols = {'passenger_count': 'Int8', 'RatecodeID': 'Int8', 'payment_type': 'Int8',
+                    'PULocationID': 'Int16', 'DOLocationID': 'Int16'}
 
-def normalize(df_raw: pd.DataFrame) -> pd.DataFrame:
-    df = df_raw.copy()
+'''
+    Maps integer codes to their labels like Series.map(mapping), but returns a categorical
+    whose categories are the mapping values, without building one string object per row.
+'''
+def map_to_categorical(values: pd.Series, mapping: dict) -> pd.Series:
+    categories = pd.Index(list(mapping.values()))
+    size = max(mapping) + 1
+    codes = np.full(size + 1, -1, dtype=np.int8)
+    codes[list(mapping.keys())] = np.arange(len(mapping))
+    return pd.Series(pd.Categorical.from_codes(codes[lookup_rows(values, size)], categories=categories), index=values.index)
+
+'''
+    With compact=True the raw frame is not copied: it is modified in place and returned, so it should not be reused.
+    Label columns become categoricals, amounts/distance/speed float32 and the code columns small nullable ints.
+    The dtypes survive to_parquet/read_parquet, so the cleaned files keep the reduced footprint.
+'''
+@instrumented
+def normalize(df_raw: pd.DataFrame, compact: bool = False) -> pd.DataFrame:
+    if compact:
+        df = df_raw
+        # Drop unused columns first and shrink the rest before any new column is created
+        df.drop(columns=['airport_fee', 'store_and_fwd_flag', 'VendorID'], errors='ignore', inplace=True)
+        df[compact_float_cols] = df[compact_float_cols].astype('float32')
+        df[list(compact_int_cols)] = df[list(compact_int_cols)].astype(compact_int_cols)
+    else:
+        df = df_raw.copy()
 
     # Normalize datetime columns
     df['tpep_pickup_datetime'] = pd.to_datetime(df['tpep_pickup_datetime'], errors='coerce').dt.tz_localize('America/New_York', ambiguous='NaT', nonexistent='NaT')
     df['tpep_dropoff_datetime'] = pd.to_datetime(df['tpep_dropoff_datetime'], errors='coerce').dt.tz_localize('America/New_York', ambiguous='NaT', nonexistent='NaT')
-    # Normalize RatecodeID 
-    df['ratecodeID_name'] = df['RatecodeID'].map(ratecodeID_map)
-    # Normalize Payment type
-    df['payment_type_name'] = df['payment_type'].map(payment_map)
+    # Normalize RatecodeID, Payment type
+    if compact:
+        df['ratecodeID_name'] = map_to_categorical(df['RatecodeID'], ratecodeID_map)
+        df['payment_type_name'] = map_to_categorical(df['payment_type'], payment_map)
+    else:
+        df['ratecodeID_name'] = df['RatecodeID'].map(ratecodeID_map)
+        df['payment_type_name'] = df['payment_type'].map(payment_map)
     # Normalize PULocationID 
-    df = df.merge(
-        zones_lookup,
-        left_on='PULocationID',
-        right_on='LocationID',
-        how='left'  
-    )
-    df.rename(columns={'Borough': 'PU_Borough', 'Zone': 'PU_Zone'}, inplace=True)
-    df.drop(columns=['LocationID'], inplace=True) 
+    df['PU_Borough'], df['PU_Zone'] = zone_dim.take(df['PULocationID'])
     # Normalize DOLocationID 
-    df = df.merge(
-        zones_lookup,
-        left_on='DOLocationID',
-        right_on='LocationID',
-        how='left'
-    )
-    df.rename(columns={'Borough': 'DO_Borough', 'Zone': 'DO_Zone'}, inplace=True)
-    df.drop(columns=['LocationID'], inplace=True)
+    df['DO_Borough'], df['DO_Zone'] = zone_dim.take(df['DOLocationID'])
 
     # Create new feature: trip's duration
     df['trip_duration_seconds'] = (df['tpep_dropoff_datetime'] - df['tpep_pickup_datetime']).dt.total_seconds()
+    if compact:
+        df['trip_duration_seconds'] = df['trip_duration_seconds'].astype('float32')
     df['trip_duration_minutes'] = round(df['trip_duration_seconds']/60)
     # Create new feature: trip's average speed
     df['avg_speed_mph'] = round(df['trip_distance'] / (df['trip_duration_seconds'] / 3600), 2)
     df['avg_speed_mph'].replace([np.inf, -np.inf], np.nan, inplace=True)
     # Create new feture: trip's day in week, is_weekend (based on pick up time)
-    df['pickup_day_of_week'] = df['tpep_pickup_datetime'].dt.day_name()
-    df['is_weekend'] = df['pickup_day_of_week'].isin(['Saturday', 'Sunday'])
+    if compact:
+        day_codes = df['tpep_pickup_datetime'].dt.dayofweek.to_numpy(dtype='float64', na_value=np.nan)
+        df['pickup_day_of_week'] = pd.Categorical.from_codes(np.nan_to_num(day_codes, nan=-1).astype(np.int8), categories=day_names)
+        df['is_weekend'] = day_codes >= 5
+    else:
+        df['pickup_day_of_week'] = df['tpep_pickup_datetime'].dt.day_name()
+        df['is_weekend'] = df['pickup_day_of_week'].isin(['Saturday', 'Sunday'])
     #Create new feature: Compute sum of known components (use 0 for missing) to compare with total_amount
     df['computed_total_amount'] = df[['fare_amount', 'tolls_amount', 'tip_amount', 'extra', 'congestion_surcharge', 'mta_tax', 'improvement_surcharge']].fillna(0).sum(axis=1)
 
@@ -74,6 +143,20 @@ def normalize(df_raw: pd.DataFrame) -> pd.DataFrame:
     'mta_tax',               # Dropped: Low variance / Irrelevant
     'improvement_surcharge'  # Dropped: Low variance / Irrelevant
     ]
-    df.drop(columns = cols_to_drop, axis=1, inplace=True)
+    df.drop(columns = cols_to_drop, axis=1, inplace=True, errors='ignore' if compact else 'raise')
+
+    return df
 
-    return df
\ No newline at end of file
+'''
+    Reports the memory per row of each column of two frames, e.g. the raw month, normalize(df) and normalize(df, compact=True).
+    The last row "Total" is the whole frame, ratio is before / after.
+'''
+@instrumented
+def memory_report(before: pd.DataFrame, after: pd.DataFrame) -> pd.DataFrame:
+    report = pd.DataFrame({
+        'before_bytes_per_row': before.memory_usage(index=False, deep=True) / max(len(before), 1),
+        'after_bytes_per_row': after.memory_usage(index=False, deep=True) / max(len(after), 1),
+    })
+    report.loc['Total'] = report.sum()
+    report['ratio'] = (report['before_bytes_per_row'] / report['after_bytes_per_row']).round(2)
+    return report
\ No newline at end of file
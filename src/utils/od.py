@@ -0,0 +1,135 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from src.utils.normalizing import zone_dim, lookup_rows
+from src.utils.kpi import kpi_flags, masked_input, local_nanoseconds, labels, hour_bins
+
+'''
+    Dense origin-destination flows between the 265 taxi zones: cell [m, s, o, d] holds measure m of the trips
+    from LocationID o + 1 to LocationID d + 1 in slice s (the time bin or hour of the local pickup, one slice without by).
+    Fare and duration are masked by the same QA rules as aggregate_kpis, their counts give the averages.
+    Trips with an unknown zone or without a pickup time are left out.
+'''
+od_measures = ['trips', 'fare_sum', 'fare_count', 'duration_sum', 'duration_count']
+n_od_zones = 265
+od_slices = {None: 1, 'time_bin': len(labels), 'hour': 24}
+
+class ODMatrix:
+    def __init__(self, values: np.ndarray, by: str = None):
+        if by not in od_slices:
+            raise ValueError(f"by must be one of {list(od_slices)}")
+        self.values = values
+        self.by = by
+
+    '''
+        Flows of one month (data and standard or packed flags): the cell of every trip is computed once
+        and every measure is one np.bincount over the flattened cell index.
+    '''
+    @classmethod
+    def from_trips(cls, df: pd.DataFrame, qa_flags: pd.DataFrame, by: str = None) -> 'ODMatrix':
+        if by not in od_slices:
+            raise ValueError(f"by must be one of {list(od_slices)}")
+        n_slices = od_slices[by]
+        flags = kpi_flags(qa_flags)
+
+        # Zone index 0..264 (LocationID - 1), n_od_zones for unknown or missing IDs
+        origin = lookup_rows(df['PULocationID'], n_od_zones + 1) - 1
+        destination = lookup_rows(df['DOLocationID'], n_od_zones + 1) - 1
+        pickup_ns = local_nanoseconds(df['tpep_pickup_datetime'])
+        hours = (pickup_ns // (3600 * 10**9)) % 24
+        slices = {None: np.zeros(len(df), dtype=np.int64), 'time_bin': hour_bins[hours], 'hour': hours}[by]
+        rows = ((origin >= 0) & (origin < n_od_zones) & (destination >= 0) & (destination < n_od_zones)
+                & (pickup_ns != np.iinfo(np.int64).min))
+
+        cell = ((slices * n_od_zones + origin) * n_od_zones + destination)[rows]
+        size = n_slices * n_od_zones * n_od_zones
+        values = np.empty((len(od_measures), size))
+        values[0] = np.bincount(cell, minlength=size)
+        for i, name in enumerate(['fare', 'duration']):
+            masked = masked_input(df, flags, name)[rows]
+            valid = ~np.isnan(masked)
+            values[1 + 2 * i] = np.bincount(cell, weights=np.where(valid, masked, 0), minlength=size)
+            values[2 + 2 * i] = np.bincount(cell, weights=valid, minlength=size)
+        return cls(values.reshape(len(od_measures), n_slices, n_od_zones, n_od_zones), by)
+
+    '''
+        Adds the flows of another month (same slicing) to this matrix.
+    '''
+    def merge(self, other: 'ODMatrix') -> 'ODMatrix':
+        if other.by != self.by:
+            raise ValueError('Cannot merge OD matrices with different slices')
+        self.values = self.values + other.values
+        return self
+
+    '''
+        One measure as an array (slices, origins, destinations), e.g. od.measure('trips')[:, 236 - 1, 161 - 1].
+    '''
+    def measure(self, name: str) -> np.ndarray:
+        return self.values[od_measures.index(name)]
+
+    '''
+        Average fare or duration of every cell (NaN without valid trips).
+    '''
+    def average(self, name: str) -> np.ndarray:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.measure(f'{name}_sum') / self.measure(f'{name}_count')
+
+    def save(self, path) -> None:
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        np.save(path, self.values)
+
+    '''
+        Memory-mapped matrix saved with save(), nothing is read before a cell is used.
+        The slicing is known from the number of slices.
+    '''
+    @classmethod
+    def load(cls, path, mmap: bool = True) -> 'ODMatrix':
+        values = np.load(path, mmap_mode='r' if mmap else None)
+        by = {n_slices: by for by, n_slices in od_slices.items()}[values.shape[1]]
+        return cls(values, by)
+
+    '''
+        OD rows as feature vectors of the pickup zone x time bin rows of compute_kpi_zone_time:
+        the share of the trips of the zone and time bin going to each destination borough (or zone).
+        Indexed by (zone name, time bin label); zones sharing a name are added up.
+    '''
+    def zone_features(self, destinations: str = 'borough') -> pd.DataFrame:
+        if self.by != 'time_bin':
+            raise ValueError("zone_features needs an OD matrix by 'time_bin'")
+        trips = np.asarray(self.measure('trips'))
+        location_ids = np.arange(1, n_od_zones + 1)
+        codes = zone_dim.codes[location_ids]
+
+        # Destinations grouped by borough (or zone name) with a one-hot matrix
+        if destinations == 'borough':
+            categories, destination_codes = zone_dim.borough_categories, codes[:, 0]
+        elif destinations == 'zone':
+            categories, destination_codes = zone_dim.zone_categories, codes[:, 1]
+        else:
+            raise ValueError("destinations must be 'borough' or 'zone'")
+        known = destination_codes >= 0
+        one_hot = np.zeros((n_od_zones, len(categories)))
+        one_hot[np.flatnonzero(known), destination_codes[known]] = 1
+        flows = trips @ one_hot  # (time bins, origins, destination groups)
+
+        # Origins grouped by zone name, one row per zone name and time bin
+        origin_zone = zone_dim.zone_categories[codes[:, 1].clip(min=0)].where(codes[:, 1] >= 0)
+        frame = pd.DataFrame(flows.transpose(1, 0, 2).reshape(-1, len(categories)),
+                             columns=[f'od_{name}' for name in categories])
+        frame['zone'] = np.repeat(origin_zone, len(labels))
+        frame['time_bin'] = np.tile(labels, n_od_zones)
+        frame = frame.dropna(subset=['zone']).groupby(['zone', 'time_bin'], sort=False).sum()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            shares = frame.to_numpy() / frame.to_numpy().sum(axis=1, keepdims=True)
+        return pd.DataFrame(np.nan_to_num(shares), index=frame.index, columns=frame.columns)
+
+'''
+    Sum of the OD matrices saved for several months (e.g. a year), as one in-memory matrix.
+'''
+def merge_od_files(paths: list) -> ODMatrix:
+    total = None
+    for path in paths:
+        od = ODMatrix.load(path)
+        total = ODMatrix(np.array(od.values), od.by) if total is None else total.merge(od)
+    return total
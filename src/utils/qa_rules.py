@@ -1,94 +1,275 @@
+import time
 import pandas as pd
 import numpy as np
 
-'''
-    This function returns a mask pandas Dataframe of all values in 1 month data, 1 is violated the rule, 0 is otherwise.
+from src.utils.fingerprint import trip_fingerprints
+from src.utils.instrumentation import instrumented
+
+qa_year = 2021
 
 '''
-def run_quality_check(df: pd.DataFrame, current_month: int) -> pd.DataFrame:
-    qa_flags = pd.DataFrame(index=df.index)
-    
-    # Rule 1: Duplicated rows -> Action: Exclude
-    qa_flags['is_duplicate'] = df.duplicated()
+    QA rules as data: (ID, name, expression, action).
+    An expression is a NumPy expression over the inputs of qa_columns and qa_frame_inputs, the shared terms
+    of qa_terms and the constants month_start / month_end (bounds of the checked month) and valid_ratecodes.
+    Exclude removes the row in clean(), Flag only marks it.
+'''
+qa_rules = [
+    # Rule 1: Duplicated rows (same trip fingerprint as an earlier row)
+    (1, 'is_duplicate', 'duplicated', 'Exclude'),
 
     # RULES RELATED TO DATETIME AND TRIP LOGIC
-    # Rule 2: Missing pickup or dropoff datetime -> Action: Exclude
-    qa_flags['missing_datetime'] = df['tpep_pickup_datetime'].isna() | df['tpep_dropoff_datetime'].isna()
+    # Rule 2: Missing pickup or dropoff datetime
+    (2, 'missing_datetime', 'isnat(pickup) | isnat(dropoff)', 'Exclude'),
+    # Rule 3: Drop off before pick up
+    (3, 'invalid_time_order', 'dropoff < pickup', 'Exclude'),
+    # Rule 4: Invalid month, year (a missing pickup is outside the month too)
+    (4, 'invalid_month', '~pickup_in_month', 'Exclude'),
 
-    # Rule 3: Drop off before pick up -> Action: Exclude
-    qa_flags['invalid_time_order'] = df["tpep_dropoff_datetime"] < df["tpep_pickup_datetime"]
+    # RULES RELATED TO TRIP FEATURES
+    # Rule 5: Duration is negative
+    (5, 'invalid_duration', 'duration <= 0', 'Exclude'),
+    # Rule 6: Distance is negative
+    (6, 'invalid_distance', 'distance <= 0', 'Exclude'),
+    # Rule 7: Speed is negative
+    (7, 'invalid_speed', 'speed <= 0', 'Exclude'),
+    # Rule 8: Zero fare but distance > 0
+    (8, 'suspicious_zero_fare', '(fare == 0) & (distance > 0)', 'Flag'),
+    # Rule 9: Very short duration but nontrivial distance
+    (9, 'short_duration_long_distance', '(duration < 1) & (distance > 1)', 'Flag'),
+    # Rule 10: Excessive average speed
+    (10, 'excessive_speed', 'speed > 66', 'Flag'),
+    # Rule 11: Excessive duration (more than 24 hours)
+    (11, 'excessive_duration', 'duration > 24 * 60', 'Flag'),
 
-    # Rule 4: Invalid month, year -> Action: Exclude 
-    qa_flags['invalid_month'] = (df['tpep_pickup_datetime'].dt.month != current_month) | (df['tpep_pickup_datetime'].dt.year != 2021)
+    # RULES RELATED TO PAYMENT AND AMOUNTS
+    # Rule 12: Negative fare amount
+    (12, 'invalid_fare_amount', 'fare < 0', 'Flag'),
+    # Rule 13: Negative tip amount
+    (13, 'invalid_tip_amount', 'tip < 0', 'Flag'),
+    # Rule 14: Negative extra amount
+    (14, 'invalid_extra', 'extra < 0', 'Flag'),
+    # Rule 15: Negative tolls amount
+    (15, 'invalid_tolls_amount', 'tolls < 0', 'Flag'),
+    # Rule 16: Negative total amount
+    (16, 'invalid_total_amount', 'total <= 0', 'Flag'),
+    # Rule 17: Fare/amount arithmetic mismatch (missing total counts as 0)
+    (17, 'fare_total_mismatch', 'abs(total_or_zero - computed_total) > 1.0', 'Flag'),
+    # Rule 18: Invalid payment type (not in range [0,6])
+    (18, 'invalid_payment_type', '(payment_type < 0) | (payment_type > 6)', 'Flag'),
+    # Rule 19: Invalid RatecodeID
+    (19, 'invalid_ratecode', '~isin(ratecode, valid_ratecodes)', 'Flag'),
+    # Rule 20: Unusual passenger counts
+    (20, 'unusual_passenger_count', '(passengers == 0) | (passengers > 5)', 'Flag'),
+    # Rule 21: Zone ID does not exist
+    (21, 'invalid_zone', 'zone_missing', 'Flag'),
+]
 
-    # RULES RELATED TO TRIP FEATURES
-    # Rule 5: Duration is negative -> Action: Exclude
-    qa_flags['invalid_duration'] = df['trip_duration_minutes'] <= 0
+# Rules in the order of the QA report, rule ID i is rule_names[i - 1]
+rule_names = [name for _, name, _, _ in qa_rules]
+# Rules 1-7 remove the row, the others only flag it
+rule_actions = [action for _, _, _, action in qa_rules]
 
-    # Rule 6: Distance is negative -> Action: Exclude 
-    qa_flags['invalid_distance'] = df["trip_distance"] <= 0
+# Expression inputs read from the normalized columns (missing values are NaN / NaT, so comparisons are False)
+qa_columns = {
+    'pickup': 'tpep_pickup_datetime', 'dropoff': 'tpep_dropoff_datetime',
+    'duration': 'trip_duration_minutes', 'distance': 'trip_distance', 'speed': 'avg_speed_mph',
+    'fare': 'fare_amount', 'tip': 'tip_amount', 'extra': 'extra', 'tolls': 'tolls_amount',
+    'total': 'total_amount', 'computed_total': 'computed_total_amount',
+    'payment_type': 'payment_type', 'ratecode': 'RatecodeID', 'passengers': 'passenger_count',
+}
+# Expression inputs that need the whole frame, computed once before the chunks
+qa_frame_inputs = {
+    'duplicated': lambda df: pd.Series(trip_fingerprints(df)).duplicated().to_numpy(),
+    'zone_missing': lambda df: df[['PU_Borough', 'PU_Zone', 'DO_Borough', 'DO_Zone']].isna().any(axis=1).to_numpy(),
+}
+# Shared sub-expressions, computed once per chunk and only if a selected rule uses them
+qa_terms = {
+    'pickup_in_month': '(pickup >= month_start) & (pickup < month_end)',
+    'total_or_zero': 'nan_to_num(total)',
+}
+qa_functions = {'isnat': np.isnat, 'isin': np.isin, 'abs': np.abs, 'nan_to_num': np.nan_to_num}
 
-    # Rule 7: Speed is negative -> Action: Exclude
-    qa_flags['invalid_speed'] = df['avg_speed_mph'] <= 0
+# Packed flags: one uint32 per row in the column 'qa_bits', rule ID i is bit i - 1,
+# clean() stores is_garbage_row in the bit after the last rule
+packed_column = 'qa_bits'
+rule_bits = {name: i for i, name in enumerate(rule_names)}
+rule_bits['is_garbage_row'] = len(rule_names)
 
-    # Rule 8: Zero fare but distance > 0 -> Action: Flag (suspicious)
-    qa_flags['suspicious_zero_fare'] = (df['fare_amount'] == 0) & (df['trip_distance'] > 0)
+'''
+    Empty QA report with the ID, Rule and Action columns, one row per rule plus the "Total:" row.
+    Each processed month adds its summarize_qa_flags series as a column.
+'''
+def qa_report_frame() -> pd.DataFrame:
+    rule_definition = {
+        'ID': list(range(1, len(rule_names) + 1)) + ['NaN'],
+        'Rule': rule_names + ['NaN'],
+        'Action': rule_actions + ['Total:'],
+    }
+    return pd.DataFrame(data = rule_definition, columns=['ID', 'Rule', 'Action'])
 
-    # Rule 9: Very short duration but nontrivial distance -> Action: Flag
-    qa_flags['short_duration_long_distance'] = (df['trip_duration_minutes'] < 1) & (df['trip_distance'] > 1)
+'''
+    Packs a frame of boolean flags (the output of run_quality_check or clean) into one uint32 bitmask per row.
+    Returns a one-column frame ('qa_bits') with the same index; other columns such as total_violations are dropped,
+    the count of violated rules of a row is np.bitwise_count(qa_bits & rule_mask(rules)).
+'''
+@instrumented
+def pack_flags(qa_flags: pd.DataFrame) -> pd.DataFrame:
+    bits = np.zeros(len(qa_flags), dtype=np.uint32)
+    for name in qa_flags.columns:
+        if name in rule_bits:
+            bits |= qa_flags[name].to_numpy(dtype=bool).astype(np.uint32) << np.uint32(rule_bits[name])
+    return pd.DataFrame({packed_column: bits}, index=qa_flags.index)
 
-    # Rule 10: Excessive average speed -> Action: Flag
-    qa_flags['excessive_speed'] = df['avg_speed_mph'] > 66
+'''
+    Inverse of pack_flags: boolean columns for the given rules (all rules by default).
+'''
+@instrumented
+def unpack_flags(packed: pd.DataFrame, rules: list = None) -> pd.DataFrame:
+    bits = packed[packed_column].to_numpy()
+    rules = rule_names if rules is None else rules
+    return pd.DataFrame({name: (bits >> np.uint32(rule_bits[name])) & 1 == 1 for name in rules}, index=packed.index)
 
-    # Rule 11: Excessive duration (more than 24 hours) -> Action: Flag
-    qa_flags['excessive_duration'] = df['trip_duration_minutes'] > (24 * 60)
+def is_packed(qa_flags: pd.DataFrame) -> bool:
+    return packed_column in qa_flags.columns
 
-    # RULES RELATED TO PAYMENT AND AMOUNTS
-    # Rule 12: Negative fare amount -> Action: Flag
-    qa_flags['invalid_fare_amount'] = df['fare_amount'] < 0
+'''
+    Bitmask with the bits of the given rules set.
+'''
+def rule_mask(rules: list) -> np.uint32:
+    mask = 0
+    for name in rules:
+        mask |= 1 << rule_bits[name]
+    return np.uint32(mask)
 
-    # Rule 13: Negative tip amount -> Action: Flag
-    qa_flags['invalid_tip_amount'] = df['tip_amount'] < 0
-    
-    # Rule 14: Negative extra amount -> Action: Flag
-    qa_flags['invalid_extra'] = df['extra'] < 0
+'''
+    Row mask of the rows that violate at least one of the given rules.
+    Works on both boolean and packed flags; on packed flags it is a single bitwise AND,
+    e.g. ~violated(qa_flags, ['suspicious_zero_fare', 'short_duration_long_distance']) keeps the rows that violate neither.
+'''
+def violated(qa_flags: pd.DataFrame, rules: list) -> pd.Series:
+    if is_packed(qa_flags):
+        return pd.Series((qa_flags[packed_column].to_numpy() & rule_mask(rules)) != 0, index=qa_flags.index)
+    return qa_flags[rules].any(axis=1)
+
+'''
+    Boolean columns of the given rules, from boolean or packed flags.
+'''
+def flag_frame(qa_flags: pd.DataFrame, rules: list) -> pd.DataFrame:
+    if is_packed(qa_flags):
+        return unpack_flags(qa_flags, rules)
+    return qa_flags[rules]
+
+'''
+    Column as a NumPy array for the rule expressions, without a copy where possible:
+    tz-aware datetimes as UTC datetime64 (missing = NaT), nullable ints as float64 (missing = NaN).
+'''
+def column_values(column: pd.Series) -> np.ndarray:
+    if isinstance(column.dtype, pd.DatetimeTZDtype):
+        return column.dt.tz_convert(None).to_numpy()
+    if isinstance(column.dtype, pd.api.extensions.ExtensionDtype):
+        return column.to_numpy(dtype='float64', na_value=np.nan)
+    return column.to_numpy()
 
-    # Rule 15: Negative tolls amount -> Action: Flag
-    qa_flags['invalid_tolls_amount'] = df['tolls_amount'] < 0
+'''
+    Compiles the rule expressions once and evaluates them in one fused pass over the frame, chunk by chunk:
+    every input and shared term is prepared once per chunk for all rules, and the temporaries stay chunk sized.
+    rules defaults to qa_rules; a subset (e.g. a new or tuned rule) evaluates only the inputs it needs.
+'''
+class QAEngine:
+    def __init__(self, rules: list = None):
+        self.rules = qa_rules if rules is None else rules
+        self.codes = [compile(expression, f'<rule {rule_id}: {name}>', 'eval') for rule_id, name, expression, _ in self.rules]
 
-    # Rule 16: Negative total amount -> Action: Flag
-    qa_flags['invalid_total_amount'] = df['total_amount'] <= 0
+        # Shared terms and inputs used by the selected rules
+        used = set()
+        for code in self.codes:
+            used.update(code.co_names)
+        self.terms = {name: compile(expression, f'<term {name}>', 'eval') for name, expression in qa_terms.items() if name in used}
+        for code in self.terms.values():
+            used.update(code.co_names)
+        self.columns = [name for name in qa_columns if name in used]
+        self.frame_inputs = [name for name in qa_frame_inputs if name in used]
 
-    # Rule 17: Fare/amount arithmetic mismatch -> Action: Flag
-    qa_flags['fare_total_mismatch'] = (df['total_amount'].fillna(0) - df['computed_total_amount']).abs() > 1.0
+    '''
+        Returns the boolean flags (one column per rule) and a frame with the rows hit and the seconds spent per rule.
+        Time spent on whole-frame inputs and shared terms is reported in extra rows (Action 'Input').
+        inputs can hold precomputed whole-frame inputs, e.g. duplicated tracked across batches.
+        year is the year of the checked month (bounds of rule 4).
+    '''
+    def evaluate(self, df: pd.DataFrame, current_month: int, inputs: dict = None, chunk_size: int = 1_000_000,
+                 year: int = qa_year) -> tuple:
+        n = len(df)
+        month_start = pd.Timestamp(year, current_month, 1, tz='America/New_York')
+        month_end = month_start + pd.offsets.MonthBegin(1)
+        constants = {
+            'month_start': month_start.tz_convert(None).to_datetime64(),
+            'month_end': month_end.tz_convert(None).to_datetime64(),
+            'valid_ratecodes': [1, 2, 3, 4, 5, 6, 99],
+        }
+        seconds = {}
 
-    # Rule 18: Invalid payment type (not in range [0,6]) -> Action: Flag
-    qa_flags['invalid_payment_type'] = (df['payment_type'] < 0) | (df['payment_type'] > 6)
+        inputs = dict(inputs or {})
+        for name in self.frame_inputs:
+            if name not in inputs:
+                start = time.perf_counter()
+                inputs[name] = qa_frame_inputs[name](df)
+                seconds[name] = time.perf_counter() - start
+        for name in self.columns:
+            inputs[name] = column_values(df[qa_columns[name]])
 
-    # Rule 19: Invalid RatecodeID -> Action: Flag
-    qa_flags['invalid_ratecode'] = ~df['RatecodeID'].isin([1,2,3,4,5,6,99])
+        flags = np.empty((len(self.rules), n), dtype=bool)
+        rule_seconds = np.zeros(len(self.rules))
+        for chunk_start in range(0, n, chunk_size):
+            chunk = slice(chunk_start, min(chunk_start + chunk_size, n))
+            namespace = {**qa_functions, **constants}
+            for name in self.frame_inputs + self.columns:
+                namespace[name] = inputs[name][chunk]
 
-    # Rule 20: Unusual passenger counts -> Action: Flag
-    qa_flags['unusual_passenger_count'] = (df['passenger_count'] == 0 ) | (df['passenger_count'] > 5)
+            for name, code in self.terms.items():
+                start = time.perf_counter()
+                namespace[name] = eval(code, {'__builtins__': {}}, namespace)
+                seconds[name] = seconds.get(name, 0.0) + time.perf_counter() - start
 
-    # Rule 21: Zone ID does not exist -> Action: Flag
-    qa_flags['invalid_zone'] = df[['PU_Borough', 'PU_Zone', 'DO_Borough', 'DO_Zone']].isna().any(axis = 1)
+            for i, code in enumerate(self.codes):
+                start = time.perf_counter()
+                flags[i, chunk] = eval(code, {'__builtins__': {}}, namespace)
+                rule_seconds[i] += time.perf_counter() - start
 
-    return qa_flags
+        qa_flags = pd.DataFrame({name: flags[i] for i, (_, name, _, _) in enumerate(self.rules)}, index=df.index)
+        rule_stats = pd.DataFrame({
+            'ID': [rule_id for rule_id, _, _, _ in self.rules] + ['NaN'] * len(seconds),
+            'Rule': [name for _, name, _, _ in self.rules] + list(seconds),
+            'Action': [action for _, _, _, action in self.rules] + ['Input'] * len(seconds),
+            'rows_hit': list(flags.sum(axis=1)) + [np.nan] * len(seconds),
+            'seconds': list(rule_seconds) + list(seconds.values()),
+        })
+        return qa_flags, rule_stats
 
 '''
-    This function summarizes qa_flags into a pandas Series (format: "count/pct%").
-    - The first 22 entries summarize violations for each individual rule.
-    - The 23th entry (Total) summarizes the count of *unique trips* (rows) 
-    that violated *at least one* rule.
+    Evaluates the QA rules (all of qa_rules by default) and returns (qa_flags, rule_stats), see QAEngine.evaluate.
+    To add or tune a rule, evaluate only that rule and assign its column to the existing flags.
 '''
-def summarize_qa_flags(qa_flags: pd.DataFrame):
+@instrumented
+def evaluate_rules(df: pd.DataFrame, current_month: int, rules: list = None, inputs: dict = None,
+                   chunk_size: int = 1_000_000, year: int = qa_year) -> tuple:
+    return QAEngine(rules).evaluate(df, current_month, inputs=inputs, chunk_size=chunk_size, year=year)
 
-    total_records = len(qa_flags)
-    
-    # Violations per rule
-    violations_per_rule = qa_flags.sum()
-    
+'''
+    This function returns a mask pandas Dataframe of all values in 1 month data, 1 is violated the rule, 0 is otherwise.
+    The rules are the qa_rules table evaluated by QAEngine; duplicated can be given precomputed
+    (the streaming path tracks duplicates across batches). year is the year of current_month.
+'''
+@instrumented
+def run_quality_check(df: pd.DataFrame, current_month: int, duplicated: np.ndarray = None, year: int = qa_year) -> pd.DataFrame:
+    inputs = None if duplicated is None else {'duplicated': duplicated}
+    qa_flags, _ = evaluate_rules(df, current_month, inputs=inputs, year=year)
+    return qa_flags
+
+'''
+    Formats per-rule violation counts into the QA report column (format: "count/pct%"),
+    followed by the count of rows that violated at least one rule.
+'''
+def format_qa_summary(violations_per_rule: pd.Series, total_violated_rows, total_records: int) -> pd.Series:
     # Percentage of each in total
     percent_per_rule = (violations_per_rule / total_records * 100).round(2)
     
@@ -100,13 +281,91 @@ def summarize_qa_flags(qa_flags: pd.DataFrame):
         final_list.append(f"{count}/{pct}%")
 
     # Count all row that has violations
-    total_violated_rows = qa_flags.any(axis=1).sum()
     total_violated_percent = (total_violated_rows / total_records * 100).round(3)
     total_string = f"{total_violated_rows}/{total_violated_percent}%"
     
     final_list.append(total_string)
+    return pd.Series(final_list)
+
+'''
+    Garbage threshold from a histogram of violations per row (histogram[k] = rows with k violations).
+    Same value as the 95th percentile (linear interpolation, truncated to int) of the per-row totals,
+    without holding the totals themselves.
+'''
+def violation_threshold(histogram: np.ndarray, q: float = 0.95) -> int:
+    total_records = int(histogram.sum())
+    if total_records == 0:
+        return 0
+    cumulative = np.cumsum(histogram)
+    position = q * (total_records - 1)
+    lower = np.floor(position)
+    # Value of the sorted per-row totals at rank lower and lower + 1
+    lower_value = np.searchsorted(cumulative, lower, side='right')
+    upper_value = np.searchsorted(cumulative, min(lower + 1, total_records - 1), side='right')
+    return int(lower_value + (upper_value - lower_value) * (position - lower))
 
-    # Calulate threshold for garbage rows
-    qa_flags['total_violations'] = qa_flags.sum(axis=1)
-    threshold = qa_flags['total_violations'].quantile(0.95).astype(int)
-    return pd.Series(final_list), threshold
\ No newline at end of file
+'''
+    Mergeable summary of QA flags: per-rule violation counts and the exact histogram of violations per row
+    (histogram[k] = rows that violate k of the rules), which also gives the row count and the rows with any violation.
+    update() takes chunks of boolean or packed flags, merge() adds the accumulator of another chunk, month or
+    worker process, so the "count/pct%" series and the garbage threshold never need all flags at once.
+'''
+class QASummaryAccumulator:
+    def __init__(self, rules: list = None):
+        self.rules = list(rule_names if rules is None else rules)
+        self.rule_counts = np.zeros(len(self.rules), dtype=np.int64)
+        self.histogram = np.zeros(len(self.rules) + 1, dtype=np.int64)
+
+    @property
+    def rows(self) -> int:
+        return int(self.histogram.sum())
+
+    def update(self, qa_flags: pd.DataFrame) -> 'QASummaryAccumulator':
+        if is_packed(qa_flags):
+            bits = qa_flags[packed_column].to_numpy()
+            self.rule_counts += [np.count_nonzero(bits & rule_mask([name])) for name in self.rules]
+            per_row = np.bitwise_count(bits & rule_mask(self.rules))
+        else:
+            flags = qa_flags[self.rules].to_numpy(dtype=bool)
+            self.rule_counts += flags.sum(axis=0)
+            per_row = flags.sum(axis=1)
+        self.histogram += np.bincount(per_row, minlength=len(self.histogram))
+        return self
+
+    def merge(self, other: 'QASummaryAccumulator') -> 'QASummaryAccumulator':
+        if other.rules != self.rules:
+            raise ValueError('Cannot merge QA summaries of different rules')
+        self.rule_counts += other.rule_counts
+        self.histogram += other.histogram
+        return self
+
+    def summary(self) -> pd.Series:
+        violations_per_rule = pd.Series(self.rule_counts, index=self.rules)
+        return format_qa_summary(violations_per_rule, self.histogram[1:].sum(), self.rows)
+
+    def threshold(self, q: float = 0.95) -> int:
+        return violation_threshold(self.histogram, q)
+
+    def to_dict(self) -> dict:
+        return {'rules': self.rules, 'rule_counts': self.rule_counts.tolist(), 'histogram': self.histogram.tolist()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'QASummaryAccumulator':
+        accumulator = cls(data['rules'])
+        accumulator.rule_counts[:] = data['rule_counts']
+        accumulator.histogram[:] = data['histogram']
+        return accumulator
+
+'''
+    This function summarizes qa_flags into a pandas Series (format: "count/pct%").
+    - The first 22 entries summarize violations for each individual rule.
+    - The 23th entry (Total) summarizes the count of *unique trips* (rows) 
+    that violated *at least one* rule.
+    Also returns the garbage threshold (95th percentile of violations per row); qa_flags is not modified.
+'''
+@instrumented
+def summarize_qa_flags(qa_flags: pd.DataFrame):
+    rules = None if is_packed(qa_flags) else [name for name in qa_flags.columns if name in rule_names]
+    accumulator = QASummaryAccumulator(rules)
+    accumulator.update(qa_flags)
+    return accumulator.summary(), accumulator.threshold()
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import pandas as pd
+import matplotlib.pyplot as plt
+
+from src.utils import figure_data, visualization
+from src.utils.build_cache import code_version
+from src.utils.figure_data import FigureData, figure_parts
+from src.utils.visualization import (visualize_summary, visualize_customer_segments, visualize_temporal_trends,
+                                     visualize_trip_characteristics, visualize_geographical_analysis)
+
+'''
+    Headless export of the monthly charts: every (month, plot type) is one task of a process pool whose workers
+    use the non-interactive Agg backend, and figures are saved by the names the visualize_* functions return.
+    A plot type is skipped when the hash of its figure data (frames, label, dpi and plotting code) is the one
+    recorded in figure_hashes.json of the output folder and its files exist.
+
+    Usage:
+        render_all([(FigureData.load('processed/figure_data/figure_data_2021-01'), 'figures/January_figures')], dpi=300)
+'''
+figure_functions = {
+    'summary': visualize_summary,
+    'customer_segments': visualize_customer_segments,
+    'temporal_trends': visualize_temporal_trends,
+    'trip_characteristics': visualize_trip_characteristics,
+    'geographical_analysis': visualize_geographical_analysis,
+}
+
+# Names of the figures of every plot type (file names without .png), as returned by the functions
+figure_names = {
+    'summary': ['revenue_per_day', 'trips_per_day', 'trips_per_week_heatmap'],
+    'customer_segments': ['payment_type_distribution', 'daily_group_ride_demand', 'tip_correlation_matrix'],
+    'temporal_trends': ['avg_speed_per_hour', 'trips_per_hour', 'revenue_per_hour'],
+    'trip_characteristics': ['trip_distance_distribution', 'trip_duration_distribution'],
+    'geographical_analysis': ['top10_pickup_zones', 'top10_dropoff_zones'],
+}
+hash_file = 'figure_hashes.json'
+preview_folder = 'previews'
+
+'''
+    Saves named figures as <name>.png, and as a JPEG preview at preview_dpi in previews/ if given, then closes them.
+'''
+def save_figures(figures: dict, folder, dpi: int = 300, preview_dpi: int = None) -> list:
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for name, fig in figures.items():
+        fig.savefig(folder / f"{name}.png", dpi=dpi, bbox_inches='tight')
+        paths.append(folder / f"{name}.png")
+        if preview_dpi is not None:
+            (folder / preview_folder).mkdir(exist_ok=True)
+            fig.savefig(folder / preview_folder / f"{name}.jpg", dpi=preview_dpi, bbox_inches='tight',
+                        pil_kwargs={'quality': 70, 'optimize': True})
+            paths.append(folder / preview_folder / f"{name}.jpg")
+        plt.close(fig)
+    return paths
+
+'''
+    Hash of everything a plot type is drawn from: its frames of the figure data, the label, the resolutions and the code.
+'''
+def figure_hash(data: FigureData, part: str, dpi: int, preview_dpi: int = None) -> str:
+    digest = hashlib.sha256()
+    digest.update(json.dumps([code_version(figure_data, visualization), data.label, data.months, dpi, preview_dpi]).encode())
+    for name in figure_parts[part]:
+        if name in data.frames:
+            frame = data.frames[name]
+            digest.update(name.encode())
+            digest.update(json.dumps([str(c) for c in frame.columns]).encode())
+            digest.update(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+    return digest.hexdigest()
+
+def use_agg() -> None:
+    plt.switch_backend('Agg')
+
+'''
+    Draws and saves the figures of one plot type. Executed in a worker process (or in this one with workers=1).
+'''
+def render_part(data: FigureData, part: str, folder, dpi: int, preview_dpi: int = None) -> list:
+    return save_figures(figure_functions[part](data), folder, dpi, preview_dpi)
+
+'''
+    Renders every plot type of every (figure data, output folder) job, stale ones only, in parallel worker processes.
+    Jobs may give the figure data as a FigureData or as the folder it was saved to.
+    Returns the number of rendered and skipped plot types.
+'''
+def render_all(jobs: list, dpi: int = 300, preview_dpi: int = None, workers: int = None, force: bool = False,
+               parts: list = None) -> dict:
+    tasks, hashes = [], {}
+    skipped = 0
+    for data, folder in jobs:
+        data = data if isinstance(data, FigureData) else FigureData.load(data)
+        folder = Path(folder)
+        recorded = {}
+        if (folder / hash_file).exists():
+            with open(folder / hash_file) as f:
+                recorded = json.load(f)
+        hashes[folder] = dict(recorded)
+        for part in parts or figure_functions:
+            key = figure_hash(data, part, dpi, preview_dpi)
+            outputs = [folder / f"{name}.png" for name in figure_names[part]]
+            if preview_dpi is not None:
+                outputs += [folder / preview_folder / f"{name}.jpg" for name in figure_names[part]]
+            if not force and recorded.get(part) == key and all(p.exists() for p in outputs):
+                skipped += 1
+                continue
+            tasks.append((data, part, folder, key))
+
+    workers = workers or min(len(tasks), os.cpu_count() or 1)
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers, initializer=use_agg) as pool:
+            futures = [pool.submit(render_part, data, part, folder, dpi, preview_dpi) for data, part, folder, _ in tasks]
+            for future in futures:
+                future.result()
+    else:
+        for data, part, folder, _ in tasks:
+            render_part(data, part, folder, dpi, preview_dpi)
+
+    # Hashes are only written once the figures are saved
+    for _, part, folder, key in tasks:
+        hashes[folder][part] = key
+    for folder, recorded in hashes.items():
+        if recorded:
+            with open(folder / hash_file, 'w') as f:
+                json.dump(recorded, f, indent=1, sort_keys=True)
+    return {'rendered': len(tasks), 'skipped': skipped}
@@ -0,0 +1,130 @@
+import struct
+import numpy as np
+
+'''
+    Mergeable quantile sketch with relative-error buckets (DDSketch).
+
+    A value x > 0 is counted in bucket i = ceil(log(x) / log(gamma)) with gamma = (1 + a) / (1 - a),
+    where a is the relative accuracy; negative values use the same buckets on -x and zeros have their own count.
+    Every bucket covers (gamma^(i-1), gamma^i] and answers with 2 * gamma^i / (gamma + 1), so
+
+        |value_at_rank(k) - x_k| <= a * |x_k|   with x_k the value of rank k of the added values,
+
+    and quantile(q), interpolated like np.quantile between two ranks, is within a of np.quantile(values, q)
+    when the values have the same sign.
+
+    The bound holds after any number of merges, because merging only adds bucket counts: a sketch of a week is
+    exactly the sketch of its days. Memory grows with log(max / min) / a, not with the number of values
+    (about 700 buckets at a = 1% for values between 0.01 and 10000).
+'''
+class QuantileSketch:
+    def __init__(self, relative_accuracy: float = 0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        # Bucket counts of the positive and of the negative values, bucket i at counts[i - offset]
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.negative_offset = 0
+        self.negative_counts = np.zeros(0, dtype=np.int64)
+        self.zero_count = 0
+
+    @property
+    def count(self) -> int:
+        return int(self.counts.sum() + self.negative_counts.sum() + self.zero_count)
+
+    def bucket(self, values: np.ndarray) -> np.ndarray:
+        return np.ceil(np.log(values) / self.log_gamma).astype(np.int64)
+
+    def bucket_value(self, index: int) -> float:
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    '''
+        Adds an array of values at once (NaN values are ignored).
+    '''
+    def add(self, values) -> 'QuantileSketch':
+        values = np.asarray(values, dtype='float64')
+        values = values[~np.isnan(values)]
+        self.zero_count += int(np.count_nonzero(values == 0))
+        self.offset, self.counts = merge_buckets(self.offset, self.counts, *bucket_counts(self.bucket(values[values > 0])))
+        self.negative_offset, self.negative_counts = merge_buckets(self.negative_offset, self.negative_counts,
+                                                                   *bucket_counts(self.bucket(-values[values < 0])))
+        return self
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError('Cannot merge sketches with different relative accuracy')
+        self.offset, self.counts = merge_buckets(self.offset, self.counts, other.offset, other.counts)
+        self.negative_offset, self.negative_counts = merge_buckets(self.negative_offset, self.negative_counts,
+                                                                   other.negative_offset, other.negative_counts)
+        self.zero_count += other.zero_count
+        return self
+
+    '''
+        Value of rank k within the relative accuracy.
+    '''
+    def value_at_rank(self, rank: int) -> float:
+        # Negative values from the most negative (largest bucket of -x) up, then zeros, then positive values
+        negative = self.negative_counts[::-1]
+        if rank < negative.sum():
+            i = np.searchsorted(np.cumsum(negative), rank, side='right')
+            return -self.bucket_value(self.negative_offset + len(negative) - 1 - i)
+        rank -= negative.sum()
+        if rank < self.zero_count:
+            return 0.0
+        rank -= self.zero_count
+        i = np.searchsorted(np.cumsum(self.counts), rank, side='right')
+        return self.bucket_value(self.offset + i)
+
+    '''
+        Quantile with the linear interpolation of np.quantile between the values of rank floor(q * (n - 1))
+        and the next one, NaN for an empty sketch.
+    '''
+    def quantile(self, q: float) -> float:
+        n = self.count
+        if n == 0:
+            return np.nan
+        position = q * (n - 1)
+        rank = int(np.floor(position))
+        low = self.value_at_rank(rank)
+        if rank + 1 >= n:
+            return low
+        return low + (self.value_at_rank(rank + 1) - low) * (position - rank)
+
+    def to_bytes(self) -> bytes:
+        header = struct.pack('<dqqqq', self.relative_accuracy, self.zero_count, self.offset, len(self.counts), self.negative_offset)
+        return header + self.counts.astype('<i8').tobytes() + self.negative_counts.astype('<i8').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'QuantileSketch':
+        header_size = struct.calcsize('<dqqqq')
+        relative_accuracy, zero_count, offset, n_counts, negative_offset = struct.unpack('<dqqqq', data[:header_size])
+        counts = np.frombuffer(data[header_size:], dtype='<i8')
+        sketch = cls(relative_accuracy)
+        sketch.zero_count = zero_count
+        sketch.offset, sketch.counts = offset, counts[:n_counts].astype(np.int64)
+        sketch.negative_offset, sketch.negative_counts = negative_offset, counts[n_counts:].astype(np.int64)
+        return sketch
+
+'''
+    Dense counts of bucket indexes: (offset, counts) with counts[i] the number of index offset + i.
+'''
+def bucket_counts(indexes: np.ndarray) -> tuple:
+    if len(indexes) == 0:
+        return 0, np.zeros(0, dtype=np.int64)
+    offset = int(indexes.min())
+    return offset, np.bincount(indexes - offset).astype(np.int64)
+
+'''
+    Sum of two dense bucket arrays with different offsets.
+'''
+def merge_buckets(offset: int, counts: np.ndarray, other_offset: int, other_counts: np.ndarray) -> tuple:
+    if len(other_counts) == 0:
+        return offset, counts
+    if len(counts) == 0:
+        return other_offset, other_counts.copy()
+    start = min(offset, other_offset)
+    merged = np.zeros(max(offset + len(counts), other_offset + len(other_counts)) - start, dtype=np.int64)
+    merged[offset - start:offset - start + len(counts)] += counts
+    merged[other_offset - start:other_offset - start + len(other_counts)] += other_counts
+    return start, merged
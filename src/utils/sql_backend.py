@@ -0,0 +1,208 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.utils.normalizing import day_names
+from src.utils.qa_rules import packed_column, rule_bits
+from src.utils.kpi import (kpi_inputs, quantile_inputs, kpi_frequencies, bin, labels,
+                           period_codes, period_frame, finish_kpi_frame)
+
+# Optional dependency: only needed for this backend
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+'''
+    Out-of-core SQL backend (DuckDB) over the processed parquet files, for full-year and multi-year KPIs
+    on machines with less memory than one month in pandas. The cleaned files and their flag files
+    (boolean or packed) are scanned in parallel and never loaded as a whole; only the per-day
+    and per-period aggregates come back to pandas, where the same period_frame as aggregate_kpis builds the frames.
+    Results are interchangeable with the pandas functions (same columns, dtypes and values up to float summation order).
+
+    Usage:
+        files = sorted(Path('processed/cleaned_data').glob('*.parquet'))
+        flags = sorted(Path('processed/flags_for_analysis').glob('*.parquet'))
+        kpis = sql_aggregate_kpis(files, flags, connect(memory_limit='2GB'))
+'''
+
+# Period label of the local pickup day d for each Grouper frequency, as in period_codes
+period_sql = {
+    'D': 'day',
+    'W': 'day + CAST(7 - isodow(day) AS INTEGER)',  # Sunday closing the week
+    'ME': 'last_day(day)',
+    'YE': 'make_date(year(day), 12, 31)',
+}
+
+'''
+    DuckDB connection with the given number of threads, memory limit (e.g. '2GB') and spill directory.
+'''
+def connect(threads: int = None, memory_limit: str = None, temp_directory: str = None):
+    if duckdb is None:
+        raise ImportError("The SQL backend needs duckdb (pip install duckdb)")
+    con = duckdb.connect()
+    con.execute("SET enable_progress_bar = false")
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    if memory_limit is not None:
+        con.execute(f"SET memory_limit = {sql_string(memory_limit)}")
+    if temp_directory is not None:
+        con.execute(f"SET temp_directory = {sql_string(temp_directory)}")
+    return con
+
+def sql_string(value) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+'''
+    Rows of every cleaned file next to the row of its flag file (the files are aligned row by row).
+'''
+def trips_sql(cleaned_files: list, flag_files: list = None) -> str:
+    if flag_files is None:
+        return ' UNION ALL '.join(f"SELECT * FROM read_parquet({sql_string(c)})" for c in cleaned_files)
+    if len(cleaned_files) != len(flag_files):
+        raise ValueError('Every cleaned file needs its flag file')
+    return ' UNION ALL '.join(f"SELECT * FROM read_parquet({sql_string(c)}) AS cleaned POSITIONAL JOIN read_parquet({sql_string(f)}) AS flags"
+                              for c, f in zip(cleaned_files, flag_files))
+
+'''
+    SQL condition that the row violates the rule, from the packed bits or the boolean flag column.
+'''
+def rule_sql(rule: str, packed: bool) -> str:
+    if packed:
+        return f'({packed_column} & {1 << rule_bits[rule]}) <> 0'
+    return f'"{rule}"'
+
+'''
+    Every KPI input of kpi_inputs as a DOUBLE column named after the input, NULL where its QA rules exclude the row.
+'''
+def masked_inputs_sql(packed: bool) -> list:
+    masked = []
+    for name, (column, rules) in kpi_inputs.items():
+        excluded = ' OR '.join(rule_sql(rule, packed) for rule in rules)
+        masked.append(f'CASE WHEN NOT ({excluded}) AND NOT isnan("{column}") THEN CAST("{column}" AS DOUBLE) END AS {name}')
+    return masked
+
+'''
+    Time bin (index in labels) of a local timestamp expression.
+'''
+def time_bin_sql(local_time: str) -> str:
+    cases = ' '.join(f"WHEN hour({local_time}) < {bin[i + 1]} THEN {i}" for i in range(len(labels)))
+    return f"CASE {cases} END"
+
+'''
+    Same dtype as the pandas path for a column read from parquet: categorical columns are stored as dictionaries.
+'''
+def like_source(values, field: pa.Field, categories):
+    if pa.types.is_dictionary(field.type):
+        return pd.Categorical(values, categories=categories)
+    return pd.array(np.asarray(values, dtype=object), dtype=object)
+
+'''
+    aggregate_kpis over any number of cleaned files and their flag files, in one SQL scan.
+    Weeks and months across files are complete (like aggregate_kpis on the concatenated months).
+'''
+def sql_aggregate_kpis(cleaned_files: list, flag_files: list, con=None) -> dict:
+    con = con or connect()
+    schema = pq.read_schema(cleaned_files[0])
+    tz = schema.field('tpep_pickup_datetime').type.tz
+    packed = packed_column in pq.read_schema(flag_files[0]).names
+
+    masked = masked_inputs_sql(packed)
+
+    # Every aggregate in every grouping set: the day rows feed period_frame, the period rows only give their quantiles
+    aggregates = ['count(*) AS day_trips', 'min(pickup) AS day_first_pickup',
+                  'arg_min(pickup_day_of_week, pickup) AS day_of_week']
+    for name in kpi_inputs:
+        aggregates += [f'coalesce(sum({name}), 0) AS {name}_sum', f'count({name}) AS {name}_count']
+    for side in ['pickup', 'dropoff']:
+        aggregates += [f'count(*) FILTER (WHERE {side}_bin = {i}) AS {side}_bin_{i}' for i in range(len(labels))]
+    for name, qs in quantile_inputs.items():
+        aggregates += [f'quantile_cont({name}, {q}) AS {name}_p{round(q * 100)}' for q in qs]
+
+    freqs = list(kpi_frequencies.values())
+    periods = ', '.join(f'{period_sql[freq]} AS "{freq}"' for freq in freqs)
+    query = f"""
+        WITH trips AS ({trips_sql(cleaned_files, flag_files)}),
+        local AS (
+            SELECT tpep_pickup_datetime AS pickup, pickup_day_of_week,
+                   timezone({sql_string(tz)}, tpep_pickup_datetime) AS pickup_local,
+                   timezone({sql_string(tz)}, tpep_dropoff_datetime) AS dropoff_local,
+                   {', '.join(masked)}
+            FROM trips WHERE tpep_pickup_datetime IS NOT NULL
+        ),
+        days AS (
+            SELECT *, CAST(pickup_local AS DATE) AS day,
+                   {time_bin_sql('pickup_local')} AS pickup_bin, {time_bin_sql('dropoff_local')} AS dropoff_bin
+            FROM local
+        ),
+        periods AS (SELECT *, {periods} FROM days)
+        SELECT {', '.join(f'"{freq}"' for freq in freqs)}, {', '.join(aggregates)}
+        FROM periods
+        GROUP BY GROUPING SETS ({', '.join(f'("{freq}")' for freq in freqs)})
+    """
+    rows = con.execute(query).fetchdf()
+
+    # Day rows (the 'D' grouping set) as in kpi_columns
+    daily = rows[rows['D'].notna()].sort_values('D', ignore_index=True)
+    days = pd.DatetimeIndex(pd.to_datetime(daily['D']))
+    day_values = {
+        'day_first_pickup': pd.to_datetime(daily['day_first_pickup'], utc=True).dt.tz_convert(tz).array,
+        'day_of_week': like_source(daily['day_of_week'], schema.field('pickup_day_of_week'), day_names),
+        'day_trips': daily['day_trips'].to_numpy(dtype=np.int64),
+        'pickup_bins': daily[[f'pickup_bin_{i}' for i in range(len(labels))]].to_numpy(dtype=np.int64),
+        'dropoff_bins': daily[[f'dropoff_bin_{i}' for i in range(len(labels))]].to_numpy(dtype=np.int64),
+    }
+    for name in kpi_inputs:
+        day_values[f'{name}_sum'] = daily[f'{name}_sum'].to_numpy(dtype='float64')
+        day_values[f'{name}_count'] = daily[f'{name}_count'].to_numpy(dtype='float64')
+
+    results = {}
+    for name, freq in kpi_frequencies.items():
+        day_codes, period_labels = period_codes(days, tz, freq)
+        # Quantiles of the period rows, empty periods stay NaN
+        period_rows = rows[rows[freq].notna()].set_index(pd.DatetimeIndex(pd.to_datetime(rows.loc[rows[freq].notna(), freq])))
+        period_rows = period_rows.reindex(period_labels.tz_localize(None))
+        quantiles = {f'{column}_p{round(q * 100)}': period_rows[f'{column}_p{round(q * 100)}'].to_numpy(dtype='float64')
+                     for column, qs in quantile_inputs.items() for q in qs}
+        kpi, per_hour = period_frame(day_values, day_codes, period_labels, quantiles)
+        results[name] = finish_kpi_frame(kpi, per_hour, name == 'Daily')
+    return results
+
+'''
+    compute_kpi_zone_time over any number of cleaned files and their flag files.
+'''
+def sql_kpi_zone_time(cleaned_files: list, flag_files: list, con=None) -> pd.DataFrame:
+    con = con or connect()
+    schema = pq.read_schema(cleaned_files[0])
+    tz = schema.field('tpep_pickup_datetime').type.tz
+    packed = packed_column in pq.read_schema(flag_files[0]).names
+    query = f"""
+        WITH trips AS ({trips_sql(cleaned_files, flag_files)}),
+        masked AS (
+            SELECT PU_Zone AS zone, {time_bin_sql(f'timezone({sql_string(tz)}, tpep_pickup_datetime)')} AS time_bin,
+                   {', '.join(masked_inputs_sql(packed))}
+            FROM trips
+            WHERE PU_Zone IS NOT NULL AND tpep_pickup_datetime IS NOT NULL
+        )
+        SELECT zone, time_bin,
+               quantile_cont(duration, 0.5) AS duration_p50, quantile_cont(duration, 0.95) AS duration_p95,
+               quantile_cont(speed, 0.5) AS speed_p50, avg(distance) AS avg_trip_distance, count(*) AS trips
+        FROM masked
+        GROUP BY ALL
+    """
+    rows = con.execute(query).fetchdf()
+
+    # Every (zone, time bin) pair of the zones seen, in zone name and time bin order
+    zones = sorted(rows['zone'].unique())
+    index = pd.MultiIndex.from_product([range(len(zones)), range(len(labels))], names=['zone', 'time_bin'])
+    rows['zone'] = pd.Index(zones).get_indexer(rows['zone'])
+    df_kpi = rows.set_index(['zone', 'time_bin']).reindex(index).reset_index()
+    df_kpi['zone'] = pd.Categorical.from_codes(df_kpi['zone'], categories=zones)
+    df_kpi['time_bin'] = pd.Categorical.from_codes(df_kpi['time_bin'], categories=labels, ordered=True)
+    df_kpi['trips'] = df_kpi['trips'].fillna(0).astype(np.int64)
+
+    # Compute trips_index_100: normalize trips to index 100
+    base_value = df_kpi['trips'].mean()
+    df_kpi['trips_index_100'] = (df_kpi['trips'] / base_value) * 100
+    return df_kpi
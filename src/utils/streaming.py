@@ -0,0 +1,126 @@
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.utils.normalizing import normalize
+from src.utils.fingerprint import trip_fingerprints
+from src.utils.qa_rules import qa_year, run_quality_check, pack_flags, QASummaryAccumulator
+from src.utils.cleaning import clean
+
+'''
+    Appends pandas frames to one parquet file batch by batch.
+    The schema is taken from the first frame; later frames are cast to it, so a batch where
+    a label column is all missing (arrow type null) still matches the string column of the file.
+'''
+class ParquetAppender:
+    def __init__(self, path):
+        self.path = path
+        self.writer = None
+        self.rows = 0
+
+    def append(self, df: pd.DataFrame) -> None:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.path, table.schema)
+        else:
+            table = table.cast(self.writer.schema)
+        self.writer.write_table(table)
+        self.rows += len(df)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+'''
+    Marks trips that were already seen, in this batch or in an earlier one, like rule 1 over the whole month.
+    Only a sorted array of the 64-bit trip fingerprints is kept between batches (8 bytes per row).
+'''
+class DuplicateTracker:
+    def __init__(self):
+        self.seen = np.empty(0, dtype=np.uint64)
+
+    def update(self, hashes: np.ndarray) -> np.ndarray:
+        duplicated = pd.Series(hashes).duplicated().to_numpy()
+        if len(self.seen) > 0:
+            pos = np.searchsorted(self.seen, hashes).clip(max=len(self.seen) - 1)
+            duplicated |= self.seen[pos] == hashes
+        self.seen = np.union1d(self.seen, hashes)
+        return duplicated
+
+'''
+    Streaming version of normalize -> run_quality_check -> summarize_qa_flags -> clean for one raw month.
+    The raw parquet is read in record batches of batch_size rows, so peak memory depends on batch_size, not on the month.
+    Pass 1 normalizes and checks each batch, spills it to a temporary parquet and adds its flags to a
+    QASummaryAccumulator (per-rule counts and histogram of violations per row for the garbage threshold).
+    Pass an accumulator to keep the month's summary, e.g. to merge it with other months.
+    Pass 2 re-reads the spilled batches, cleans them with the month threshold and appends them to cleaned_out / flag_out.
+    is_duplicate is computed across batch boundaries with DuplicateTracker. With a fingerprint_index (FingerprintIndex),
+    trips already seen in an earlier month of the index are duplicates too, and the month's fingerprints are added to it
+    (unless save_fingerprints=False, e.g. when the month's file was already built from the same raw file).
+    Fingerprints are taken from the raw batch before normalize(), like raw_file_fingerprints.
+    legacy_double_count is passed to clean() (the garbage-row count of the 2021 outputs).
+    With packed_flags=True the flags are written as one uint32 bitmask per row (see pack_flags).
+    year is the year of the month, for the month bounds of rule 4 and the fingerprint index.
+    Returns the same (summary, threshold) as summarize_qa_flags on the whole month.
+'''
+def stream_normalize_clean(raw_path, cleaned_out, flag_out, current_month: int, batch_size: int = 500_000,
+                           compact: bool = True, packed_flags: bool = False, spill_dir=None,
+                           fingerprint_index=None, year: int = qa_year, accumulator: QASummaryAccumulator = None,
+                           save_fingerprints: bool = True, legacy_double_count: bool = False) -> tuple:
+    duplicates = DuplicateTracker()
+    accumulator = QASummaryAccumulator() if accumulator is None else accumulator
+    total_records = 0
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp:
+        spill_data = ParquetAppender(os.path.join(tmp, 'normalized.parquet'))
+        spill_flags = ParquetAppender(os.path.join(tmp, 'flags.parquet'))
+
+        # Pass 1: normalize, QA, spill
+        raw_file = pq.ParquetFile(raw_path)
+        for batch in raw_file.iter_batches(batch_size=batch_size):
+            df = batch.to_pandas()
+            df.index = pd.RangeIndex(total_records, total_records + len(df))
+            # From the raw wall times: normalize() turns DST-ambiguous times into NaT (and works in place with compact=True)
+            fingerprints = trip_fingerprints(df)
+            normalized = normalize(df, compact=compact)
+
+            duplicated = duplicates.update(fingerprints)
+            if fingerprint_index is not None:
+                duplicated |= fingerprint_index.seen_before(fingerprints, year, current_month)
+            qa_flags = run_quality_check(normalized, current_month, duplicated=duplicated, year=year)
+
+            accumulator.update(qa_flags)
+            total_records += len(df)
+
+            spill_data.append(normalized)
+            spill_flags.append(qa_flags)
+        spill_data.close()
+        spill_flags.close()
+
+        if fingerprint_index is not None and save_fingerprints:
+            fingerprint_index.save(year, current_month, duplicates.seen)
+
+        summary = accumulator.summary()
+        threshold = accumulator.threshold()
+
+        # Pass 2: clean with the threshold of the whole month
+        cleaned_writer = ParquetAppender(cleaned_out)
+        flag_writer = ParquetAppender(flag_out)
+        if spill_data.writer is not None:
+            data_batches = pq.ParquetFile(spill_data.path).iter_batches(batch_size=batch_size)
+            flag_batches = pq.ParquetFile(spill_flags.path).iter_batches(batch_size=batch_size)
+            for data_batch, flag_batch in zip(data_batches, flag_batches):
+                normalized = data_batch.to_pandas()
+                qa_flags = flag_batch.to_pandas()
+                if packed_flags:
+                    qa_flags = pack_flags(qa_flags)
+                cleaned, standard = clean(normalized, qa_flags, threshold, legacy_double_count=legacy_double_count)
+                cleaned_writer.append(cleaned)
+                flag_writer.append(standard)
+        cleaned_writer.close()
+        flag_writer.close()
+
+    return summary, threshold
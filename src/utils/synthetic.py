@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.utils.qa_rules import qa_year, rule_names
+
+'''
+    Offline generator of yellow taxi trips in the raw TLC schema (the columns normalize() expects), for benchmarks
+    and experiments without the real files. Trips follow a daily demand curve over the month, popular zones get
+    more pickups, speeds are city-like and the amounts add up like real fares (fare, extra, mta_tax, tip, tolls,
+    improvement and congestion surcharge = total_amount).
+
+    A share of the rows is then made to break one QA rule each, rates[rule] of the rows for every rule
+    (default: about the rates of January 2021 in reports/qa_summary.csv). Some violations imply others, as in the
+    real data: a dropoff before the pickup also gives a negative duration and speed, a zero distance a zero speed,
+    and a trip of less than a minute over more than a mile an excessive speed.
+
+    Usage:
+        df_raw = generate_trips(1_000_000, month=1, rates={'fare_total_mismatch': 0.05})
+        write_trips('raw/synthetic_yellow_tripdata_2021-01.parquet', 10_000_000, month=1)
+'''
+default_rates = {
+    'is_duplicate': 0.001,
+    'missing_datetime': 0.0005,
+    'invalid_time_order': 0.004,
+    'invalid_month': 0.0005,
+    'invalid_duration': 0.008,
+    'invalid_distance': 0.014,
+    'invalid_speed': 0.001,
+    'suspicious_zero_fare': 0.0002,
+    'short_duration_long_distance': 0.0045,
+    'excessive_speed': 0.001,
+    'excessive_duration': 0.0001,
+    'invalid_fare_amount': 0.005,
+    'invalid_tip_amount': 0.0001,
+    'invalid_extra': 0.0015,
+    'invalid_tolls_amount': 0.0001,
+    'invalid_total_amount': 0.0005,
+    'fare_total_mismatch': 0.28,
+    'invalid_payment_type': 0.0005,
+    'invalid_ratecode': 0.07,
+    'unusual_passenger_count': 0.038,
+    'invalid_zone': 0.02,
+}
+# Row counts of the benchmark data sets
+dataset_sizes = {'100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+
+# Share of the trips per local hour of day (0-23)
+hour_weights = np.array([1.5, 1.0, 0.6, 0.4, 0.4, 0.7, 1.8, 3.6, 4.8, 4.9, 4.8, 5.0,
+                         5.3, 5.4, 5.8, 6.0, 6.0, 6.3, 6.4, 5.9, 5.0, 4.4, 3.8, 2.6])
+amount_columns = ['fare_amount', 'extra', 'mta_tax', 'tip_amount', 'tolls_amount', 'improvement_surcharge', 'congestion_surcharge']
+
+'''
+    Pickup zone weights: a few hundred zones with a long tail, as in the real pickups (Manhattan zones first).
+'''
+def zone_weights(rng: np.random.Generator) -> tuple:
+    zones = np.arange(1, 264)
+    weights = 1 / (1 + rng.permutation(len(zones))) ** 1.1
+    return zones, weights / weights.sum()
+
+'''
+    Valid trips of one month in the raw TLC schema (naive New York wall times, float codes where the files have NaN).
+'''
+def valid_trips(n_rows: int, month: int, rng: np.random.Generator) -> pd.DataFrame:
+    month_start = pd.Timestamp(qa_year, month, 1)
+    n_days = (month_start + pd.offsets.MonthBegin(1) - month_start).days
+    hour = rng.choice(24, size=n_rows, p=hour_weights / hour_weights.sum())
+    seconds = rng.integers(0, n_days, n_rows) * 86400 + hour * 3600 + rng.integers(0, 3600, n_rows)
+    pickup = (month_start.to_datetime64() + seconds.astype('timedelta64[s]')).astype('datetime64[ns]')
+
+    # Duration and a speed of 5-25 mph give the distance
+    duration = np.clip(rng.lognormal(np.log(11 * 60), 0.6, n_rows), 90, 4 * 3600).astype(np.int64)
+    distance = np.round(duration / 3600 * rng.uniform(5, 25, n_rows), 2)
+    dropoff = pickup + duration.astype('timedelta64[s]')
+
+    zones, weights = zone_weights(rng)
+    payment_type = rng.choice([1, 2, 3, 4], size=n_rows, p=[0.72, 0.26, 0.01, 0.01])
+    fare = np.round(2.5 + 2.5 * distance + 0.1 * duration / 60, 1)  # flag drop, per mile and time in slow traffic
+    tip = np.where(payment_type == 1, np.round(fare * rng.uniform(0.1, 0.3, n_rows), 2), 0.0)
+    df = pd.DataFrame({
+        'VendorID': rng.choice([1, 2], size=n_rows, p=[0.3, 0.7]),
+        'tpep_pickup_datetime': pickup,
+        'tpep_dropoff_datetime': dropoff,
+        'passenger_count': rng.choice([1.0, 2.0, 3.0, 4.0, 5.0], size=n_rows, p=[0.74, 0.15, 0.05, 0.03, 0.03]),
+        'trip_distance': distance,
+        'RatecodeID': rng.choice([1.0, 2.0, 3.0, 5.0], size=n_rows, p=[0.96, 0.025, 0.005, 0.01]),
+        'store_and_fwd_flag': np.where(rng.random(n_rows) < 0.01, 'Y', 'N'),
+        'PULocationID': rng.choice(zones, size=n_rows, p=weights),
+        'DOLocationID': rng.choice(zones, size=n_rows, p=weights),
+        'payment_type': payment_type,
+        'fare_amount': fare,
+        'extra': rng.choice([0.0, 0.5, 1.0, 2.5], size=n_rows, p=[0.4, 0.35, 0.15, 0.1]),
+        'mta_tax': 0.5,
+        'tip_amount': tip,
+        'tolls_amount': np.where(rng.random(n_rows) < 0.05, 6.12, 0.0),
+        'improvement_surcharge': 0.3,
+        'total_amount': 0.0,
+        'congestion_surcharge': np.where(rng.random(n_rows) < 0.85, 2.5, 0.0),
+        'airport_fee': np.nan,
+    })
+    df['total_amount'] = np.round(df[amount_columns].sum(axis=1), 2)
+    return df
+
+'''
+    Makes the given rows break one QA rule (and the rules it implies), in place.
+'''
+def inject_violation(df: pd.DataFrame, rule: str, rows: np.ndarray, rng: np.random.Generator) -> None:
+    n = len(rows)
+    if n == 0:
+        return
+    pickup_col = df.columns.get_loc('tpep_pickup_datetime')
+    dropoff_col = df.columns.get_loc('tpep_dropoff_datetime')
+    pickup = df['tpep_pickup_datetime'].to_numpy()[rows]
+
+    def set_dropoff(seconds: np.ndarray) -> None:
+        df.iloc[rows, dropoff_col] = pickup + seconds.astype('timedelta64[s]')
+
+    def add_to(column: str, delta) -> None:
+        # Changes one amount and the total with it, so that the arithmetic still matches
+        df.loc[rows, column] += delta
+        df.loc[rows, 'total_amount'] += delta
+
+    if rule == 'missing_datetime':
+        df.iloc[rows[::2], pickup_col] = pd.NaT
+        df.iloc[rows[1::2], dropoff_col] = pd.NaT
+    elif rule == 'invalid_time_order':
+        set_dropoff(-rng.integers(60, 3600, n))
+    elif rule == 'invalid_month':
+        # Pickups a few years or months off, the trip itself unchanged
+        shift = np.where(rng.random(n) < 0.5, 365 * 12, 62).astype('timedelta64[D]')
+        df.iloc[rows, pickup_col] = pickup - shift
+        df.iloc[rows, dropoff_col] = df['tpep_dropoff_datetime'].to_numpy()[rows] - shift
+    elif rule == 'invalid_duration':
+        # Dropoff at the pickup time over a short distance (no speed, so no other rule)
+        set_dropoff(np.zeros(n, dtype=np.int64))
+        df.loc[rows, 'trip_distance'] = np.round(rng.uniform(0.01, 0.9, n), 2)
+    elif rule == 'invalid_distance':
+        df.loc[rows, 'trip_distance'] = 0.0
+    elif rule == 'invalid_speed':
+        df.loc[rows, 'trip_distance'] = -np.round(rng.uniform(0.1, 5, n), 2)
+    elif rule == 'suspicious_zero_fare':
+        add_to('fare_amount', -df['fare_amount'].to_numpy()[rows])
+    elif rule == 'short_duration_long_distance':
+        set_dropoff(rng.integers(1, 25, n))
+        df.loc[rows, 'trip_distance'] = np.round(rng.uniform(1.1, 10, n), 2)
+    elif rule == 'excessive_speed':
+        set_dropoff(rng.integers(300, 600, n))
+        df.loc[rows, 'trip_distance'] = np.round(rng.uniform(10, 40, n), 2)
+    elif rule == 'excessive_duration':
+        set_dropoff(rng.integers(25 * 3600, 48 * 3600, n))
+    elif rule == 'invalid_fare_amount':
+        add_to('fare_amount', -df['fare_amount'].to_numpy()[rows] - np.round(rng.uniform(2.5, 5, n), 1))
+    elif rule == 'invalid_tip_amount':
+        add_to('tip_amount', -df['tip_amount'].to_numpy()[rows] - np.round(rng.uniform(0.5, 2, n), 2))
+    elif rule == 'invalid_extra':
+        add_to('extra', -df['extra'].to_numpy()[rows] - 0.5)
+    elif rule == 'invalid_tolls_amount':
+        add_to('tolls_amount', -df['tolls_amount'].to_numpy()[rows] - 6.12)
+    elif rule == 'invalid_total_amount':
+        # Refunds: every amount negative
+        df.loc[rows, amount_columns + ['total_amount']] *= -1
+    elif rule == 'fare_total_mismatch':
+        df.loc[rows, 'total_amount'] += np.round(rng.uniform(1.5, 20, n), 2)
+    elif rule == 'invalid_payment_type':
+        df.loc[rows, 'payment_type'] = rng.integers(7, 10, n)
+    elif rule == 'invalid_ratecode':
+        df.loc[rows, 'RatecodeID'] = np.where(rng.random(n) < 0.5, np.nan, 7.0)
+    elif rule == 'unusual_passenger_count':
+        df.loc[rows, 'passenger_count'] = rng.choice([0.0, 6.0, 7.0, 9.0], size=n)
+    elif rule == 'invalid_zone':
+        # The Unknown / Outside of NYC rows of the lookup, whose borough or zone is N/A
+        df.loc[rows[::2], 'PULocationID'] = rng.choice([264, 265], size=len(rows[::2]))
+        df.loc[rows[1::2], 'DOLocationID'] = rng.choice([264, 265], size=len(rows[1::2]))
+    else:
+        raise ValueError(f"Unknown QA rule: {rule}")
+
+'''
+    n_rows raw trips of one month with rates[rule] of the rows breaking each rule; rules left out keep
+    their default_rates (pass 0 to turn one off).
+    Every violating row breaks one injected rule (and possibly the rules it implies), so the measured rate of
+    a rule is at least the requested one; the rates must add up to at most 1.
+    Duplicates copy another row of the frame, so they are flagged by rule 1 of the same frame.
+'''
+def generate_trips(n_rows: int, month: int = 1, rates: dict = None, seed: int = 0) -> pd.DataFrame:
+    rates = {**default_rates, **(rates or {})}
+    unknown = set(rates) - set(rule_names)
+    if unknown:
+        raise ValueError(f"Unknown QA rules: {sorted(unknown)}")
+    total_rate = sum(rates.values())
+    if total_rate > 1:
+        raise ValueError(f"Violation rates add up to {total_rate:.3f} > 1")
+
+    rng = np.random.default_rng(seed)
+    df = valid_trips(n_rows, month, rng)
+    rules = list(rates)
+    # Exactly ceil(rate * n_rows) shuffled rows per rule (kind = index of the rule, len(rules) for none),
+    # so that every measured rate is at least the requested one
+    counts = np.ceil(np.array(list(rates.values())) * n_rows).astype(np.int64)
+    kind = np.full(n_rows, len(rules))
+    kind[:min(counts.sum(), n_rows)] = np.repeat(np.arange(len(rules)), counts)[:n_rows]
+    kind = rng.permutation(kind)
+    for i, rule in enumerate(rules):
+        if rule != 'is_duplicate':
+            inject_violation(df, rule, np.flatnonzero(kind == i), rng)
+
+    if 'is_duplicate' in rates:
+        targets = np.flatnonzero(kind == rules.index('is_duplicate'))
+        sources = np.flatnonzero(kind != rules.index('is_duplicate'))
+        if len(targets) and len(sources):
+            order = np.arange(n_rows)
+            order[targets] = rng.choice(sources, size=len(targets))
+            df = df.take(order).reset_index(drop=True)
+    df['total_amount'] = df['total_amount'].round(2)
+    return df
+
+'''
+    Writes n_rows synthetic trips to one parquet file, chunk_rows at a time (10M rows need about one chunk
+    of memory). Duplicates are drawn within each chunk. Returns the number of rows written.
+'''
+def write_trips(path, n_rows: int, month: int = 1, rates: dict = None, seed: int = 0,
+                chunk_rows: int = 1_000_000) -> int:
+    writer = None
+    written = 0
+    for i, chunk_start in enumerate(range(0, n_rows, chunk_rows)):
+        df = generate_trips(min(chunk_rows, n_rows - chunk_start), month, rates, seed=seed + i)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(path, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        written += len(df)
+    if writer is not None:
+        writer.close()
+    return written
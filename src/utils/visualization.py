@@ -3,14 +3,35 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 
-def visualize_summary(df_month: pd.DataFrame, kpi_daily: pd.DataFrame) -> None: 
-    df = df_month.copy()
-    kpi = kpi_daily.copy()
-    month_name = df['tpep_pickup_datetime'].dt.strftime('%B').unique()[0]
+from src.utils.demand import DemandStore
+from src.utils.figure_data import FigureData, correlation_matrix
+from src.utils.instrumentation import instrumented
+
+'''
+    Every visualize_* function plots from figure data only (src/utils/figure_data.py). df_month is either a FigureData
+    (of a month, or merged months for a year) or the trips of a month, whose figure data is then computed first.
+    Each returns its figures by name (the file name without .png), see src/utils/rendering.py to save them.
+'''
+def as_figure_data(df_month, qa_flags: pd.DataFrame, part: str, kpi_daily: pd.DataFrame = None) -> FigureData:
+    if isinstance(df_month, FigureData):
+        return df_month
+    return FigureData.from_trips(df_month, qa_flags, kpi_daily, parts=[part])
+
+'''
+    kpi_daily (the 'Daily' frame of aggregate_kpis) is required with the trips of a month; figure data already holds it.
+'''
+@instrumented
+def visualize_summary(df_month, kpi_daily: pd.DataFrame = None) -> dict: 
+    if not isinstance(df_month, FigureData) and kpi_daily is None:
+        raise ValueError("visualize_summary needs kpi_daily (aggregate_kpis(...)['Daily']) for the trips of a month")
+    data = as_figure_data(df_month, None, 'summary', kpi_daily)
+    if 'daily' not in data.frames:
+        raise ValueError("The figure data has no daily KPIs: build it with FigureData.from_trips(..., kpi_daily)")
+    month_name = data.label
 
     # Plot revenue per day of the month.
     # LinePlot
-    revenue_per_day = kpi['Total_fare']
+    revenue_per_day = data['daily']['Total_fare']
 
     fig1 = plt.figure(figsize=(10, 6))
     plt.plot(revenue_per_day.index.astype(str), revenue_per_day.values, marker='o')
@@ -22,7 +43,7 @@ def visualize_summary(df_month: pd.DataFrame, kpi_daily: pd.DataFrame) -> None:
 
     # Plot trips per day of the month.   
     # BarPlot
-    trips_per_day = kpi['Total_trips']
+    trips_per_day = data['daily']['Total_trips']
 
     fig2 = plt.figure(figsize=(10, 6))
     plt.bar(trips_per_day.index.astype(str), trips_per_day.values)
@@ -34,24 +55,23 @@ def visualize_summary(df_month: pd.DataFrame, kpi_daily: pd.DataFrame) -> None:
 
     # Plot trips per day of week
     # Heatmap with 7 days of week
-    day_map = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-
-    df['pickup_hour'] = df['tpep_pickup_datetime'].dt.hour
-
     fig3 = plt.figure(figsize=(10, 6))
-    sns.heatmap(data=df.groupby(['pickup_day_of_week', 'pickup_hour']).size().unstack(fill_value=0).reindex(day_map), cmap="viridis")
+    sns.heatmap(data=data['hour_day_of_week'], cmap="viridis")
     plt.title(f'Trip per week in {month_name}')
     plt.xlabel('Day of week')
     plt.ylabel('Total amount of trip')
 
-def visualize_customer_segments(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> None:
-    df = df_month.copy()
-    qa = qa_flags.copy()
-    month_name = df['tpep_pickup_datetime'].dt.strftime('%B').unique()[0]
+    return {'revenue_per_day': fig1, 'trips_per_day': fig2, 'trips_per_week_heatmap': fig3}
+
+@instrumented
+def visualize_customer_segments(df_month, qa_flags: pd.DataFrame = None) -> dict:
+    data = as_figure_data(df_month, qa_flags, 'customer_segments')
+    month_name = data.label
 
     # Plot distribution of payment types
     # Pie chart
-    payment_counts =  df.loc[~qa['invalid_payment_type'], 'payment_type_name'].value_counts()
+    payment_counts = data['payment']['trips']
+    payment_counts = payment_counts[payment_counts > 0] # categorical labels also count unused categories
 
     fig1 = plt.figure(figsize=(10, 6))
     plt.pie(payment_counts.values, labels=None, autopct=None, startangle=90, wedgeprops={'linewidth': 1, 'edgecolor': 'white'})
@@ -61,13 +81,9 @@ def visualize_customer_segments(df_month: pd.DataFrame, qa_flags: pd.DataFrame)
 
     # Plot daily trend of group rides (passenger_count > 2)
     # Bar plot (30-31 columns for days of month)
+    daily_group_counts = data['group_rides']['trips']
+    daily_group_counts = daily_group_counts[daily_group_counts > 0]
     
-    mask_group = (~qa['unusual_passenger_count']) & (df['passenger_count'] > 2)
-    group_rides = df.loc[mask_group]
-    
-    daily_group_counts = group_rides.groupby(group_rides['tpep_pickup_datetime'].dt.day).size()
-    
-    # 3. Plot
     fig2 = plt.figure(figsize=(10, 6))
     plt.bar(daily_group_counts.index, daily_group_counts.values, color='teal', alpha=0.7)
     plt.title(f'Daily Volume of Group Rides (>2 Passengers) in {month_name}')
@@ -79,23 +95,27 @@ def visualize_customer_segments(df_month: pd.DataFrame, qa_flags: pd.DataFrame)
 
     # Plot tip amount correlation with distance and duration
     # Correlation matrix (3x3)
-    cols = ['tip_amount', 'trip_distance', 'trip_duration_minutes']
-    mask = (~qa['invalid_tip_amount']) & (~qa['suspicious_zero_fare']) & (~qa['short_duration_long_distance']) & (~qa['excessive_speed']) & (~qa['excessive_duration'])
-    df_corr = df.loc[mask, cols]
-    corr_matrix = df_corr.corr()
+    corr_matrix = correlation_matrix(data['tip_moments'])
     fig_corr = plt.figure(figsize=(6,5))
     sns.heatmap(corr_matrix, annot=True, cmap='coolwarm', vmin=-1, vmax=1)
     plt.title(f'Correlation (tip, distance, duration) in {month_name}')
     plt.tight_layout()
 
-def visualize_temporal_trends(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> None:
-    df = df_month.copy()
-    qa = qa_flags.copy()
-    month_name = df['tpep_pickup_datetime'].dt.strftime('%B').unique()[0]
+    return {'payment_type_distribution': fig1, 'daily_group_ride_demand': fig2, 'tip_correlation_matrix': fig_corr}
+
+'''
+    With a DemandStore, the trips per hour come from the store (all trips of the month, or of the store
+    for the figure data of several months) instead of the figure data.
+'''
+@instrumented
+def visualize_temporal_trends(df_month, qa_flags: pd.DataFrame = None, demand: DemandStore = None) -> dict:
+    data = as_figure_data(df_month, qa_flags, 'temporal_trends')
+    month_name = data.label
+    hourly = data['hourly']
 
     # Plot average speed per hour of day
     # Histogram
-    avg_speed_per_hour = df.loc[(~qa['excessive_speed'])].groupby(df['tpep_pickup_datetime'].dt.hour)['avg_speed_mph'].mean()
+    avg_speed_per_hour = (hourly['speed_sum'] / hourly['speed_count'])[hourly['speed_count'] > 0]
     fig1 = plt.figure(figsize=(10, 6))
     plt.hist(avg_speed_per_hour.index, weights=avg_speed_per_hour.values, bins = 24, rwidth=0.8)
     plt.title(f'Average Speed per Hour in {month_name}')
@@ -104,7 +124,10 @@ def visualize_temporal_trends(df_month: pd.DataFrame, qa_flags: pd.DataFrame) ->
 
     # Number of trips per Hour
     # Barchart
-    trip_count_per_hour = df.loc[(~qa['suspicious_zero_fare']) & (~qa['short_duration_long_distance']) & (~qa['excessive_speed']) & (~qa['excessive_duration'])].groupby(df['tpep_pickup_datetime'].dt.hour)['tpep_pickup_datetime'].count()
+    if demand is not None:
+        trip_count_per_hour = demand.hour_of_day(month=data.months[0] if len(data.months) == 1 else None)
+    else:
+        trip_count_per_hour = hourly['trips'][hourly['trips'] > 0]
     fig2 = plt.figure()
     sns.barplot(x=trip_count_per_hour.index, y=trip_count_per_hour.values, palette="viridis")
     plt.title(f'Trip per hour in {month_name}')
@@ -113,24 +136,40 @@ def visualize_temporal_trends(df_month: pd.DataFrame, qa_flags: pd.DataFrame) ->
 
     # Revenue per Hour
     # LinePlot
-    revenue_per_hour = df.loc[(~qa['suspicious_zero_fare']) & (~qa['short_duration_long_distance']) & (~qa['excessive_speed']) & (~qa['excessive_duration'])].groupby(df['tpep_pickup_datetime'].dt.hour)['total_amount'].sum()
+    revenue_per_hour = hourly['revenue'][hourly['trips'] > 0]
     fig3 = plt.figure()
     plt.plot(revenue_per_hour.index, revenue_per_hour.values, marker='o')
     plt.title(f'Revenue per hour in {month_name}')
     plt.xlabel('Hour of day')
     plt.ylabel('Total Revenue') 
 
-def visualize_trip_characteristics(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> None:
-    df = df_month.copy()
-    qa = qa_flags.copy()
-    mask = (~qa['invalid_tip_amount']) & (~qa['suspicious_zero_fare']) & (~qa['short_duration_long_distance']) & (~qa['excessive_speed']) & (~qa['excessive_duration'])
-    month_name = df['tpep_pickup_datetime'].dt.strftime('%B').unique()[0]
+    return {'avg_speed_per_hour': fig1, 'trips_per_hour': fig2, 'revenue_per_hour': fig3}
+
+'''
+    Histogram bars of a histogram frame with its precomputed KDE curve, over the occupied bins
+    merged into about 60 bars (the bins of the original plots).
+'''
+def plot_histogram(histogram: pd.DataFrame, color: str, bars: int = 60) -> None:
+    occupied = np.flatnonzero(histogram['count'].to_numpy())
+    if len(occupied):
+        histogram = histogram.iloc[occupied[0]:occupied[-1] + 1]
+    centers = (histogram['left'] + histogram['right']).to_numpy() / 2
+    starts = np.arange(0, len(histogram), max(1, len(histogram) // bars))
+    edges = list(histogram['left'].iloc[starts]) + [histogram['right'].iloc[-1]]
+    counts = np.add.reduceat(histogram['count'].to_numpy(), starts) if len(histogram) else []
+    sns.histplot(x=histogram['left'].iloc[starts].to_numpy(), weights=counts, bins=edges, color=color)
+    # The KDE per fine bin, scaled to the width of the bars
+    plt.plot(centers, histogram['kde'].to_numpy() * max(1, len(histogram) // bars), color=color)
+
+@instrumented
+def visualize_trip_characteristics(df_month, qa_flags: pd.DataFrame = None) -> dict:
+    data = as_figure_data(df_month, qa_flags, 'trip_characteristics')
+    month_name = data.label
 
     # Plot distance distribution
     # Histogram
-    dist = df.loc[mask, 'trip_distance'].dropna()
-    plt.figure(figsize=(10,5))
-    sns.histplot(np.log1p(dist), bins=60, kde=True, color='C0')
+    fig1 = plt.figure(figsize=(10,5))
+    plot_histogram(data['distance_hist'], 'C0')
     plt.title(f'Trip distance distribution (log1p scale) in {month_name}')
     plt.xlabel('log1p(trip_distance) (miles)')
     plt.ylabel('Count')
@@ -139,23 +178,24 @@ def visualize_trip_characteristics(df_month: pd.DataFrame, qa_flags: pd.DataFram
 
     # Plot duration distribution
     # Histogram
-    dur = df.loc[mask, 'trip_duration_minutes'].dropna()
-    plt.figure(figsize=(10,5))
-    sns.histplot(np.log1p(dur), bins=60, kde=True, color='C1')
+    fig2 = plt.figure(figsize=(10,5))
+    plot_histogram(data['duration_hist'], 'C1')
     plt.title(f'Trip duration distribution (log1p scale) in {month_name}')
     plt.xlabel('log1p(duration_min)')
     plt.ylabel('Count')
     plt.tight_layout()
 
-def visualize_geographical_analysis(df_month: pd.DataFrame, qa_flags: pd.DataFrame) -> None:
-    df = df_month.copy()
-    qa = qa_flags.copy()
+    return {'trip_distance_distribution': fig1, 'trip_duration_distribution': fig2}
+
+@instrumented
+def visualize_geographical_analysis(df_month, qa_flags: pd.DataFrame = None) -> dict:
+    data = as_figure_data(df_month, qa_flags, 'geographical_analysis')
+    month_name = data.label
     # Top 10 pick up zones 
     # Horizontal Bar plot
-    LocationID_counts = df['PU_Zone'].value_counts().nlargest(10).sort_values(ascending=False)
-    month_name = df['tpep_pickup_datetime'].dt.strftime('%B').unique()[0]
+    LocationID_counts = data['zones']['pickup'].nlargest(10).sort_values(ascending=False)
 
-    fig5 = plt.figure(figsize=(10, 6))
+    fig4 = plt.figure(figsize=(10, 6))
     sns.barplot(x=LocationID_counts.values, y=LocationID_counts.index, palette="viridis", orient='h', order=LocationID_counts.index)
     plt.title(f'Top 10 most Pick Up Trips LocationID in {month_name}')
     plt.xlabel('Total amount of trip')
@@ -163,7 +203,7 @@ def visualize_geographical_analysis(df_month: pd.DataFrame, qa_flags: pd.DataFra
 
     # Top 10 drop off zones
     # Horizontal Bar plot
-    LocationID_counts = df['DO_Zone'].value_counts().nlargest(10).sort_values(ascending=False)
+    LocationID_counts = data['zones']['dropoff'].nlargest(10).sort_values(ascending=False)
 
     fig5 = plt.figure(figsize=(10, 6))
     sns.barplot(x=LocationID_counts.values, y=LocationID_counts.index, palette="viridis", orient='h', order=LocationID_counts.index)
@@ -171,7 +211,10 @@ def visualize_geographical_analysis(df_month: pd.DataFrame, qa_flags: pd.DataFra
     plt.xlabel('Total amount of trip')
     plt.ylabel('LocationId')
 
-def visualize_years(df: pd.DataFrame) -> None:
+    return {'top10_pickup_zones': fig4, 'top10_dropoff_zones': fig5}
+
+@instrumented
+def visualize_years(df: pd.DataFrame) -> dict:
     df = df.copy()
 
     # Change to datetime
@@ -200,10 +243,12 @@ def visualize_years(df: pd.DataFrame) -> None:
     plt.tight_layout()
 
     # Bar chart Average Distance
-    plt.figure(figsize=(10,5))
+    fig2 = plt.figure(figsize=(10,5))
     plt.bar(df['month'], df['avg_distance'])
     plt.title('Average Trip Distance by Month')
     plt.ylabel('Average Distance')
     plt.xlabel('Month')
     plt.grid(axis='y', alpha=0.3)
-    plt.tight_layout()
\ No newline at end of file
+    plt.tight_layout()
+
+    return {'revenue_vs_trip': fig, 'trip_distance_whole_year': fig2}